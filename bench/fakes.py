@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+Локальные заглушки OpenAI и Bitrix24 для нагрузочных тестов RUBI CHAT PRO
+Настраиваемые задержка, скорость генерации токенов, пагинация и лимиты запросов
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class TokenBucket:
+    """Лимит запросов: rate в секунду, burst - запас для всплеска"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self) -> float:
+        """0, если запрос пропущен, иначе сколько секунд подождать"""
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _json(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# =====================
+# OPENAI
+# =====================
+
+SCORE_ARGUMENTS = json.dumps({
+    "politeness": 4,
+    "understanding": 3,
+    "solution": 4,
+    "closing": 3,
+    "sentiment": "Позитивная",
+    "key_phrases": ["добрый день", "коммерческое предложение", "созвонимся завтра"],
+    "recommendations": ["Уточнять бюджет клиента", "Назначать следующий шаг"]
+}, ensure_ascii=False)
+
+ASSISTANT_REPLY = "Коротко: сделка в стадии переговоров, следующий шаг - отправить КП до пятницы."
+
+
+class FakeOpenAI:
+    """Заглушка OpenAI API: транскрибация, chat.completions (в т.ч. stream) и эмбеддинги"""
+
+    def __init__(self, latency: float = 0.02, tokens_per_second: float = 200, rpm: float = 0, port: int = 0):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.limiter = TokenBucket(rpm / 60, max(int(rpm / 10), 1)) if rpm else TokenBucket(0, 0)
+        self.requests = 0
+        self.rejected = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def start(self) -> "FakeOpenAI":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(_Handler):
+            def do_POST(self):
+                body = self._body()
+                fake.requests += 1
+                wait = fake.limiter.take()
+                if wait:
+                    fake.rejected += 1
+                    self._json(
+                        429,
+                        {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                        {"retry-after": f"{wait:.3f}", "x-ratelimit-remaining-requests": "0"}
+                    )
+                    return
+                time.sleep(fake.latency)
+
+                if self.path.endswith("/audio/transcriptions"):
+                    self._transcription(len(body))
+                elif self.path.endswith("/chat/completions"):
+                    self._chat(json.loads(body))
+                elif self.path.endswith("/embeddings"):
+                    self._embeddings(json.loads(body))
+                else:
+                    self._json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+            def _transcription(self, size: int):
+                # Длительность условно пропорциональна размеру (16 КБ/с)
+                duration = max(size / 16000, 1.0)
+                segments = [
+                    {
+                        "id": i,
+                        "start": float(start),
+                        "end": float(min(start + 5, duration)),
+                        "text": f"Реплика {i}: добрый день, обсуждаем поставку.",
+                        "no_speech_prob": 0.01
+                    }
+                    for i, start in enumerate(range(0, int(duration), 5))
+                ]
+                self._json(200, {
+                    "task": "transcribe",
+                    "language": "russian",
+                    "duration": duration,
+                    "text": " ".join(seg["text"] for seg in segments),
+                    "segments": segments
+                })
+
+            def _chat(self, request: dict):
+                tool = (request.get("tools") or [None])[0]
+                text = SCORE_ARGUMENTS if tool else ASSISTANT_REPLY
+                usage = {"prompt_tokens": 500, "completion_tokens": len(text) // 3, "total_tokens": 500 + len(text) // 3}
+
+                if not request.get("stream"):
+                    message = {"role": "assistant", "content": None if tool else text}
+                    if tool:
+                        message["tool_calls"] = [{
+                            "id": "call_1",
+                            "type": "function",
+                            "function": {"name": tool["function"]["name"], "arguments": text}
+                        }]
+                    self._json(200, {
+                        "id": "chatcmpl-fake",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": request["model"],
+                        "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                        "usage": usage
+                    })
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                pieces = re.findall(r".{1,4}", text, re.S)
+                for i, piece in enumerate(pieces):
+                    if tool:
+                        call = {"index": 0, "function": {"arguments": piece}}
+                        if i == 0:
+                            call.update(id="call_1", type="function")
+                            call["function"]["name"] = tool["function"]["name"]
+                        delta = {"tool_calls": [call]}
+                    else:
+                        delta = {"content": piece}
+                    self._event({
+                        "id": "chatcmpl-fake",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": request["model"],
+                        "choices": [{"index": 0, "delta": delta, "finish_reason": None}]
+                    })
+                    if fake.tokens_per_second:
+                        time.sleep(1 / fake.tokens_per_second)
+                if (request.get("stream_options") or {}).get("include_usage"):
+                    self._event({
+                        "id": "chatcmpl-fake",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": request["model"],
+                        "choices": [],
+                        "usage": usage
+                    })
+                self._chunk(b"data: [DONE]\n\n")
+                self._chunk(b"")
+
+            def _event(self, payload: dict):
+                self._chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+            def _chunk(self, data: bytes):
+                try:
+                    self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # Клиент закрыл поток досрочно (JSON уже получен)
+                    pass
+
+            def _embeddings(self, request: dict):
+                inputs = request["input"] if isinstance(request["input"], list) else [request["input"]]
+                dimensions = request.get("dimensions", 1536)
+                data = []
+                for i, text in enumerate(inputs):
+                    rnd = random.Random(text)
+                    data.append({"object": "embedding", "index": i, "embedding": [rnd.gauss(0, 1) for _ in range(dimensions)]})
+                self._json(200, {
+                    "object": "list",
+                    "data": data,
+                    "model": request["model"],
+                    "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)}
+                })
+
+        return Handler
+
+
+# =====================
+# BITRIX24
+# =====================
+
+class FakeBitrix:
+    """Заглушка REST API Bitrix24: list-методы по 50 записей со start/next (или по ID со start=-1), batch и лимит запросов"""
+
+    PAGE_SIZE = 50
+
+    def __init__(self, calls: int = 1000, deals: int = 1000, managers: int = 10,
+                 rps: float = 2, burst: int = 50, latency: float = 0.01, port: int = 0):
+        self.latency = latency
+        self.limiter = TokenBucket(rps, burst)
+        self.requests = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+        base = time.mktime((2024, 1, 1, 0, 0, 0, 0, 0, -1))
+        self.users = [{"ID": str(i), "NAME": "Менеджер", "LAST_NAME": str(i)} for i in range(1, managers + 1)]
+        self.deals = [
+            {
+                "ID": str(i),
+                "TITLE": f"ООО Клиент {i}",
+                "ASSIGNED_BY_ID": str(i % managers + 1),
+                "OPPORTUNITY": str(10000 * (i % 97 + 1)),
+                "STAGE_ID": ["NEW", "PREPARATION", "EXECUTING", "WON", "LOSE"][i % 5],
+                "PROBABILITY": str(i * 7 % 100),
+                "CLOSEDATE": self._date(base + i * 86400),
+                "DATE_MODIFY": self._date(base + i)
+            }
+            for i in range(1, deals + 1)
+        ]
+        self.activities = [
+            {
+                "ID": str(i),
+                "OWNER_ID": str(i % max(deals, 1) + 1),
+                "OWNER_TYPE_ID": "2",
+                "SUBJECT": "Звонок",
+                "TYPE_ID": "1",
+                "RESPONSIBLE_ID": str(i % managers + 1),
+                "START_TIME": self._date(base + i * 60),
+                "DATE_MODIFY": self._date(base + i * 60),
+                "FILES": [{"id": i, "url": ""}]
+            }
+            for i in range(1, calls + 1)
+        ]
+        self.added = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+        for activity in self.activities:
+            activity["FILES"][0]["url"] = f"{self.base_url}records/{activity['ID']}.mp3"
+
+    @staticmethod
+    def _date(ts: float) -> str:
+        return time.strftime("%Y-%m-%dT%H:%M:%S+03:00", time.localtime(ts))
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/rest/1/fake/"
+
+    def start(self) -> "FakeBitrix":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def touch_deals(self, count: int):
+        """Изменить count сделок (для проверки дельта-синхронизации)"""
+        now = self._date(time.time())
+        for deal in self.deals[:count]:
+            deal["PROBABILITY"] = str((int(deal["PROBABILITY"] or 0) + 10) % 100)
+            deal["DATE_MODIFY"] = now
+
+    def _list(self, rows: list, params: dict) -> dict:
+        filters = params.get("filter") or {}
+        since = filters.get(">=DATE_MODIFY")
+        after_id = int(filters.get(">ID") or 0)
+        selected = [
+            row for row in rows
+            if (since is None or row.get("DATE_MODIFY", "") >= since)
+            and int(row["ID"]) > after_id
+            and all(row.get(k) == v for k, v in filters.items() if not k.startswith(">"))
+        ]
+        for field, direction in reversed(list((params.get("order") or {}).items())):
+            key = (lambda row: int(row["ID"])) if field == "ID" else (lambda row, field=field: row.get(field, ""))
+            selected.sort(key=key, reverse=str(direction).upper() == "DESC")
+        start = int(params.get("start") or 0)
+        if start < 0:
+            # start=-1: без подсчета total и без next, следующая страница - по фильтру >ID
+            return {"result": selected[:self.PAGE_SIZE]}
+        page = selected[start:start + self.PAGE_SIZE]
+        result = {"result": page, "total": len(selected)}
+        if start + self.PAGE_SIZE < len(selected):
+            result["next"] = start + self.PAGE_SIZE
+        return result
+
+    def call(self, method: str, params: dict) -> dict:
+        if method == "crm.activity.list":
+            return self._list(self.activities, params)
+        if method == "crm.deal.list":
+            return self._list(self.deals, params)
+        if method == "user.get":
+            return self._list(self.users, params)
+        if method == "crm.deal.get":
+            deal = next((d for d in self.deals if d["ID"] == str(params.get("id"))), None)
+            if deal is None:
+                return {"error": "NOT_FOUND", "error_description": "Not found"}
+            return {"result": deal}
+        if method == "crm.activity.get":
+            activity = next((a for a in self.activities if a["ID"] == str(params.get("id"))), None)
+            if activity is None:
+                return {"error": "NOT_FOUND", "error_description": "Not found"}
+            return {"result": activity}
+        if method == "crm.activity.add":
+            with self.lock:
+                self.added.append(params.get("fields"))
+                return {"result": len(self.added)}
+        return {"error": "ERROR_METHOD_NOT_FOUND", "error_description": f"Method {method} not found"}
+
+    def _handler(self):
+        fake = self
+
+        class Handler(_Handler):
+            def do_GET(self):
+                if "/records/" in self.path:
+                    # Запись звонка: заголовок MPEG-кадра и ~2 секунды «аудио»
+                    seed = self.path.rsplit("/", 1)[-1].encode()
+                    frame = bytes([0xFF, 0xFB, 0x90, 0x00]) + seed.ljust(413, b"\x00")
+                    body = frame * 80
+                    self.send_response(200)
+                    self.send_header("Content-Type", "audio/mpeg")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                else:
+                    self._json(404, {"error": "NOT_FOUND"})
+
+            def do_POST(self):
+                body = self._body()
+                fake.requests += 1
+                wait = fake.limiter.take()
+                if wait:
+                    fake.rejected += 1
+                    self._json(503, {"error": "QUERY_LIMIT_EXCEEDED", "error_description": "Too many requests"})
+                    return
+                time.sleep(fake.latency)
+
+                method = self.path.rsplit("/", 1)[-1].removesuffix(".json")
+                params = json.loads(body or b"{}")
+                if method == "batch":
+                    results, errors = {}, {}
+                    for key, command in (params.get("cmd") or {}).items():
+                        name, _, query = command.partition("?")
+                        flat = dict(parse_qsl(query))
+                        answer = fake.call(name, {"id": flat.get("id"), "fields": {
+                            k[7:-1]: v for k, v in flat.items() if k.startswith("fields[")
+                        }})
+                        if "error" in answer:
+                            errors[key] = answer
+                        else:
+                            results[key] = answer["result"]
+                    self._json(200, {"result": {"result": results, "result_error": errors}})
+                    return
+
+                answer = fake.call(method, params)
+                self._json(400 if "error" in answer else 200, answer)
+
+        return Handler
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный бенчмарк RUBI CHAT PRO на локальных заглушках OpenAI и Bitrix24
+
+Запуск из корня репозитория:
+    python bench/run_bench.py                    # 10k звонков, 1M сделок
+    python bench/run_bench.py --quick            # быстрый прогон
+    python bench/run_bench.py --save-baseline    # сохранить результат как эталон
+    python bench/run_bench.py --check            # код выхода 1 при регрессии относительно эталона
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fakes import FakeBitrix, FakeOpenAI
+
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+
+# Метрика -> направление: +1 - чем больше, тем хуже; -1 - чем меньше, тем хуже
+METRICS = {"p50_ms": 1, "p95_ms": 1, "throughput_per_s": -1, "peak_mb": 1}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк RUBI CHAT PRO")
+    parser.add_argument("--calls", type=int, default=10000, help="Звонков для транскрибации/оценки")
+    parser.add_argument("--deals", type=int, default=1000000, help="Сделок для дашбордов")
+    parser.add_argument("--bitrix-deals", type=int, default=5000, help="Сделок в заглушке Bitrix24")
+    parser.add_argument("--workers", type=int, default=8, help="Параллельных потоков")
+    parser.add_argument("--openai-latency", type=float, default=0.02, help="Задержка ответа OpenAI, с")
+    parser.add_argument("--openai-tps", type=float, default=200, help="Скорость потоковой генерации, фрагментов/с")
+    parser.add_argument("--openai-rpm", type=float, default=0, help="Лимит запросов OpenAI в минуту (0 - без лимита)")
+    parser.add_argument("--bitrix-rps", type=float, default=2, help="Лимит запросов Bitrix24 в секунду")
+    parser.add_argument("--bitrix-burst", type=int, default=50, help="Запас запросов Bitrix24 для всплеска")
+    parser.add_argument("--quick", action="store_true", help="200 звонков, 100k сделок")
+    parser.add_argument("--only", nargs="*", help="Запустить только эти сценарии")
+    parser.add_argument("--output", help="Сохранить результаты в JSON")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Файл эталона")
+    parser.add_argument("--save-baseline", action="store_true", help="Записать результаты как эталон")
+    parser.add_argument("--check", action="store_true", help="Код выхода 1 при регрессии")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Допустимое ухудшение (доля)")
+    args = parser.parse_args()
+    if args.quick:
+        args.calls, args.deals, args.bitrix_deals = 200, 100000, 1000
+    return args
+
+
+def summarize(latencies: list, elapsed: float, errors: int) -> dict:
+    _, peak = tracemalloc.get_traced_memory()
+    ms = np.asarray(latencies) * 1000 if latencies else np.zeros(1)
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "p50_ms": round(float(np.percentile(ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(ms, 95)), 2),
+        "throughput_per_s": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "peak_mb": round(peak / 2 ** 20, 1)
+    }
+
+
+def measure(func, items: list, workers: int = 1) -> dict:
+    """Прогнать func по items: задержка каждого вызова, пропускная способность, пик памяти"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def timed(item):
+        started = time.perf_counter()
+        try:
+            func(item)
+        except Exception:
+            with lock:
+                errors[0] += 1
+        with lock:
+            latencies.append(time.perf_counter() - started)
+
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(timed, items))
+    else:
+        for item in items:
+            timed(item)
+    return summarize(latencies, time.perf_counter() - started, errors[0])
+
+
+def require(value):
+    """Функции приложения возвращают пустое значение при ошибке - считаем это ошибкой"""
+    if not value:
+        raise RuntimeError("empty result")
+    return value
+
+
+def fake_mp3(i: int, frames: int = 120) -> bytes:
+    """Уникальная «запись» из MPEG-кадров, чтобы не попадать в кэш"""
+    frame = bytes([0xFF, 0xFB, 0x90, 0x00]) + str(i).encode().ljust(413, b"\x00")
+    return frame * frames
+
+
+def synthetic_deals(n: int) -> pd.DataFrame:
+    rng = np.random.default_rng(42)
+    managers = [f"Менеджер {i}" for i in range(50)]
+    return pd.DataFrame({
+        "id": np.arange(1, n + 1),
+        "title": pd.Series(np.arange(1, n + 1)).astype(str).radd("ООО Клиент "),
+        "manager": rng.choice(managers, n),
+        "amount": rng.integers(10000, 5000000, n),
+        "stage": rng.choice(["Квалификация", "Предложение", "Переговоры", "Закрыто выиграно", "Закрыто проиграно"], n),
+        "probability": rng.integers(0, 101, n),
+        "next_action": "—"
+    })
+
+
+def run(args) -> dict:
+    openai_server = FakeOpenAI(args.openai_latency, args.openai_tps, args.openai_rpm).start()
+    bitrix = FakeBitrix(args.calls, args.bitrix_deals, rps=args.bitrix_rps, burst=args.bitrix_burst).start()
+    data_dir = tempfile.mkdtemp(prefix="rubi-bench-")
+    os.environ.update({
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": openai_server.base_url,
+        "BITRIX24_WEBHOOK": bitrix.base_url,
+        "RUBI_DATA_DIR": data_dir,
+        "BATCH_MAX_WORKERS": str(args.workers),
+        "BITRIX_RPS": str(args.bitrix_rps),
+        "BITRIX_BURST": str(args.bitrix_burst),
+    })
+    if args.openai_rpm:
+        os.environ["OPENAI_RPM"] = str(args.openai_rpm)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    import rubi_chat_pro_complete as app
+    import_seconds = time.perf_counter() - started
+    app.bare_mode()
+
+    wanted = set(args.only or [])
+    results = {"import": summarize([import_seconds], import_seconds, 0)}
+
+    def scenario(name, func, *a, **kw):
+        if wanted and name not in wanted:
+            return
+        print(f"▶ {name}...", flush=True)
+        results[name] = func(*a, **kw)
+        print(f"  {results[name]}", flush=True)
+
+    # OpenAI: каждый вызов с уникальным входом, чтобы измерять API, а не кэш
+    scenario("transcribe_audio", measure,
+             lambda i: require(app.transcribe_audio(fake_mp3(i))), list(range(args.calls)), args.workers)
+    scenario("analyze_call", measure,
+             lambda i: require(app.analyze_call(f"Звонок {i}: добрый день, обсуждаем поставку и сроки.")),
+             list(range(args.calls)), args.workers)
+    scenario("analyze_call_cached", measure,
+             lambda i: require(app.analyze_call(f"Звонок {i}: добрый день, обсуждаем поставку и сроки.")),
+             list(range(min(args.calls, 1000))), 1)
+
+    # Bitrix24: полная синхронизация, дельта и чтение из локального хранилища
+    scenario("bitrix_sync_full", measure, lambda _: app.sync_bitrix(), [None])
+    bitrix.touch_deals(100)
+    scenario("bitrix_sync_delta", measure, lambda _: app.sync_bitrix(), [None])
+    scenario("get_calls_from_bitrix", measure, lambda _: require(app.get_calls_from_bitrix()), list(range(200)))
+
+    def batch_pipeline():
+        items = app.batch_items_from_bitrix(app.get_calls_from_bitrix(limit=args.calls))
+        latencies, errors = [], 0
+        tracemalloc.reset_peak()
+        started = time.perf_counter()
+        for result in app.run_batch_analysis(items, max_workers=args.workers):
+            latencies.append(result["elapsed"])
+            errors += bool(result["error"])
+        return summarize(latencies, time.perf_counter() - started, errors)
+
+    scenario("batch_pipeline", batch_pipeline)
+
+    # Дашборды на синтетических сделках
+    if not wanted or wanted & {"deals_frame", "deal_index", "deal_filter", "deals_table"}:
+        raw = synthetic_deals(args.deals)
+        deals = app.build_deals_frame(raw)
+        index = app.build_deal_index(deals)
+        rng = np.random.default_rng(7)
+        filters = [
+            (
+                rng.choice(["Все"] + index["managers"]),
+                rng.choice(["Все"] + index["stages"]),
+                rng.choice(["Все"] + app.PROBABILITY_BUCKETS)
+            )
+            for _ in range(200)
+        ]
+        scenario("deals_frame", measure, lambda _: app.build_deals_frame(raw), [None] * 3)
+        scenario("deal_index", measure, lambda _: app.build_deal_index(deals), [None] * 3)
+        scenario("deal_filter", measure, lambda f: app.select_deals(index, *f), filters)
+        scenario("deals_table", measure,
+                 lambda f: app.build_deals_table(deals.iloc[np.sort(app.select_deals(index, *f)[0])[:app.TABLE_MAX_ROWS]]),
+                 filters)
+
+    results["_backends"] = {
+        "openai_requests": openai_server.requests,
+        "openai_rejected": openai_server.rejected,
+        "bitrix_requests": bitrix.requests,
+        "bitrix_rejected": bitrix.rejected
+    }
+    openai_server.stop()
+    bitrix.stop()
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Регрессии: [(сценарий, метрика, эталон, сейчас), ...]"""
+    regressions = []
+    for name, metrics in results.items():
+        if name.startswith("_") or name not in baseline:
+            continue
+        for metric, direction in METRICS.items():
+            old, new = baseline[name].get(metric), metrics.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * direction
+            if change > tolerance:
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def main():
+    args = parse_args()
+    results = run(args)
+
+    print()
+    print(f"{'Сценарий':<24}{'N':>8}{'Ошибок':>8}{'p50, мс':>12}{'p95, мс':>12}{'В секунду':>12}{'Пик, МБ':>10}")
+    for name, m in results.items():
+        if not name.startswith("_"):
+            print(f"{name:<24}{m['count']:>8}{m['errors']:>8}{m['p50_ms']:>12}{m['p95_ms']:>12}{m['throughput_per_s']:>12}{m['peak_mb']:>10}")
+    print(f"Бэкенды: {results['_backends']}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"💾 Эталон сохранен: {args.baseline}")
+        return
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, metric, old, new in regressions:
+            print(f"🔴 {name}.{metric}: {old} -> {new}")
+        if not regressions:
+            print("🟢 Регрессий относительно эталона нет")
+        if regressions and args.check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
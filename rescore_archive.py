@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Переоценка архива звонков RUBI CHAT PRO после смены рубрики оценки (без интерфейса)
+
+Запуск из корня репозитория:
+    python rescore_archive.py                           # через Batch API, вдвое дешевле
+    python rescore_archive.py --mode concurrent         # параллельными запросами, быстрее
+    python rescore_archive.py --status                  # прогресс текущего прогона
+    python rescore_archive.py --retry-errors            # повторить звонки, завершившиеся ошибкой
+
+Прогон привязан к рубрике (PROMPT_VERSION, промпт, модели): повторный запуск после
+обрыва продолжает его с контрольной точки. Новые оценки заменяют старые в истории.
+"""
+
+import argparse
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Переоценка архива звонков")
+    parser.add_argument("--mode", choices=["batch", "concurrent"], default="batch", help="Batch API или параллельные запросы")
+    parser.add_argument("--workers", type=int, help="Потоков в режиме concurrent")
+    parser.add_argument("--batch-size", type=int, help="Звонков в одном пакете Batch API")
+    parser.add_argument("--max-batches", type=int, help="Пакетов Batch API в обработке одновременно")
+    parser.add_argument("--poll-seconds", type=float, help="Период опроса пакетов")
+    parser.add_argument("--retry-errors", action="store_true", help="Вернуть в очередь звонки с ошибкой")
+    parser.add_argument("--status", action="store_true", help="Показать прогресс и выйти")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    import rubi_chat_pro_complete as app
+    app.bare_mode()
+
+    run_id = app.rescore_run_id()
+    plan = app.rescore_progress(run_id) if args.status else app.plan_rescore(run_id, args.retry_errors)
+    print(f"Прогон {run_id} (рубрика v{app.PROMPT_VERSION}): {plan}", flush=True)
+    if args.status:
+        return
+
+    started = time.time()
+
+    def progress(counts):
+        print(f"  {time.time() - started:8.0f} с  {counts}", flush=True)
+
+    if args.mode == "batch":
+        app.rescore_with_batch_api(
+            run_id,
+            batch_size=args.batch_size or app.RESCORE_BATCH_SIZE,
+            poll_seconds=args.poll_seconds or app.RESCORE_POLL_SECONDS,
+            max_batches=args.max_batches or app.RESCORE_MAX_BATCHES,
+            progress=progress
+        )
+    else:
+        app.rescore_concurrent(run_id, workers=args.workers or app.BATCH_MAX_WORKERS, progress=progress)
+
+    counts = app.rescore_progress(run_id)
+    print(f"✅ Готово: {counts['done']} переоценено, {counts['error']} с ошибкой")
+
+
+if __name__ == "__main__":
+    main()
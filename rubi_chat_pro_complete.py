@@ -5,19 +5,64 @@ RUBI CHAT PRO v4.0 - ПОЛНОЕ ПРИЛОЖЕНИЕ
 Все 5 модулей + интеграция с Bitrix24
 """
 
+from __future__ import annotations
+
 import os
 import json
+import random
+import re
 import time
-from datetime import datetime, timedelta
+import hashlib
+import hmac
+import importlib
+import logging
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import uuid
+import wave
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import date, datetime, timedelta
 from io import BytesIO
-import requests
+from pathlib import Path
+from typing import TYPE_CHECKING
+from urllib.parse import parse_qsl, urlencode
 
-import numpy as np
-import pandas as pd
 import streamlit as st
-from openai import OpenAI
-import plotly.express as px
-import plotly.graph_objects as go
+
+if TYPE_CHECKING:
+    import httpx
+
+# Начало прогона скрипта: Streamlit исполняет модуль заново на каждый rerun
+_RERUN_STARTED = time.perf_counter()
+
+class _LazyModule:
+    """Модуль, который импортируется при первом обращении к атрибуту.
+    
+    Страница входа и AI ассистент не платят за импорт pandas/plotly/openai,
+    которые нужны только дашбордам и анализу звонков.
+    """
+    
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+np = _LazyModule("numpy")
+pd = _LazyModule("pandas")
+px = _LazyModule("plotly.express")
+requests = _LazyModule("requests")
 
 # =====================
 # КОНФИГУРАЦИЯ
@@ -32,12 +77,109 @@ try:
 except (KeyError, FileNotFoundError):
     BITRIX24_WEBHOOK = os.getenv("BITRIX24_WEBHOOK", "")
 
+# Приемник исходящих вебхуков Bitrix24 (порт 0 - выключен); без токена приложения не запускается.
+# Снаружи - через обратный прокси; события меняют версию дашбордов не чаще раза в DATA_VERSION_DEBOUNCE_SECONDS
+try:
+    BITRIX24_APP_TOKEN = st.secrets["BITRIX24_APP_TOKEN"]
+except (KeyError, FileNotFoundError):
+    BITRIX24_APP_TOKEN = os.getenv("BITRIX24_APP_TOKEN", "")
+WEBHOOK_HOST = os.getenv("RUBI_WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("RUBI_WEBHOOK_PORT", "0"))
+WEBHOOK_PATH = "/bitrix/events"
+DATA_VERSION_DEBOUNCE_SECONDS = float(os.getenv("DATA_VERSION_DEBOUNCE_SECONDS", "60"))
+
+# Параллельность пакетного анализа
+BATCH_MAX_WORKERS = int(os.getenv("BATCH_MAX_WORKERS", "4"))
+
+# Лимиты внешних API: скорость и запас токен-бакета, повторы с джиттером, предохранитель
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM_RESERVE = int(os.getenv("OPENAI_TPM_RESERVE", "2000"))
+BITRIX_RPS = float(os.getenv("BITRIX_RPS", "2"))
+BITRIX_BURST = int(os.getenv("BITRIX_BURST", "50"))
+BITRIX_OPERATING_LIMIT = 480
+RATE_LIMIT_RETRIES = int(os.getenv("RATE_LIMIT_RETRIES", "5"))
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+CIRCUIT_FAILURES = int(os.getenv("CIRCUIT_FAILURES", "8"))
+CIRCUIT_COOLDOWN_SECONDS = float(os.getenv("CIRCUIT_COOLDOWN_SECONDS", "30"))
+
+# Модели и версия промпта (версия входит в ключ кэша анализов)
+WHISPER_MODEL = "whisper-1"
+TRANSCRIBE_LANGUAGE = "ru"
+PROMPT_VERSION = "4"
+
+# Оценка звонков: сначала быстрая модель, пограничные итоги перепроверяет сильная
+SCORING_FAST_MODEL = os.getenv("SCORING_FAST_MODEL", "gpt-4o-mini")
+SCORING_STRONG_MODEL = os.getenv("SCORING_STRONG_MODEL", "gpt-4")
+SCORING_THRESHOLDS = (14, 18)
+SCORING_BORDER_MARGIN = 1
+
+# Нарезка длинных записей для Whisper (лимит API - 25 МБ на файл)
+WHISPER_MAX_BYTES = 24 * 1024 * 1024
+TRANSCRIBE_CHUNK_SECONDS = int(os.getenv("TRANSCRIBE_CHUNK_SECONDS", "300"))
+TRANSCRIBE_OVERLAP_SECONDS = 2
+TRANSCRIBE_WORKERS = int(os.getenv("TRANSCRIBE_WORKERS", "4"))
+
+# Подготовка транскрипта к оценке: отсев тишины и музыки, длинные звонки отправляются
+# выдержками по критериям
+NO_SPEECH_THRESHOLD = 0.6
+TURN_MAX_CHARS = 400
+CRITERION_MAX_TURNS = 6
+SEGMENT_SCORING_MIN_CHARS = int(os.getenv("SEGMENT_SCORING_MIN_CHARS", "2000"))
+
+# AI ассистент: модель, бюджет контекста в токенах и размер страницы истории
+ASSISTANT_MODEL = os.getenv("ASSISTANT_MODEL", "gpt-4")
+ASSISTANT_CONTEXT_TOKENS = int(os.getenv("ASSISTANT_CONTEXT_TOKENS", "3000"))
+ASSISTANT_SUMMARY_TOKENS = 400
+CHAT_PAGE_SIZE = 20
+
+# Локальный поисковый индекс по сделкам, анализам и транскриптам
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 256
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "5"))
+
+# Фоновые задачи: потоки исполнителя и период опроса статуса в интерфейсе
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = 2
+
+# Пульс сделок: период автообновления и размер страницы
+PULSE_REFRESH_SECONDS = int(os.getenv("PULSE_REFRESH_SECONDS", "30"))
+PULSE_PAGE_SIZE = 50
+PULSE_SNAPSHOTS = 8
+
+# Переоценка архива (rescore_archive.py): звонков в одном пакете Batch API, пакетов
+# в обработке одновременно (лимит OpenAI на токены в очереди) и период опроса
+RESCORE_BATCH_SIZE = int(os.getenv("RESCORE_BATCH_SIZE", "5000"))
+RESCORE_MAX_BATCHES = int(os.getenv("RESCORE_MAX_BATCHES", "2"))
+RESCORE_POLL_SECONDS = float(os.getenv("RESCORE_POLL_SECONDS", "60"))
+
+# Локальное хранилище и кэш
+DATA_DIR = os.getenv("RUBI_DATA_DIR", ".rubi_data")
+CACHE_TTL_DAYS = float(os.getenv("CACHE_TTL_DAYS", "30"))
+CACHE_MAX_MB = float(os.getenv("CACHE_MAX_MB", "200"))
+
+# Архив сжатых транскриптов и записей (записи - только в Opus, нужен ffmpeg)
+ARCHIVE_AUDIO = os.getenv("ARCHIVE_AUDIO", "1") == "1"
+ARCHIVE_OPUS_BITRATE = os.getenv("ARCHIVE_OPUS_BITRATE", "16k")
+
+# Цены OpenAI для учета стоимости, $ за 1M токенов (вход, выход); Whisper - $ за минуту
+OPENAI_PRICES = {
+    "gpt-4": (30.0, 60.0),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "text-embedding-3-small": (0.02, 0.0),
+}
+WHISPER_PRICE_PER_MINUTE = 0.006
+OPENAI_BATCH_DISCOUNT = 0.5
+METRICS_RECENT_SPANS = 5000
+
+# Бюджет полного прогона скрипта (импорты, конфигурация, отрисовка), мс
+RERUN_BUDGET_MS = float(os.getenv("RERUN_BUDGET_MS", "300"))
+
 if not OPENAI_API_KEY:
     st.error("❌ OPENAI_API_KEY не найден!")
     st.stop()
 
-client = OpenAI(api_key=OPENAI_API_KEY)
-
 st.set_page_config(
     page_title="RUBI CHAT PRO v4.0",
     page_icon="🔥",
@@ -55,176 +197,3324 @@ MANAGERS = [
     {"id": 4, "name": "Мария Иванова", "kpi": 45, "target": 100, "calls": 20, "deals": 5},
 ]
 
-DEALS = [
-    {"id": 1, "title": "ООО Строй-Сервис", "manager": "Иван Петров", "amount": 500000, "stage": "Переговоры", "probability": 85, "next_action": "Отправить КП"},
-    {"id": 2, "title": "ЗАО Промторг", "manager": "Ирина Сидорова", "amount": 250000, "stage": "Предложение", "probability": 60, "next_action": "Презентация"},
-    {"id": 3, "title": "ООО Логистика", "manager": "Артем Смирнов", "amount": 750000, "stage": "Переговоры", "probability": 45, "next_action": "Встреча"},
-    {"id": 4, "title": "ООО Альфа", "manager": "Мария Иванова", "amount": 100000, "stage": "Квалификация", "probability": 30, "next_action": "Уточнить потребность"},
-]
+DEALS = [
+    {"id": 1, "title": "ООО Строй-Сервис", "manager": "Иван Петров", "amount": 500000, "stage": "Переговоры", "probability": 85, "next_action": "Отправить КП"},
+    {"id": 2, "title": "ЗАО Промторг", "manager": "Ирина Сидорова", "amount": 250000, "stage": "Предложение", "probability": 60, "next_action": "Презентация"},
+    {"id": 3, "title": "ООО Логистика", "manager": "Артем Смирнов", "amount": 750000, "stage": "Переговоры", "probability": 45, "next_action": "Встреча"},
+    {"id": 4, "title": "ООО Альфа", "manager": "Мария Иванова", "amount": 100000, "stage": "Квалификация", "probability": 30, "next_action": "Уточнить потребность"},
+]
+
+# =====================
+# ЛОКАЛЬНОЕ ХРАНИЛИЩЕ
+# =====================
+
+_SCHEMAS_READY = set()
+
+@contextmanager
+def _db(filename: str, schema: str = ""):
+    """SQLite-соединение в каталоге данных: коммит при выходе, схема создается один раз"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(DATA_DIR, filename), timeout=30)
+    try:
+        if (filename, schema) not in _SCHEMAS_READY:
+            conn.execute("PRAGMA journal_mode=WAL")
+            if schema:
+                conn.executescript(schema)
+            _SCHEMAS_READY.add((filename, schema))
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def content_hash(*parts) -> str:
+    """SHA-256 от байтов/строк: ключ для контентно-адресуемого хранения"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+# =====================
+# КЭШ ТРАНСКРИБАЦИЙ И АНАЛИЗОВ
+# =====================
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache(accessed);
+"""
+
+def cache_get(key: str):
+    """Достать значение из кэша (None, если нет или истек TTL)"""
+    with _db("cache.sqlite", CACHE_SCHEMA) as conn:
+        row = conn.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] > CACHE_TTL_DAYS * 86400:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            return None
+        conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+def cache_put(key: str, value):
+    """Сохранить значение в кэш и вытеснить устаревшие/редко используемые записи"""
+    payload = json.dumps(value, ensure_ascii=False)
+    now = time.time()
+    with _db("cache.sqlite", CACHE_SCHEMA) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, payload, len(payload.encode("utf-8")), now, now)
+        )
+        conn.execute("DELETE FROM cache WHERE created < ?", (now - CACHE_TTL_DAYS * 86400,))
+        
+        # LRU-вытеснение по суммарному размеру
+        excess = (conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+                  - CACHE_MAX_MB * 1024 * 1024)
+        if excess > 0:
+            freed = 0
+            stale = []
+            for key_, size in conn.execute("SELECT key, size FROM cache ORDER BY accessed"):
+                stale.append((key_,))
+                freed += size
+                if freed >= excess:
+                    break
+            conn.executemany("DELETE FROM cache WHERE key = ?", stale)
+
+def transcript_cache_key(audio_hash: str) -> str:
+    """Ключ транскрибации: хэш аудио + модель + язык"""
+    return "transcript:" + content_hash(audio_hash, WHISPER_MODEL, TRANSCRIBE_LANGUAGE, "segments")
+
+def analysis_cache_key(transcription: str, segmented: bool = False) -> str:
+    """Ключ анализа: хэш транскрипта + версия промпта + модель (+ оценка по репликам)"""
+    parts = [transcription, PROMPT_VERSION, SCORING_FAST_MODEL, SCORING_STRONG_MODEL]
+    if segmented:
+        parts.append("turns")
+    return "analysis:" + content_hash(*parts)
+
+# =====================
+# МЕТРИКИ И ТРАССИРОВКА
+# =====================
+
+SPAN_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Спаны текущего прогона скрипта
+_RERUN_SPANS = deque(maxlen=500)
+
+class Metrics:
+    """Метрики процесса: тайминги внешних вызовов и отрисовки, токены, стоимость, повторы"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.counters = {}
+        self.recent = deque(maxlen=METRICS_RECENT_SPANS)
+    
+    def observe(self, record: dict):
+        key = (record["span"], tuple(sorted(record["labels"].items())))
+        with self.lock:
+            stat = self.spans.get(key)
+            if stat is None:
+                stat = self.spans[key] = {"count": 0, "errors": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(SPAN_BUCKETS)}
+            stat["count"] += 1
+            stat["errors"] += record["error"]
+            stat["sum"] += record["seconds"]
+            stat["max"] = max(stat["max"], record["seconds"])
+            for i, bound in enumerate(SPAN_BUCKETS):
+                if record["seconds"] <= bound:
+                    stat["buckets"][i] += 1
+            self.recent.append(dict(record, ts=time.time()))
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def total(self, name: str) -> float:
+        """Сумма счетчика по всем меткам"""
+        with self.lock:
+            return sum(value for (counter, _), value in self.counters.items() if counter == name)
+    
+    def prometheus(self) -> str:
+        """Дамп в текстовом формате Prometheus"""
+        lines = [
+            "# HELP rubi_span_seconds Время внешних вызовов и отрисовки модулей",
+            "# TYPE rubi_span_seconds histogram"
+        ]
+        with self.lock:
+            spans = sorted(self.spans.items())
+            counters = sorted(self.counters.items())
+        for (name, labels), stat in spans:
+            base = (("span", name),) + labels
+            for bound, count in zip(SPAN_BUCKETS, stat["buckets"]):
+                lines.append(f"rubi_span_seconds_bucket{_prom_labels(base + (('le', bound),))} {count}")
+            lines.append(f"rubi_span_seconds_bucket{_prom_labels(base + (('le', '+Inf'),))} {stat['count']}")
+            lines.append(f"rubi_span_seconds_sum{_prom_labels(base)} {stat['sum']:.6f}")
+            lines.append(f"rubi_span_seconds_count{_prom_labels(base)} {stat['count']}")
+        lines.append("# TYPE rubi_span_errors_total counter")
+        for (name, labels), stat in spans:
+            lines.append(f"rubi_span_errors_total{_prom_labels((('span', name),) + labels)} {stat['errors']}")
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE rubi_{name} counter")
+            lines.append(f"rubi_{name}{_prom_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+    
+    def jsonl(self) -> str:
+        """Последние спаны, по одному JSON на строку"""
+        with self.lock:
+            recent = list(self.recent)
+        return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in recent)
+
+def _prom_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+@st.cache_resource
+def get_metrics() -> Metrics:
+    """Метрики: один набор на процесс, общий для всех сессий и потоков"""
+    return Metrics()
+
+@contextmanager
+def span(name: str, **labels):
+    """Замер блока: время, ошибка и (через запись) токены и стоимость.
+    
+    Запись попадает в метрики процесса и в спаны текущего rerun. Исключение
+    помечает спан ошибкой и пробрасывается дальше.
+    """
+    record = {"span": name, "labels": labels, "error": False, "seconds": 0.0}
+    started = time.perf_counter()
+    try:
+        yield record
+    except Exception:
+        record["error"] = True
+        raise
+    finally:
+        record["seconds"] = time.perf_counter() - started
+        get_metrics().observe(record)
+        _RERUN_SPANS.append(record)
+
+def traced(func):
+    """Декоратор: спан render на каждый вызов функции отрисовки"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with span("render", fn=func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+def record_usage(record: dict, prompt_tokens: int, completion_tokens: int = 0, estimated: bool = False, batch: bool = False):
+    """Учесть токены и стоимость вызова модели record["labels"]["model"] (batch - по цене Batch API)"""
+    model = record["labels"].get("model", "")
+    price_in, price_out = OPENAI_PRICES.get(model, (0.0, 0.0))
+    cost = (prompt_tokens * price_in + completion_tokens * price_out) / 1e6
+    if batch:
+        cost *= OPENAI_BATCH_DISCOUNT
+    record.update(tokens=prompt_tokens + completion_tokens, cost=cost, estimated=estimated)
+    metrics = get_metrics()
+    metrics.inc("openai_tokens_total", prompt_tokens, model=model, type="prompt")
+    metrics.inc("openai_tokens_total", completion_tokens, model=model, type="completion")
+    metrics.inc("openai_cost_usd_total", cost, model=model)
+
+def record_audio(record: dict, seconds: float):
+    """Учесть минуты Whisper"""
+    cost = seconds / 60 * WHISPER_PRICE_PER_MINUTE
+    record.update(audio_seconds=seconds, cost=cost)
+    metrics = get_metrics()
+    metrics.inc("openai_audio_seconds_total", seconds, model=record["labels"].get("model", ""))
+    metrics.inc("openai_cost_usd_total", cost, model=record["labels"].get("model", ""))
+
+def record_retry(backend: str, count: int = 1):
+    if count:
+        get_metrics().inc("retries_total", count, backend=backend)
+
+# =====================
+# ЛИМИТЫ И ПОВТОРЫ ВНЕШНИХ API
+# =====================
+
+class CircuitOpenError(Exception):
+    """Предохранитель бэкенда разомкнут: вызовы отклоняются без обращения к API"""
+
+class RateLimiter:
+    """Токен-бакет бэкенда, общий для всех потоков и сессий.
+    
+    Скорость адаптивная: лимитный ответ сервера делит ее пополам, каждый успешный
+    вызов возвращает 5% от максимума. Заголовки лимитов могут приостановить выдачу
+    до сброса окна.
+    """
+    
+    def __init__(self, rate: float, burst: int):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Дождаться разрешения на один запрос"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+    
+    def throttle(self):
+        """Сервер ответил лимитом: вдвое медленнее"""
+        with self.lock:
+            self.rate = max(self.rate / 2, self.max_rate / 20)
+            self.tokens = 0.0
+    
+    def block(self, seconds: float):
+        """Не выдавать разрешений seconds секунд (Retry-After, сброс окна по заголовкам)"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+    
+    def set_limit(self, rate: float):
+        """Реальный лимит из заголовков ответа"""
+        with self.lock:
+            if rate > 0 and rate != self.max_rate:
+                self.max_rate = rate
+                self.rate = min(self.rate, rate)
+    
+    def succeed(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+class CircuitBreaker:
+    """Предохранитель: после CIRCUIT_FAILURES сбоев подряд бэкенд отдыхает CIRCUIT_COOLDOWN_SECONDS.
+    
+    После паузы пропускается один пробный вызов, остальные получают отказ, пока он
+    не завершится: успех замыкает цепь, сбой снова размыкает ее. Зависший пробный
+    вызов через CIRCUIT_COOLDOWN_SECONDS уступает место следующему.
+    """
+    
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+        self.lock = threading.Lock()
+    
+    def check(self, backend: str):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            now = time.monotonic()
+            if now - self.opened_at < self.cooldown:
+                raise CircuitOpenError(f"{backend}: сервис недоступен, повтор через {self.cooldown - (now - self.opened_at):.0f} с")
+            if self.probe_at is not None and now - self.probe_at < self.cooldown:
+                raise CircuitOpenError(f"{backend}: сервис недоступен, идет пробный вызов")
+            self.probe_at = now
+    
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probe_at = None
+    
+    def release(self):
+        """Вызов завершился не сбоем сервиса (лимит, ошибка запроса): пробный слот свободен"""
+        with self.lock:
+            self.probe_at = None
+    
+    def failure(self) -> bool:
+        """Учесть сбой; True, если цепь только что разомкнулась"""
+        with self.lock:
+            self.probe_at = None
+            self.failures += 1
+            if self.failures >= self.threshold:
+                opened = self.opened_at is None or time.monotonic() - self.opened_at >= self.cooldown
+                self.opened_at = time.monotonic()
+                return opened
+            return False
+
+BACKEND_LIMITS = {
+    "openai": lambda: (OPENAI_RPM / 60, max(int(OPENAI_RPM / 60), 1)),
+    "bitrix": lambda: (BITRIX_RPS, BITRIX_BURST),
+}
+
+@st.cache_resource
+def get_rate_limiter(backend: str) -> RateLimiter:
+    """Лимитер бэкенда: один на процесс"""
+    return RateLimiter(*BACKEND_LIMITS[backend]())
+
+@st.cache_resource
+def get_circuit_breaker(backend: str) -> CircuitBreaker:
+    """Предохранитель бэкенда: один на процесс"""
+    return CircuitBreaker(CIRCUIT_FAILURES, CIRCUIT_COOLDOWN_SECONDS)
+
+def _parse_duration(value: str) -> float:
+    """Длительность из заголовков OpenAI: "20ms", "1s", "6m0s", "1h2m3.5s" """
+    total = 0.0
+    for number, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value or ""):
+        total += float(number) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total
+
+def _retry_after(headers) -> float:
+    try:
+        return float(headers.get("retry-after")) if headers is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def _classify_error(error: Exception) -> tuple:
+    """(временная ли ошибка, лимит ли это, Retry-After в секундах)"""
+    # Ошибка OpenAI возможна, только если пакет уже загружен - не импортируем его ради проверки
+    openai = sys.modules.get("openai")
+    if openai is not None and isinstance(error, openai.APIStatusError):
+        status = error.status_code
+        return status == 429 or status >= 500, status == 429, _retry_after(error.response.headers)
+    if openai is not None and isinstance(error, openai.APIConnectionError):
+        return True, False, None
+    if isinstance(error, BitrixError):
+        limited = error.code in ("QUERY_LIMIT_EXCEEDED", "OPERATION_TIME_LIMIT")
+        return limited or error.status >= 500, limited, None
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status in (429, 503) or status >= 500, status in (429, 503), _retry_after(error.response.headers)
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True, False, None
+    return False, False, None
+
+def call_with_retry(backend: str, func, *args, idempotent: bool = True, **kwargs):
+    """Вызов внешнего API через общий лимитер, предохранитель и повторы.
+    
+    Временные ошибки (лимиты, 5xx, таймауты, обрывы) повторяются до RATE_LIMIT_RETRIES
+    раз с экспоненциальной паузой и полным джиттером (или по Retry-After). Остальные
+    ошибки пробрасываются сразу. Запись (idempotent=False) повторяется только после
+    отказа по лимиту: после таймаута или 5xx сервер мог ее уже выполнить.
+    """
+    limiter = get_rate_limiter(backend)
+    breaker = get_circuit_breaker(backend)
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        breaker.check(backend)
+        limiter.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            transient, limited, retry_after = _classify_error(e)
+            if transient and not limited:
+                if breaker.failure():
+                    get_metrics().inc("circuit_open_total", backend=backend)
+            else:
+                # Лимит - штатная ситуация, предохранитель размыкают только сбои
+                breaker.release()
+            if not transient or not (idempotent or limited):
+                raise
+            if limited:
+                limiter.throttle()
+                get_metrics().inc("throttled_total", backend=backend)
+            if attempt == RATE_LIMIT_RETRIES:
+                raise
+            record_retry(backend)
+            if retry_after:
+                limiter.block(retry_after)
+            else:
+                time.sleep(random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+            continue
+        breaker.success()
+        limiter.succeed()
+        return result
+
+def _observe_openai_headers(response: httpx.Response):
+    """Заголовки x-ratelimit-* каждого ответа OpenAI подстраивают общий лимитер"""
+    headers = response.headers
+    if "x-ratelimit-limit-requests" not in headers:
+        return
+    limiter = get_rate_limiter("openai")
+    try:
+        limiter.set_limit(float(headers["x-ratelimit-limit-requests"]) / 60)
+        if int(headers.get("x-ratelimit-remaining-requests", 1)) <= 0:
+            limiter.block(_parse_duration(headers.get("x-ratelimit-reset-requests")))
+        if int(headers.get("x-ratelimit-remaining-tokens", OPENAI_TPM_RESERVE)) < OPENAI_TPM_RESERVE:
+            limiter.block(_parse_duration(headers.get("x-ratelimit-reset-tokens")))
+    except ValueError:
+        pass
+
+@st.cache_resource
+def get_openai_client():
+    """Клиент OpenAI: один на процесс, создается при первом вызове API.
+    
+    Повторы делает call_with_retry, поэтому встроенные повторы клиента отключены.
+    """
+    import httpx
+    from openai import OpenAI
+    
+    return OpenAI(
+        api_key=OPENAI_API_KEY,
+        max_retries=0,
+        http_client=httpx.Client(
+            timeout=httpx.Timeout(600, connect=5),
+            event_hooks={"response": [_observe_openai_headers]}
+        )
+    )
+
+# =====================
+# ИСТОРИЯ АНАЛИЗОВ
+# =====================
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    day TEXT NOT NULL,
+    manager TEXT NOT NULL,
+    deal_id TEXT,
+    client TEXT,
+    total_score INTEGER,
+    politeness INTEGER,
+    understanding INTEGER,
+    solution INTEGER,
+    closing INTEGER,
+    sentiment TEXT,
+    key_phrases TEXT,
+    transcript_ref TEXT,
+    analysis TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_analyses_manager ON analyses(manager, created_at);
+CREATE INDEX IF NOT EXISTS idx_analyses_created ON analyses(created_at);
+CREATE INDEX IF NOT EXISTS idx_analyses_ref ON analyses(transcript_ref, deal_id);
+CREATE TABLE IF NOT EXISTS manager_stats (
+    manager TEXT PRIMARY KEY,
+    calls INTEGER NOT NULL,
+    score_sum INTEGER NOT NULL,
+    politeness_sum INTEGER NOT NULL,
+    understanding_sum INTEGER NOT NULL,
+    solution_sum INTEGER NOT NULL,
+    closing_sum INTEGER NOT NULL,
+    positive INTEGER NOT NULL,
+    negative INTEGER NOT NULL,
+    last_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS daily_stats (
+    day TEXT NOT NULL,
+    manager TEXT NOT NULL,
+    calls INTEGER NOT NULL,
+    score_sum INTEGER NOT NULL,
+    PRIMARY KEY (day, manager)
+);
+"""
+
+def record_analysis(analysis: dict, transcription: str, manager: str, deal_id: str = "", client: str = "") -> int:
+    """Сохранить анализ в историю и обновить агрегаты в той же транзакции.
+    
+    Повторный анализ того же звонка (тот же транскрипт и сделка) - например, после
+    перезапуска задачи или повторной выгрузки из Bitrix24 - не создает вторую строку:
+    возвращается id уже сохраненной.
+    """
+    now = time.time()
+    ref = content_hash(transcription)
+    day = datetime.fromtimestamp(now).strftime("%Y-%m-%d")
+    scores = analysis.get("scores", {})
+    total = int(analysis.get("total_score", 0))
+    sentiment = str(analysis.get("sentiment", ""))
+    positive = int(sentiment.lower().startswith("позит"))
+    negative = int(sentiment.lower().startswith("негат"))
+    
+    with _db("history.sqlite", HISTORY_SCHEMA) as conn:
+        existing = conn.execute(
+            "SELECT id FROM analyses WHERE transcript_ref = ? AND deal_id = ?", (ref, str(deal_id or ""))
+        ).fetchone()
+        if existing:
+            return existing[0]
+        cursor = conn.execute(
+            """INSERT INTO analyses (created_at, day, manager, deal_id, client, total_score,
+                   politeness, understanding, solution, closing, sentiment, key_phrases,
+                   transcript_ref, analysis)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (now, day, manager, str(deal_id or ""), client, total,
+             scores.get("politeness", 0), scores.get("understanding", 0),
+             scores.get("solution", 0), scores.get("closing", 0), sentiment,
+             json.dumps(analysis.get("key_phrases", []), ensure_ascii=False),
+             ref, json.dumps(analysis, ensure_ascii=False))
+        )
+        conn.execute(
+            """INSERT INTO manager_stats VALUES (?, 1, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(manager) DO UPDATE SET
+                   calls = calls + 1,
+                   score_sum = score_sum + excluded.score_sum,
+                   politeness_sum = politeness_sum + excluded.politeness_sum,
+                   understanding_sum = understanding_sum + excluded.understanding_sum,
+                   solution_sum = solution_sum + excluded.solution_sum,
+                   closing_sum = closing_sum + excluded.closing_sum,
+                   positive = positive + excluded.positive,
+                   negative = negative + excluded.negative,
+                   last_at = excluded.last_at""",
+            (manager, total, scores.get("politeness", 0), scores.get("understanding", 0),
+             scores.get("solution", 0), scores.get("closing", 0), positive, negative, now)
+        )
+        conn.execute(
+            """INSERT INTO daily_stats VALUES (?, ?, 1, ?)
+               ON CONFLICT(day, manager) DO UPDATE SET
+                   calls = calls + 1,
+                   score_sum = score_sum + excluded.score_sum""",
+            (day, manager, total)
+        )
+    return cursor.lastrowid
+
+def load_history(manager: str = "", limit: int = 20, offset: int = 0) -> list:
+    """Страница истории анализов (новые сверху), по индексу manager/created_at"""
+    query = """SELECT id, created_at, manager, deal_id, client, total_score, sentiment, analysis, transcript_ref
+               FROM analyses"""
+    params = []
+    if manager:
+        query += " WHERE manager = ?"
+        params.append(manager)
+    query += " ORDER BY created_at DESC LIMIT ? OFFSET ?"
+    params += [limit, offset]
+    
+    with _db("history.sqlite", HISTORY_SCHEMA) as conn:
+        rows = conn.execute(query, params).fetchall()
+    return [
+        {
+            "id": row[0],
+            "created_at": datetime.fromtimestamp(row[1]),
+            "manager": row[2],
+            "deal_id": row[3],
+            "client": row[4],
+            "total_score": row[5],
+            "sentiment": row[6],
+            "analysis": json.loads(row[7]),
+            "transcript_ref": row[8]
+        }
+        for row in rows
+    ]
+
+def load_manager_stats() -> list:
+    """Накопленные средние по менеджерам (без пересчета истории)"""
+    with _db("history.sqlite", HISTORY_SCHEMA) as conn:
+        rows = conn.execute(
+            """SELECT manager, calls, score_sum, politeness_sum, understanding_sum,
+                      solution_sum, closing_sum, positive, negative
+               FROM manager_stats ORDER BY manager"""
+        ).fetchall()
+    return [
+        {
+            "manager": manager,
+            "calls": calls,
+            "avg_score": score_sum / calls,
+            "avg_politeness": politeness / calls,
+            "avg_understanding": understanding / calls,
+            "avg_solution": solution / calls,
+            "avg_closing": closing / calls,
+            "positive_share": positive / calls,
+            "negative_share": negative / calls
+        }
+        for manager, calls, score_sum, politeness, understanding, solution, closing, positive, negative in rows
+    ]
+
+def load_daily_stats(days: int = 30) -> list:
+    """Дневные итоги за последние days дней"""
+    since = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+    with _db("history.sqlite", HISTORY_SCHEMA) as conn:
+        rows = conn.execute(
+            "SELECT day, manager, calls, score_sum FROM daily_stats WHERE day >= ? ORDER BY day",
+            (since,)
+        ).fetchall()
+    return [
+        {"day": day, "manager": manager, "calls": calls, "avg_score": score_sum / calls}
+        for day, manager, calls, score_sum in rows
+    ]
+
+def update_analyses(conn: sqlite3.Connection, ref: str, analysis: dict) -> int:
+    """Заменить оценку у всех анализов транскрипта ref (агрегаты - через rebuild_history_stats)"""
+    scores = analysis.get("scores", {})
+    return conn.execute(
+        """UPDATE analyses SET total_score = ?, politeness = ?, understanding = ?, solution = ?,
+               closing = ?, sentiment = ?, key_phrases = ?, analysis = ?
+           WHERE transcript_ref = ?""",
+        (int(analysis.get("total_score", 0)), scores.get("politeness", 0), scores.get("understanding", 0),
+         scores.get("solution", 0), scores.get("closing", 0), str(analysis.get("sentiment", "")),
+         json.dumps(analysis.get("key_phrases", []), ensure_ascii=False),
+         json.dumps(analysis, ensure_ascii=False), ref)
+    ).rowcount
+
+def rebuild_history_stats():
+    """Пересчитать manager_stats и daily_stats по таблице analyses"""
+    with _db("history.sqlite", HISTORY_SCHEMA) as conn:
+        conn.execute("DELETE FROM manager_stats")
+        conn.execute(
+            """INSERT INTO manager_stats
+               SELECT manager, COUNT(*), SUM(total_score), SUM(politeness), SUM(understanding),
+                      SUM(solution), SUM(closing),
+                      SUM(sentiment LIKE 'Позит%' OR sentiment LIKE 'позит%'),
+                      SUM(sentiment LIKE 'Негат%' OR sentiment LIKE 'негат%'),
+                      MAX(created_at)
+               FROM analyses GROUP BY manager"""
+        )
+        conn.execute("DELETE FROM daily_stats")
+        conn.execute(
+            """INSERT INTO daily_stats
+               SELECT day, manager, COUNT(*), SUM(total_score) FROM analyses GROUP BY day, manager"""
+        )
+
+# =====================
+# ФУНКЦИИ BITRIX24
+# =====================
+
+CALL_FILTER = {
+    "SUBJECT": "Звонок",
+    "TYPE_ID": "1"
+}
+
+def get_calls_from_bitrix(limit: int = 50) -> list:
+    """Получить звонки Bitrix24 из локального хранилища (наполняется sync_bitrix)"""
+    with _db("bitrix.sqlite", SYNC_SCHEMA) as conn:
+        rows = conn.execute(
+            "SELECT raw FROM activities ORDER BY start_time DESC, id DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+    return [json.loads(raw) for (raw,) in rows]
+
+class BitrixError(Exception):
+    """Ошибка, которую вернул REST API Bitrix24"""
+    
+    def __init__(self, message: str, code: str = "", status: int = 200):
+        super().__init__(message)
+        self.code = code
+        self.status = status
+
+@st.cache_resource
+def get_bitrix_session() -> requests.Session:
+    """Общая HTTP-сессия Bitrix24: keep-alive и пул соединений (повторы - в call_with_retry)"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(BATCH_MAX_WORKERS, 10))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def _bitrix_post(method: str, params: dict) -> dict:
+    with span("bitrix", method=method):
+        response = get_bitrix_session().post(
+            f"{BITRIX24_WEBHOOK}{method}.json",
+            json=params,
+            timeout=30
+        )
+        # HTML-страница 502/504 от прокси - временная ошибка HTTP, а не ответ Bitrix24
+        if not response.ok and "json" not in response.headers.get("Content-Type", ""):
+            response.raise_for_status()
+        data = response.json() if response.content else {}
+        if "error" in data:
+            raise BitrixError(
+                f"{method}: {data['error']} {data.get('error_description', '')}".strip(),
+                code=str(data["error"]),
+                status=response.status_code
+            )
+        response.raise_for_status()
+    
+    # Почти исчерпанный лимит времени выполнения метода - пауза до сброса окна
+    timing = data.get("time") or {}
+    if timing.get("operating", 0) > BITRIX_OPERATING_LIMIT * 0.9 and timing.get("operating_reset_at"):
+        get_rate_limiter("bitrix").block(max(timing["operating_reset_at"] - time.time(), 0))
+    return data
+
+def is_bitrix_write(method: str) -> bool:
+    return method.rsplit(".", 1)[-1] in ("add", "update", "delete", "set")
+
+def _bitrix_request(method: str, params: dict = None, idempotent: bool = None) -> dict:
+    """Вызов метода REST API Bitrix24 через общий лимитер, возвращает полный ответ.
+    
+    Методы записи (*.add, *.update, ...) по умолчанию не повторяются после таймаута и 5xx.
+    """
+    if idempotent is None:
+        idempotent = not is_bitrix_write(method)
+    return call_with_retry("bitrix", _bitrix_post, method, params or {}, idempotent=idempotent)
+
+def bitrix_call(method: str, params: dict = None, idempotent: bool = None):
+    """Вызов метода REST API Bitrix24, возвращает поле result"""
+    return _bitrix_request(method, params, idempotent).get("result")
+
+def _http_build_query(params: dict) -> str:
+    """Параметры в PHP-формате (fields[OWNER_ID]=...), как их ждет batch.json"""
+    pairs = []
+    
+    def walk(value, key):
+        if isinstance(value, dict):
+            for k, v in value.items():
+                walk(v, f"{key}[{k}]" if key else str(k))
+        elif isinstance(value, (list, tuple)):
+            for i, v in enumerate(value):
+                walk(v, f"{key}[{i}]")
+        else:
+            pairs.append((key, "" if value is None else value))
+    
+    walk(params, "")
+    return urlencode(pairs)
+
+BITRIX_BATCH_SIZE = 50
+
+def bitrix_batch(commands: dict) -> dict:
+    """Выполнить {ключ: (метод, параметры)} через batch.json - до 50 команд за один запрос.
+    
+    Возвращает {ключ: result} только для успешно выполненных команд.
+    """
+    results = {}
+    items = list(commands.items())
+    for i in range(0, len(items), BITRIX_BATCH_SIZE):
+        chunk = items[i:i + BITRIX_BATCH_SIZE]
+        data = bitrix_call("batch", {
+            "halt": 0,
+            "cmd": {key: f"{method}?{_http_build_query(params)}" for key, (method, params) in chunk}
+        }, idempotent=not any(is_bitrix_write(method) for _, (method, _) in chunk))
+        results.update(data.get("result") or {})
+    return results
+
+def get_deal_info(deal_id: str) -> dict:
+    """Получить информацию о сделке"""
+    if not BITRIX24_WEBHOOK:
+        return {}
+    
+    try:
+        return bitrix_call("crm.deal.get", {"id": deal_id}) or {}
+    except (requests.RequestException, BitrixError, CircuitOpenError, ValueError):
+        return {}
+
+def download_call_record(call: dict) -> bytes:
+    """Скачать запись звонка из активности Bitrix24"""
+    files = call.get("FILES") or []
+    if not files:
+        raise ValueError(f"У звонка {call.get('ID')} нет записи")
+    
+    def fetch():
+        with span("bitrix", method="download"):
+            response = get_bitrix_session().get(files[0]["url"], timeout=60)
+            response.raise_for_status()
+            return response.content
+    
+    return call_with_retry("bitrix", fetch)
+
+def _analysis_activity_fields(deal_id: str, analysis: dict) -> dict:
+    """Поля дела Bitrix24 с результатами анализа"""
+    note_text = f"""📊 АНАЛИЗ КАЧЕСТВА ЗВОНКА - RUBI CHAT PRO v4.0
+
+⭐ Оценка: {analysis.get('total_score', 0)}/20
+
+Критерии:
+🎤 Вежливость: {analysis.get('scores', {}).get('politeness', 0)}/5
+👂 Выявление потребностей: {analysis.get('scores', {}).get('understanding', 0)}/5
+💼 Представление решения: {analysis.get('scores', {}).get('solution', 0)}/5
+✍️ Закрытие сделки: {analysis.get('scores', {}).get('closing', 0)}/5
+
+😊 Тональность: {analysis.get('sentiment', 'N/A')}
+
+💡 Рекомендации:
+{chr(10).join(f"• {rec}" for rec in analysis.get('recommendations', []))}"""
+    
+    return {
+        "OWNER_ID": deal_id,
+        "OWNER_TYPE_ID": "2",
+        "TYPE_ID": "4",
+        "DESCRIPTION": note_text,
+        "SUBJECT": "🤖 АНАЛИЗ ЗВОНКА"
+    }
+
+def save_analysis_to_bitrix(deal_id: str, analysis: dict):
+    """Сохранить анализ в Bitrix24"""
+    if not BITRIX24_WEBHOOK:
+        return False
+    
+    try:
+        bitrix_call("crm.activity.add", {"fields": _analysis_activity_fields(deal_id, analysis)})
+        return True
+    except (requests.RequestException, BitrixError, CircuitOpenError, ValueError):
+        return False
+
+def save_analyses_to_bitrix(analyses: list) -> int:
+    """Сохранить много анализов [(deal_id, analysis), ...] через batch.json, вернуть число сохраненных"""
+    if not BITRIX24_WEBHOOK:
+        return 0
+    
+    try:
+        results = bitrix_batch({
+            f"a{i}": ("crm.activity.add", {"fields": _analysis_activity_fields(deal_id, analysis)})
+            for i, (deal_id, analysis) in enumerate(analyses)
+        })
+    except (requests.RequestException, BitrixError, CircuitOpenError, ValueError):
+        return 0
+    return len(results)
+
+# =====================
+# СИНХРОНИЗАЦИЯ BITRIX24
+# =====================
+
+SYNC_SCHEMA = """
+CREATE TABLE IF NOT EXISTS activities (
+    id INTEGER PRIMARY KEY,
+    owner_id INTEGER,
+    owner_type_id INTEGER,
+    subject TEXT,
+    responsible_id INTEGER,
+    start_time TEXT,
+    date_modify TEXT,
+    raw TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_activities_start ON activities(start_time);
+CREATE INDEX IF NOT EXISTS idx_activities_owner ON activities(owner_id);
+CREATE TABLE IF NOT EXISTS deals (
+    id INTEGER PRIMARY KEY,
+    title TEXT,
+    assigned_by_id INTEGER,
+    opportunity REAL,
+    stage_id TEXT,
+    probability INTEGER,
+    date_modify TEXT,
+    raw TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_deals_assigned ON deals(assigned_by_id);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    entity TEXT PRIMARY KEY,
+    date_modify TEXT,
+    last_id INTEGER,
+    synced_at REAL
+);
+CREATE TABLE IF NOT EXISTS kpi_rollups (
+    grain TEXT NOT NULL,
+    period TEXT NOT NULL,
+    manager_id INTEGER NOT NULL,
+    calls INTEGER NOT NULL,
+    won INTEGER NOT NULL,
+    closed INTEGER NOT NULL,
+    won_amount REAL NOT NULL,
+    PRIMARY KEY (grain, period, manager_id)
+);
+CREATE TABLE IF NOT EXISTS kpi_counted (
+    kind TEXT NOT NULL,
+    entity_id INTEGER NOT NULL,
+    manager_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    amount REAL NOT NULL,
+    PRIMARY KEY (kind, entity_id)
+);
+"""
+
+BITRIX_STAGES = {
+    "NEW": "Квалификация",
+    "PREPARATION": "Предложение",
+    "PREPAYMENT_INVOICE": "Переговоры",
+    "EXECUTING": "Переговоры",
+    "FINAL_INVOICE": "Переговоры",
+    "WON": "Закрыто выиграно",
+    "LOSE": "Закрыто проиграно",
+}
+
+def bitrix_list(method: str, params: dict):
+    """Постраничный обход list-метода Bitrix24 по протоколу start/next"""
+    start = 0
+    while True:
+        data = _bitrix_request(method, {**params, "start": start})
+        yield data.get("result", [])
+        if "next" not in data:
+            break
+        start = data["next"]
+
+BITRIX_PAGE_SIZE = 50
+
+def bitrix_list_by_id(method: str, params: dict, after_id: int = 0):
+    """Обход list-метода Bitrix24 по возрастанию ID: фильтр >ID вместо смещения и start=-1.
+    
+    Без смещения записи не пропускаются и не дублируются, когда выборка меняется
+    между страницами, а Bitrix24 не считает total на каждом запросе.
+    """
+    while True:
+        data = _bitrix_request(method, {
+            **params,
+            "order": {"ID": "ASC"},
+            "filter": {**params.get("filter", {}), ">ID": after_id},
+            "start": -1,
+        })
+        page = data.get("result", [])
+        yield page
+        if len(page) < BITRIX_PAGE_SIZE:
+            break
+        after_id = int(page[-1]["ID"])
+
+KPI_GRAINS = {"day": "День", "week": "Неделя", "month": "Месяц"}
+DEAL_OUTCOMES = {"WON": "won", "LOSE": "lost"}
+
+def kpi_periods(day: str) -> list:
+    """Периоды всех гранулярностей, в которые попадает день: [(grain, period), ...]"""
+    d = date.fromisoformat(day)
+    year, week, _ = d.isocalendar()
+    return [("day", d.isoformat()), ("week", f"{year}-W{week:02d}"), ("month", d.strftime("%Y-%m"))]
+
+def _add_rollup(conn: sqlite3.Connection, manager_id: int, day: str, calls: int = 0, won: int = 0, closed: int = 0, won_amount: float = 0.0):
+    conn.executemany(
+        """INSERT INTO kpi_rollups VALUES (?, ?, ?, ?, ?, ?, ?)
+           ON CONFLICT(grain, period, manager_id) DO UPDATE SET
+               calls = calls + excluded.calls,
+               won = won + excluded.won,
+               closed = closed + excluded.closed,
+               won_amount = won_amount + excluded.won_amount""",
+        [(grain, period, manager_id, calls, won, closed, won_amount) for grain, period in kpi_periods(day)]
+    )
+
+def _rollup_calls(conn: sqlite3.Connection, rows: list):
+    """Каждый звонок учитывается в сводах один раз - по дню начала и ответственному"""
+    for r in rows:
+        if not r.get("START_TIME") or not r.get("RESPONSIBLE_ID"):
+            continue
+        manager_id, day = int(r["RESPONSIBLE_ID"]), r["START_TIME"][:10]
+        claimed = conn.execute(
+            "INSERT OR IGNORE INTO kpi_counted VALUES ('call', ?, ?, ?, '', 0)", (int(r["ID"]), manager_id, day)
+        ).rowcount
+        if claimed:
+            _add_rollup(conn, manager_id, day, calls=1)
+
+def _rollup_deals(conn: sqlite3.Connection, rows: list):
+    """Закрытые сделки в сводах: при смене исхода, менеджера или суммы старый вклад вычитается"""
+    for r in rows:
+        outcome = DEAL_OUTCOMES.get(str(r.get("STAGE_ID") or "").split(":")[-1], "")
+        manager_id = int(r.get("ASSIGNED_BY_ID") or 0)
+        amount = float(r.get("OPPORTUNITY") or 0)
+        previous = conn.execute(
+            "SELECT manager_id, day, outcome, amount FROM kpi_counted WHERE kind = 'deal' AND entity_id = ?",
+            (int(r["ID"]),)
+        ).fetchone()
+        if previous and (previous[0], previous[2], previous[3]) == (manager_id, outcome, amount):
+            continue
+        if previous and previous[2]:
+            won = previous[2] == "won"
+            _add_rollup(conn, previous[0], previous[1], won=-won, closed=-1, won_amount=-previous[3] * won)
+        
+        # День закрытия сделки; у сделок, синхронизированных без CLOSEDATE, - день изменения
+        day = (r.get("CLOSEDATE") or r.get("DATE_MODIFY") or datetime.now().isoformat())[:10]
+        if outcome:
+            won = outcome == "won"
+            _add_rollup(conn, manager_id, day, won=won, closed=1, won_amount=amount * won)
+        conn.execute(
+            "INSERT OR REPLACE INTO kpi_counted VALUES ('deal', ?, ?, ?, ?, ?)",
+            (int(r["ID"]), manager_id, day, outcome, amount)
+        )
+
+def rebuild_kpi_rollups():
+    """Пересчитать своды по локальному хранилищу (если данные синхронизированы до их появления)"""
+    with _db("bitrix.sqlite", SYNC_SCHEMA) as conn:
+        conn.execute("DELETE FROM kpi_rollups")
+        conn.execute("DELETE FROM kpi_counted")
+        _rollup_calls(conn, [
+            {"ID": i, "RESPONSIBLE_ID": responsible, "START_TIME": start}
+            for i, responsible, start in conn.execute("SELECT id, responsible_id, start_time FROM activities")
+        ])
+        _rollup_deals(conn, [
+            {"ID": i, "ASSIGNED_BY_ID": assigned, "OPPORTUNITY": amount, "STAGE_ID": stage,
+             "CLOSEDATE": closed, "DATE_MODIFY": modified}
+            for i, assigned, amount, stage, closed, modified in conn.execute(
+                "SELECT id, assigned_by_id, opportunity, stage_id, json_extract(raw, '$.CLOSEDATE'), date_modify FROM deals"
+            )
+        ])
+
+def _upsert_activities(conn: sqlite3.Connection, rows: list):
+    _rollup_calls(conn, rows)
+    conn.executemany(
+        "INSERT OR REPLACE INTO activities VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            (int(r["ID"]), r.get("OWNER_ID"), r.get("OWNER_TYPE_ID"), r.get("SUBJECT"),
+             r.get("RESPONSIBLE_ID"), r.get("START_TIME"), r.get("DATE_MODIFY"),
+             json.dumps(r, ensure_ascii=False))
+            for r in rows
+        ]
+    )
+
+def _upsert_deals(conn: sqlite3.Connection, rows: list):
+    _rollup_deals(conn, rows)
+    conn.executemany(
+        "INSERT OR REPLACE INTO deals VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            (int(r["ID"]), r.get("TITLE"), r.get("ASSIGNED_BY_ID"), float(r.get("OPPORTUNITY") or 0),
+             r.get("STAGE_ID"), r.get("PROBABILITY"), r.get("DATE_MODIFY"),
+             json.dumps(r, ensure_ascii=False))
+            for r in rows
+        ]
+    )
+
+def _sync_entity(entity: str, method: str, select: list, filters: dict, upsert) -> int:
+    """Дельта-синхронизация сущности: записи, измененные после high-water mark, обходом по ID.
+    
+    Новая отметка - последнее DATE_MODIFY в Bitrix24 на начало прохода: все, что
+    изменится во время прохода, попадет в следующую синхронизацию. Прерванный
+    проход продолжается с last_id и отметку не сдвигает.
+    """
+    with _db("bitrix.sqlite", SYNC_SCHEMA) as conn:
+        state = conn.execute(
+            "SELECT date_modify, last_id FROM sync_state WHERE entity = ?", (entity,)
+        ).fetchone()
+    since, after_id = (state[0], state[1] or 0) if state else (None, 0)
+    
+    if after_id:
+        mark = since
+    else:
+        latest = _bitrix_request(method, {
+            "select": ["ID", "DATE_MODIFY"],
+            "filter": dict(filters),
+            "order": {"DATE_MODIFY": "DESC"},
+            "start": -1,
+        }).get("result", [])
+        mark = latest[0].get("DATE_MODIFY") if latest else since
+    
+    params = {"select": select, "filter": dict(filters)}
+    if since:
+        # ">=" с идемпотентным upsert: записи с той же секундой изменения не теряются
+        params["filter"][">=DATE_MODIFY"] = since
+    
+    total = 0
+    for page in bitrix_list_by_id(method, params, after_id):
+        if not page:
+            continue
+        # Страница и курсор пишутся одной транзакцией: прерванная синхронизация продолжится
+        with _db("bitrix.sqlite", SYNC_SCHEMA) as conn:
+            upsert(conn, page)
+            conn.execute(
+                "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?)",
+                (entity, since, int(page[-1]["ID"]), time.time())
+            )
+        total += len(page)
+    
+    with _db("bitrix.sqlite", SYNC_SCHEMA) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO sync_state VALUES (?, ?, NULL, ?)",
+            (entity, mark, time.time())
+        )
+    return total
+
+def _sync_users() -> int:
+    """Полная синхронизация пользователей (справочник имен менеджеров)"""
+    total = 0
+    for page in bitrix_list("user.get", {}):
+        with _db("bitrix.sqlite", SYNC_SCHEMA) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO users VALUES (?, ?)",
+                [
+                    (int(u["ID"]), " ".join(filter(None, [u.get("NAME"), u.get("LAST_NAME")])))
+                    for u in page
+                ]
+            )
+        total += len(page)
+    rename_history_managers()
+    return total
+
+def manager_name(user_id) -> str:
+    """Имя менеджера Bitrix24 по ID из справочника users ("ID n", пока пользователи не синхронизированы)"""
+    with _db("bitrix.sqlite", SYNC_SCHEMA) as conn:
+        row = conn.execute("SELECT name FROM users WHERE id = ?", (int(user_id),)).fetchone()
+    return row[0] if row and row[0] else f"ID {user_id}"
+
+def rename_history_managers():
+    """Заменить в истории ID менеджеров, записанные до синхронизации пользователей, на имена"""
+    with _db("history.sqlite", HISTORY_SCHEMA) as conn:
+        # GLOB отбирает кандидатов по индексу, fullmatch отсекает имена вроде "1С-отдел"
+        stored = {manager for (manager,) in conn.execute(
+            "SELECT manager FROM manager_stats WHERE manager GLOB '[0-9]*' OR manager GLOB 'ID [0-9]*'"
+        ) if re.fullmatch(r"(ID )?\d+", manager)}
+    if not stored:
+        return
+    with _db("bitrix.sqlite", SYNC_SCHEMA) as conn:
+        names = dict(conn.execute("SELECT id, name FROM users WHERE name != ''").fetchall())
+    renames = [
+        (names[int(manager.removeprefix("ID "))], manager)
+        for manager in stored
+        if int(manager.removeprefix("ID ")) in names
+    ]
+    if renames:
+        with _db("history.sqlite", HISTORY_SCHEMA) as conn:
+            conn.executemany("UPDATE analyses SET manager = ? WHERE manager = ?", renames)
+        rebuild_history_stats()
+
+def sync_bitrix() -> dict:
+    """Инкрементальная синхронизация звонков, сделок и менеджеров в локальное хранилище"""
+    if not BITRIX24_WEBHOOK:
+        return {}
+    
+    return {
+        "users": _sync_users(),
+        "activities": _sync_entity(
+            "activities",
+            "crm.activity.list",
+            ["ID", "OWNER_ID", "OWNER_TYPE_ID", "SUBJECT", "RESPONSIBLE_ID", "START_TIME", "DATE_MODIFY", "FILES"],
+            CALL_FILTER,
+            _upsert_activities
+        ),
+        "deals": _sync_entity(
+            "deals",
+            "crm.deal.list",
+            ["ID", "TITLE", "ASSIGNED_BY_ID", "OPPORTUNITY", "STAGE_ID", "PROBABILITY", "CLOSEDATE", "DATE_MODIFY"],
+            {},
+            _upsert_deals
+        ),
+    }
+
+# =====================
+# СЛОЙ ДАННЫХ ДАШБОРДОВ
+# =====================
+
+STAGE_ORDER = ["Квалификация", "Предложение", "Переговоры", "Закрыто выиграно", "Закрыто проиграно"]
+
+def data_version() -> str:
+    """Версия данных дашбордов: меняется после каждой записи синхронизации.
+    
+    Изменения из вебхуков (строка 'webhook') публикуются в версию не чаще раза
+    в DATA_VERSION_DEBOUNCE_SECONDS: иначе каждое событие сбрасывало бы кэши
+    дашбордов и запускало переиндексацию. Последнее событие пачки попадает
+    в версию при первом прогоне после окна.
+    """
+    with _db("bitrix.sqlite", SYNC_SCHEMA) as conn:
+        state = dict(conn.execute("SELECT entity, synced_at FROM sync_state").fetchall())
+        pending = state.pop("webhook", 0)
+        published = state.pop("webhook_published", 0)
+        published_at = state.pop("webhook_published_at", 0)
+        if pending > published and time.time() - published_at >= DATA_VERSION_DEBOUNCE_SECONDS:
+            conn.executemany(
+                "INSERT OR REPLACE INTO sync_state (entity, synced_at) VALUES (?, ?)",
+                [("webhook_published", pending), ("webhook_published_at", time.time())]
+            )
+            published = pending
+    return f"{max([published, *state.values()]):.6f}"
+
+def format_rub(amounts: pd.Series) -> pd.Series:
+    """Форматирование сумм: 500000 -> '500 000₽'"""
+    return amounts.map("{:,.0f}".format).str.replace(",", " ") + "₽"
+
+def build_deals_frame(raw: pd.DataFrame) -> pd.DataFrame:
+    """Типизированный фрейм сделок: категориальные стадия и менеджер, готовые подписи сумм"""
+    extra_stages = sorted(set(raw["stage"].dropna().unique()) - set(STAGE_ORDER))
+    frame = pd.DataFrame({
+        "id": raw["id"].astype("int64"),
+        "title": raw["title"].fillna("").astype(str),
+        "manager": raw["manager"].astype("category"),
+        "amount": raw["amount"].fillna(0).astype("int64"),
+        "stage": pd.Categorical(raw["stage"], categories=STAGE_ORDER + extra_stages, ordered=True),
+        "probability": raw["probability"].fillna(0).astype("int16"),
+        "next_action": raw["next_action"].fillna("—").astype(str),
+    })
+    frame["amount_fmt"] = format_rub(frame["amount"])
+    return frame
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def load_deals_frame(version: str) -> pd.DataFrame:
+    """Сделки из локального хранилища (пока оно пустое - демо-данные), один раз на версию данных.
+    
+    Фрейм общий для всех сессий и только читается: cache_data копировал бы его на каждый rerun.
+    """
+    with _db("bitrix.sqlite", SYNC_SCHEMA) as conn:
+        raw = pd.read_sql_query("""
+            SELECT d.id, d.title, COALESCE(u.name, 'ID ' || d.assigned_by_id) AS manager,
+                   d.opportunity AS amount, d.stage_id, d.probability
+            FROM deals d LEFT JOIN users u ON u.id = d.assigned_by_id
+        """, conn)
+    
+    if raw.empty:
+        raw = pd.DataFrame(DEALS)
+    else:
+        raw["stage"] = raw["stage_id"].map(BITRIX_STAGES).fillna(raw["stage_id"])
+        raw["next_action"] = "—"
+    return build_deals_frame(raw)
+
+def build_deals_table(deals: pd.DataFrame) -> pd.DataFrame:
+    """Таблица сделок для отображения"""
+    return pd.DataFrame({
+        "ID": deals["id"],
+        "📌 Сделка": deals["title"],
+        "👤 Менеджер": deals["manager"],
+        "💰 Сумма": deals["amount_fmt"],
+        "📊 Стадия": deals["stage"],
+        "📈 Вероятность": deals["probability"].astype(str) + "%",
+        "🎯 Следующее действие": deals["next_action"]
+    })
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def deals_table(version: str) -> pd.DataFrame:
+    """Первые TABLE_MAX_ROWS сделок без фильтров"""
+    return build_deals_table(load_deals_frame(version).head(TABLE_MAX_ROWS))
+
+def kpi_period_bounds(grain: str, period: str) -> tuple:
+    """Первый и последний день периода"""
+    if grain == "day":
+        day = date.fromisoformat(period)
+        return day, day
+    if grain == "week":
+        year, week = period.split("-W")
+        first = date.fromisocalendar(int(year), int(week), 1)
+        return first, first + timedelta(days=6)
+    first = date.fromisoformat(f"{period}-01")
+    return first, (first + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def kpi_period_options(version: str, grain: str) -> list:
+    """Периоды, за которые есть своды (новые первыми)"""
+    with _db("bitrix.sqlite", SYNC_SCHEMA) as conn:
+        counted = conn.execute("SELECT 1 FROM kpi_counted LIMIT 1").fetchone()
+        synced = conn.execute("SELECT 1 FROM activities UNION ALL SELECT 1 FROM deals LIMIT 1").fetchone()
+    if synced and not counted:
+        rebuild_kpi_rollups()
+    with _db("bitrix.sqlite", SYNC_SCHEMA) as conn:
+        return [period for (period,) in conn.execute(
+            "SELECT DISTINCT period FROM kpi_rollups WHERE grain = ? ORDER BY period DESC LIMIT 60", (grain,)
+        )]
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def load_kpi_frame(version: str, grain: str, period: str) -> pd.DataFrame:
+    """KPI менеджеров за период из готовых сводов (без сводов - демо-данные).
+    
+    Чтение - одна строка свода на менеджера и дневные итоги оценок за период,
+    поэтому время не зависит от длины истории.
+    """
+    if not period:
+        frame = pd.DataFrame(MANAGERS)
+        return pd.DataFrame({
+            "manager": frame["name"],
+            "calls": frame["calls"],
+            "calls_per_day": frame["calls"].astype(float),
+            "won": frame["deals"],
+            "won_amount": 0.0,
+            "conversion": frame["kpi"].astype(float),
+            "avg_score": np.nan
+        })
+    
+    with _db("bitrix.sqlite", SYNC_SCHEMA) as conn:
+        frame = pd.read_sql_query(
+            """SELECT r.manager_id, COALESCE(u.name, 'ID ' || r.manager_id) AS manager,
+                      r.calls, r.won, r.closed, r.won_amount
+               FROM kpi_rollups r LEFT JOIN users u ON u.id = r.manager_id
+               WHERE r.grain = ? AND r.period = ?
+               ORDER BY manager""",
+            conn,
+            params=(grain, period)
+        )
+    
+    first, last = kpi_period_bounds(grain, period)
+    with _db("history.sqlite", HISTORY_SCHEMA) as conn:
+        scores = dict(
+            (manager, score_sum / calls)
+            for manager, calls, score_sum in conn.execute(
+                """SELECT manager, SUM(calls), SUM(score_sum) FROM daily_stats
+                   WHERE day BETWEEN ? AND ? GROUP BY manager""",
+                (first.isoformat(), last.isoformat())
+            )
+        )
+    
+    days = max((min(last, date.today()) - first).days + 1, 1)
+    return pd.DataFrame({
+        "manager": frame["manager"],
+        "calls": frame["calls"],
+        "calls_per_day": frame["calls"] / days,
+        "won": frame["won"],
+        "won_amount": frame["won_amount"],
+        "conversion": (frame["won"] / frame["closed"].where(frame["closed"] > 0) * 100).fillna(0),
+        "avg_score": frame["manager"].map(scores)
+    })
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def kpi_table(version: str, grain: str, period: str) -> pd.DataFrame:
+    kpi = load_kpi_frame(version, grain, period)
+    return pd.DataFrame({
+        "👤 Менеджер": kpi["manager"],
+        "📞 Звонков": kpi["calls"],
+        "📞 В день": kpi["calls_per_day"].round(1),
+        "🤝 Выиграно": kpi["won"],
+        "💰 Выручка": format_rub(kpi["won_amount"].round().astype("int64")),
+        "📈 Конверсия": kpi["conversion"].round().astype("int64").astype(str) + "%",
+        "⭐ Средняя оценка": kpi["avg_score"].round(1)
+    })
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def sales_figures(version: str, grain: str, period: str) -> tuple:
+    """Графики конверсии и звонков (строятся один раз на версию данных и период)"""
+    kpi = load_kpi_frame(version, grain, period)
+    conversion_fig = px.bar(
+        x=kpi["manager"],
+        y=kpi["conversion"],
+        labels={"x": "Менеджер", "y": "Конверсия %"},
+        title="Конверсия в выигрыш по менеджерам"
+    )
+    calls_fig = px.bar(
+        x=kpi["manager"],
+        y=kpi["calls"],
+        labels={"x": "Менеджер", "y": "Звонки"},
+        title="Звонки по менеджерам"
+    )
+    return conversion_fig, calls_fig
+
+PROBABILITY_BUCKETS = ["> 80%", "60-80%", "< 60%"]
+TABLE_MAX_ROWS = 1000
+
+def probability_buckets(probability: np.ndarray) -> np.ndarray:
+    """Код корзины вероятности для каждой сделки (порядок как в PROBABILITY_BUCKETS)"""
+    return np.select([probability > 80, probability >= 60], [0, 1], 2).astype(np.int8)
+
+def build_deal_index(deals: pd.DataFrame) -> dict:
+    """Индекс сделок по ячейкам (менеджер, стадия, корзина вероятности).
+    
+    cube[m, s, b] - число сделок в ячейке, positions[bounds[c]:bounds[c + 1]] -
+    позиции строк ячейки c. Любая комбинация фильтров - это набор ячеек,
+    поэтому выборка стоит O(выбранных строк), а воронка - сумма по кубу.
+    """
+    managers = list(deals["manager"].cat.categories)
+    stages = list(deals["stage"].cat.categories)
+    shape = (len(managers), len(stages), len(PROBABILITY_BUCKETS))
+    
+    manager_codes = deals["manager"].cat.codes.to_numpy().astype(np.int64)
+    stage_codes = deals["stage"].cat.codes.to_numpy().astype(np.int64)
+    bucket_codes = probability_buckets(deals["probability"].to_numpy()).astype(np.int64)
+    valid = (manager_codes >= 0) & (stage_codes >= 0)
+    
+    cells = np.where(valid, (manager_codes * shape[1] + stage_codes) * shape[2] + bucket_codes, -1)
+    positions = np.argsort(cells, kind="stable")
+    positions = positions[np.searchsorted(cells[positions], 0):]
+    counts = np.bincount(cells[valid], minlength=int(np.prod(shape)))
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+    
+    return {
+        "managers": managers,
+        "stages": stages,
+        "cube": counts.reshape(shape),
+        "positions": positions,
+        "bounds": bounds,
+    }
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def load_deal_index(version: str) -> dict:
+    """Индекс сделок, один на версию данных (общий для всех сессий, только чтение)"""
+    return build_deal_index(load_deals_frame(version))
+
+def _filter_codes(options: list, selected: str) -> list:
+    if selected == "Все":
+        return list(range(len(options)))
+    return [options.index(selected)] if selected in options else []
+
+def select_deals(index: dict, manager: str = "Все", stage: str = "Все", probability: str = "Все") -> tuple:
+    """Выборка по фильтрам: (позиции строк, количество по стадиям для воронки)"""
+    m_codes = _filter_codes(index["managers"], manager)
+    s_codes = _filter_codes(index["stages"], stage)
+    b_codes = _filter_codes(PROBABILITY_BUCKETS, probability)
+    
+    stage_counts = index["cube"][np.ix_(m_codes, s_codes, b_codes)].sum(axis=(0, 2))
+    
+    n_stages, n_buckets = len(index["stages"]), len(PROBABILITY_BUCKETS)
+    bounds = index["bounds"]
+    slices = [
+        index["positions"][bounds[c]:bounds[c + 1]]
+        for m in m_codes for s in s_codes for b in b_codes
+        for c in [(m * n_stages + s) * n_buckets + b]
+        if bounds[c + 1] > bounds[c]
+    ]
+    positions = np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+    return positions, dict(zip([index["stages"][s] for s in s_codes], stage_counts.tolist()))
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def funnel_figure(stages: tuple, counts: tuple):
+    """График воронки, мемоизированный по данным.
+    
+    Проигранные сделки - не этап воронки: они идут отдельной серией в строке
+    «Закрыто» рядом с выигранными.
+    """
+    closed = {"Закрыто выиграно": "Выиграно", "Закрыто проиграно": "Проиграно"}
+    return px.funnel(
+        x=list(counts),
+        y=["Закрыто" if stage in closed else stage for stage in stages],
+        color=[closed.get(stage, "В работе") for stage in stages],
+        title="Воронка продаж"
+    )
+
+PULSE_HEALTH = ["✅ Здоровая", "⚠️ Требует внимания", "🔴 Критичная"]
+
+def deal_health(probability: np.ndarray) -> np.ndarray:
+    """Код здоровья для каждой сделки (порядок как в PULSE_HEALTH)"""
+    return np.select([probability > 70, probability > 40], [0, 1], 2).astype(np.int8)
+
+def build_pulse_index(deals: pd.DataFrame) -> dict:
+    """Сделки по корзинам здоровья: order[bounds[h]:bounds[h + 1]] - позиции корзины h.
+    
+    Внутри корзины - по убыванию суммы, поэтому страница - это срез без сортировки.
+    """
+    health = deal_health(deals["probability"].to_numpy())
+    order = np.lexsort((-deals["amount"].to_numpy(), health))
+    counts = np.bincount(health, minlength=len(PULSE_HEALTH))
+    return {
+        "health": health,
+        "order": order,
+        "bounds": np.concatenate([[0], np.cumsum(counts)]),
+    }
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def load_pulse_index(version: str) -> dict:
+    """Индекс пульса, один на версию данных (общий для всех сессий, только чтение)"""
+    return build_pulse_index(load_deals_frame(version))
+
+def deal_snapshot(deals: pd.DataFrame) -> dict:
+    """Поля, изменение которых показывает пульс, в порядке возрастания ID"""
+    ids = deals["id"].to_numpy()
+    order = np.argsort(ids, kind="stable")
+    return {
+        "ids": ids[order],
+        "order": order,
+        "stage": deals["stage"].cat.codes.to_numpy()[order],
+        "stages": list(deals["stage"].cat.categories),
+        "probability": deals["probability"].to_numpy()[order],
+        "amount": deals["amount"].to_numpy()[order],
+    }
+
+def diff_deal_snapshots(old: dict, new: dict) -> tuple:
+    """Новые и изменившиеся сделки: (позиции в new, позиции в old или -1 для новых)"""
+    if not len(old["ids"]):
+        return np.arange(len(new["ids"])), np.full(len(new["ids"]), -1)
+    pos = np.minimum(np.searchsorted(old["ids"], new["ids"]), len(old["ids"]) - 1)
+    found = old["ids"][pos] == new["ids"]
+    # Коды стадий старого снимка в кодах нового (список стадий мог пополниться); -1 остается -1
+    remap = np.array([new["stages"].index(s) if s in new["stages"] else -2 for s in old["stages"]] + [-1])
+    changed = (
+        ~found
+        | (remap[old["stage"][pos]] != new["stage"])
+        | (old["probability"][pos] != new["probability"])
+        | (old["amount"][pos] != new["amount"])
+    )
+    idx = np.flatnonzero(changed)
+    return idx, np.where(found[idx], pos[idx], -1)
+
+def build_changes_table(deals: pd.DataFrame, old: dict, new: dict, idx: np.ndarray, old_pos: np.ndarray) -> pd.DataFrame:
+    """Таблица изменений «было → стало» для idx (позиции в new)"""
+    rows = deals.iloc[new["order"][idx]]
+    known = old_pos >= 0
+    safe = np.where(known, old_pos, 0)
+    was_stage = np.asarray(old["stages"] + [""], dtype=object)[old["stage"][safe]]
+    was_probability = old["probability"][safe].astype(str)
+    was_amount = format_rub(pd.Series(old["amount"][safe])).to_numpy()
+    
+    def arrow(was, now):
+        now = np.asarray(now, dtype=object).astype(str)
+        return np.where(~known, "🆕 " + now, np.where(was == now, now, was.astype(object) + " → " + now))
+    
+    return pd.DataFrame({
+        "ID": rows["id"].to_numpy(),
+        "📌 Сделка": rows["title"].to_numpy(),
+        "📊 Стадия": arrow(was_stage.astype(str), rows["stage"].astype(str).to_numpy()),
+        "📈 Вероятность, %": arrow(was_probability, rows["probability"].to_numpy()),
+        "💰 Сумма": arrow(was_amount.astype(str), rows["amount_fmt"].to_numpy()),
+    })
+
+class DealChangeTracker:
+    """Снимки сделок по версиям данных и разницы между версиями.
+    
+    Один на процесс: снимок строится один раз на версию, разница - один раз на пару
+    версий. С какой версии показывать изменения, решает сессия - это версия, которую
+    пользователь видел перед текущей. Хранятся PULSE_SNAPSHOTS последних снимков.
+    """
+    
+    def __init__(self, keep: int = PULSE_SNAPSHOTS):
+        self.lock = threading.Lock()
+        self.keep = keep
+        self.snapshots = {}
+        self.changes = {}
+    
+    def _snapshot(self, version: str, deals: pd.DataFrame) -> dict:
+        if version not in self.snapshots:
+            self.snapshots[version] = deal_snapshot(deals)
+            # Версии сменяются только вперед: вытесняются самые старые снимки и их разницы
+            for old in list(self.snapshots)[:-self.keep]:
+                del self.snapshots[old]
+            self.changes = {key: value for key, value in self.changes.items() if key[0] in self.snapshots}
+        return self.snapshots[version]
+    
+    def changes_between(self, since: str, version: str, deals: pd.DataFrame) -> dict:
+        """Изменения версии version относительно since:
+        {"since": версия-база, "positions": позиции изменившихся сделок во фрейме, "table": первые TABLE_MAX_ROWS}.
+        
+        since=None - первый просмотр, изменений нет. Если снимок since уже вытеснен,
+        база - самый старый сохраненный снимок (он и возвращается в "since").
+        """
+        with self.lock:
+            new = self._snapshot(version, deals)
+            if since is not None and since not in self.snapshots:
+                since = next(iter(self.snapshots))
+            if since is None or since == version:
+                return {"since": since, "positions": np.empty(0, dtype=np.int64), "table": None}
+            
+            key = (since, version)
+            if key not in self.changes:
+                old = self.snapshots[since]
+                idx, old_pos = diff_deal_snapshots(old, new)
+                shown = slice(0, TABLE_MAX_ROWS)
+                self.changes[key] = {
+                    "since": since,
+                    "positions": new["order"][idx],
+                    "table": build_changes_table(deals, old, new, idx[shown], old_pos[shown])
+                }
+            return self.changes[key]
+
+@st.cache_resource
+def get_deal_change_tracker() -> DealChangeTracker:
+    return DealChangeTracker()
+
+# =====================
+# НАРЕЗКА АУДИО
+# =====================
+
+_MP3_BITRATES_V1 = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+_MP3_BITRATES_V2 = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+
+def hash_fileobj(fileobj) -> str:
+    """Потоковый SHA-256 файлового объекта (блоками по 1 МБ)"""
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    for block in iter(lambda: fileobj.read(1024 * 1024), b""):
+        digest.update(block)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+def _detect_audio_format(head: bytes) -> str:
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "wav"
+    if head[:3] == b"ID3" or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+        return "mp3"
+    if head[:4] == b"OggS":
+        return "ogg"
+    if head[4:8] == b"ftyp":
+        return "m4a"
+    return "mp3"
+
+def _find_mp3_sync(data: bytes, start: int = 0) -> int:
+    """Позиция ближайшего заголовка MPEG-кадра Layer III не раньше start (-1, если нет)"""
+    pos = data.find(b"\xff", start)
+    while 0 <= pos < len(data) - 2:
+        b1, b2 = data[pos + 1], data[pos + 2]
+        if b1 & 0xE0 == 0xE0 and (b1 >> 1) & 3 == 1 and b2 >> 4 not in (0, 15):
+            return pos
+        pos = data.find(b"\xff", pos + 1)
+    return -1
+
+def _mp3_bytes_per_second(data: bytes) -> int:
+    """Байт в секунду по первому кадру (CBR); 128 кбит/с, если заголовок не распознан"""
+    pos = _find_mp3_sync(data)
+    if pos < 0:
+        return 16000
+    b1, b2 = data[pos + 1], data[pos + 2]
+    table = _MP3_BITRATES_V1 if (b1 >> 3) & 3 == 3 else _MP3_BITRATES_V2
+    return table[b2 >> 4] * 125
+
+def _mp3_chunks(fileobj, size: int):
+    head = fileobj.read(10)
+    audio_start = 0
+    if head[:3] == b"ID3":
+        # Размер ID3v2 хранится в synchsafe-формате
+        audio_start = 10 + ((head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9])
+    fileobj.seek(audio_start)
+    bps = _mp3_bytes_per_second(fileobj.read(64 * 1024))
+    window = min(TRANSCRIBE_CHUNK_SECONDS * bps, WHISPER_MAX_BYTES)
+    overlap = TRANSCRIBE_OVERLAP_SECONDS * bps
+    
+    pos = audio_start
+    while pos < size:
+        fileobj.seek(pos)
+        data = fileobj.read(window)
+        end = pos + len(data)
+        if end < size:
+            # Режем по последней границе кадра в хвосте окна
+            cut = -1
+            sync = _find_mp3_sync(data, max(len(data) - 8192, 1))
+            while sync > 0:
+                cut = sync
+                sync = _find_mp3_sync(data, sync + 1)
+            if cut > 0:
+                data = data[:cut]
+                end = pos + cut
+        yield (pos - audio_start) / bps, data, "chunk.mp3"
+        if end >= size:
+            break
+        next_pos = end - overlap
+        fileobj.seek(next_pos)
+        sync = _find_mp3_sync(fileobj.read(8192))
+        pos = max(next_pos + max(sync, 0), pos + 1)
+
+def _quietest_frame(frames: bytes, n: int, rate: int, channels: int) -> int:
+    """Самое тихое место (RMS по 100 мс) в последних 15% окна 16-битного PCM"""
+    samples = np.frombuffer(frames[:n * 2 * channels], dtype="<i2").astype(np.float32)
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1)
+    block = max(rate // 10, 1)
+    lo = int(n * 0.85)
+    nblocks = (n - lo) // block
+    if nblocks < 2:
+        return n
+    energy = (samples[lo:lo + nblocks * block].reshape(nblocks, block) ** 2).mean(axis=1)
+    return lo + int(energy.argmin()) * block + block // 2
+
+def _wav_chunks(fileobj):
+    with wave.open(fileobj, "rb") as wav:
+        params = wav.getparams()
+        frame_bytes = params.sampwidth * params.nchannels
+        window = min(TRANSCRIBE_CHUNK_SECONDS * params.framerate, (WHISPER_MAX_BYTES - 1024) // frame_bytes)
+        overlap = TRANSCRIBE_OVERLAP_SECONDS * params.framerate
+        
+        pos = 0
+        while pos < params.nframes:
+            wav.setpos(pos)
+            frames = wav.readframes(window)
+            n = len(frames) // frame_bytes
+            if pos + n < params.nframes and params.sampwidth == 2:
+                # Граница окна переносится в паузу, чтобы не резать слова
+                n = _quietest_frame(frames, n, params.framerate, params.nchannels)
+                frames = frames[:n * frame_bytes]
+            
+            out = BytesIO()
+            with wave.open(out, "wb") as chunk:
+                chunk.setparams(params)
+                chunk.writeframes(frames)
+            yield pos / params.framerate, out.getvalue(), "chunk.wav"
+            
+            if pos + n >= params.nframes:
+                break
+            pos += max(n - overlap, 1)
+
+def _pydub_chunks(fileobj, fmt: str):
+    try:
+        from pydub import AudioSegment
+    except ImportError:
+        raise ValueError("Файл больше 25 МБ: для нарезки этого формата установите pydub и ffmpeg")
+    
+    audio = AudioSegment.from_file(fileobj, format="mp4" if fmt == "m4a" else fmt)
+    window_ms = TRANSCRIBE_CHUNK_SECONDS * 1000
+    step_ms = window_ms - TRANSCRIBE_OVERLAP_SECONDS * 1000
+    for start in range(0, len(audio), step_ms):
+        out = BytesIO()
+        audio[start:start + window_ms].export(out, format="mp3", bitrate="64k")
+        yield start / 1000, out.getvalue(), "chunk.mp3"
+        if start + window_ms >= len(audio):
+            break
+
+def iter_audio_chunks(fileobj):
+    """Окна записи (смещение в секундах, байты, имя файла) с перекрытием TRANSCRIBE_OVERLAP_SECONDS"""
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    fmt = _detect_audio_format(fileobj.read(12))
+    fileobj.seek(0)
+    
+    if fmt == "wav":
+        yield from _wav_chunks(fileobj)
+    elif fmt == "mp3":
+        yield from _mp3_chunks(fileobj, size)
+    elif size > WHISPER_MAX_BYTES:
+        yield from _pydub_chunks(fileobj, fmt)
+    else:
+        yield 0.0, fileobj.read(), f"call.{fmt}"
+
+def _transcribe_chunk(data: bytes, filename: str) -> dict:
+    """Whisper verbose_json для одного окна: текст, сегменты и длительность"""
+    audio_file = BytesIO(data)
+    audio_file.name = filename
+    
+    with span("openai.transcription", model=WHISPER_MODEL) as record:
+        transcript = call_with_retry(
+            "openai",
+            get_openai_client().audio.transcriptions.create,
+            model=WHISPER_MODEL,
+            file=audio_file,
+            language=TRANSCRIBE_LANGUAGE,
+            response_format="verbose_json"
+        )
+        record_audio(record, float(getattr(transcript, "duration", 0) or 0))
+    
+    segments = []
+    for seg in getattr(transcript, "segments", None) or []:
+        get = seg.get if isinstance(seg, dict) else lambda name, default=None, seg=seg: getattr(seg, name, default)
+        segments.append({
+            "start": float(get("start", 0)),
+            "end": float(get("end", 0)),
+            "text": get("text", "").strip(),
+            "no_speech_prob": float(get("no_speech_prob", 0) or 0),
+            "compression_ratio": float(get("compression_ratio", 0) or 0)
+        })
+    return {"text": transcript.text, "segments": segments}
+
+def stitch_transcripts(chunks: list) -> dict:
+    """Склейка окон [(смещение, результат), ...] по таймкодам.
+    
+    Граница между соседними окнами проходит посередине перекрытия: каждое окно
+    оставляет только сегменты, центр которых попадает в его зону.
+    """
+    half = TRANSCRIBE_OVERLAP_SECONDS / 2
+    segments = []
+    texts = []
+    for i, (offset, result) in enumerate(chunks):
+        lo = offset + half if i else float("-inf")
+        hi = chunks[i + 1][0] + half if i + 1 < len(chunks) else float("inf")
+        if not result["segments"]:
+            texts.append(result["text"].strip())
+            continue
+        for seg in result["segments"]:
+            seg = dict(seg, start=seg["start"] + offset, end=seg["end"] + offset)
+            if lo <= (seg["start"] + seg["end"]) / 2 < hi:
+                segments.append(seg)
+                texts.append(seg["text"])
+    return {"text": " ".join(t for t in texts if t), "segments": segments}
+
+def format_timestamped(segments: list) -> str:
+    """Текст с таймкодами [чч:мм:сс]"""
+    return "\n".join(
+        f"[{int(seg['start']) // 3600:02d}:{int(seg['start']) % 3600 // 60:02d}:{int(seg['start']) % 60:02d}] {seg['text']}"
+        for seg in segments
+    )
+
+# =====================
+# РЕПЛИКИ И СЖАТИЕ ТРАНСКРИПТА
+# =====================
+
+# Сегменты Whisper на музыке/тишине и типичные «субтитры», которые Whisper дописывает к ним
+HALLUCINATION_RE = re.compile(
+    r"продолжение следует|субтитр|спасибо за просмотр|подписывайтесь|dimatorzok",
+    re.IGNORECASE
+)
+# Реплики только из междометий ("да"/"нет"/"хорошо" оставляем: это ответы клиента)
+FILLER_RE = re.compile(r"^(?:(?:угу|ага|ну|э+|м+|алло|ало|так|окей|ок)[\s,.!?…-]*)+$", re.IGNORECASE)
+
+# Признаки, по которым реплики попадают в выдержку для критерия
+CRITERION_CUES = {
+    "politeness": re.compile(r"здравствуйте|добр(ый|ое)|спасибо|пожалуйста|извините|до свидания|всего доброго", re.IGNORECASE),
+    "understanding": re.compile(r"\?|расскажите|уточн|правильно ли|для чего|какие задачи|сколько", re.IGNORECASE),
+    "solution": re.compile(r"предлага|можем|вариант|стоимост|цен[аеуы]|тариф|услови|скидк|дорого|подумаю|не нужно|сравн", re.IGNORECASE),
+    "closing": re.compile(r"договор|счет|счёт|оформ|встреч|отправ|перезвон|завтра|когда удобно|следующ", re.IGNORECASE),
+}
+
+def _is_noise(seg: dict) -> bool:
+    """Тишина, музыка ожидания, галлюцинации Whisper и междометия"""
+    text = seg["text"].strip()
+    return (
+        not text
+        or seg.get("no_speech_prob", 0) > NO_SPEECH_THRESHOLD
+        or seg.get("compression_ratio", 0) > 2.4
+        or bool(HALLUCINATION_RE.search(text))
+        or bool(FILLER_RE.match(text))
+    )
+
+def split_turns(segments: list) -> list:
+    """Реплики звонка из сегментов Whisper без шума: [{"turn", "start", "end", "text"}, ...].
+    
+    Whisper не различает голоса, а угаданная по паузам смена говорящего одной
+    ошибкой переворачивает все роли после нее. Поэтому реплики не размечаются:
+    кто говорит, модель определяет по смыслу при оценке.
+    """
+    turns = []
+    for seg in segments:
+        if not _is_noise(seg):
+            turns.append({"turn": len(turns), "start": seg["start"], "end": seg["end"], "text": seg["text"].strip()})
+    return turns
+
+def select_turns(turns: list) -> dict:
+    """Номера реплик для каждого критерия (не больше CRITERION_MAX_TURNS): {критерий: [номер, ...]}"""
+    last = len(turns) - 1
+    
+    def by_cues(name, pool):
+        # Больше совпадений - раньше; при равенстве - по порядку в звонке
+        hits = [(len(CRITERION_CUES[name].findall(t["text"])), t["turn"]) for t in pool]
+        return [i for n, i in sorted(hits, key=lambda h: -h[0]) if n]
+    
+    def top(candidates):
+        return sorted(list(dict.fromkeys(candidates))[:CRITERION_MAX_TURNS])
+    
+    # Вопрос вместе со следующей репликой - ответ на него
+    questions = [t["turn"] for t in turns if t["text"].endswith("?")]
+    return {
+        "politeness": top([t["turn"] for t in turns[:2] + turns[-2:]] + by_cues("politeness", turns)),
+        "understanding": top([i for q in questions for i in (q, q + 1) if i <= last] + by_cues("understanding", turns)),
+        "solution": top(by_cues("solution", turns)),
+        "closing": top(list(range(max(last - 3, 0), last + 1)) + by_cues("closing", turns[len(turns) * 2 // 3:]))
+    }
+
+def _clip(text: str, limit: int = TURN_MAX_CHARS) -> str:
+    """Длинный монолог: начало и конец"""
+    if len(text) <= limit:
+        return text
+    return text[:limit * 2 // 3] + " … " + text[-limit // 3:]
+
+def scoring_input(transcription: str, segments: list = None) -> tuple:
+    """Текст для оценки и реплики, на которые ссылаются оценки сегментов: (текст, реплики).
+    
+    Без сегментов отправляется исходный транскрипт. Короткий звонок - все реплики
+    с номерами; длинный - только реплики, отобранные под критерии.
+    """
+    turns = split_turns(segments or [])
+    if not turns:
+        return transcription, []
+    
+    dialog = "Реплики звонка по порядку (говорящие не размечены):\n" + "\n".join(
+        f"[{t['turn']}] {t['text']}" for t in turns
+    )
+    if len(dialog) <= SEGMENT_SCORING_MIN_CHARS:
+        return dialog, turns
+    
+    selected = select_turns(turns)
+    used = sorted(set().union(*selected.values()))
+    lines = ["Выдержки из звонка (говорящие не размечены; в скобках - номер реплики):"]
+    lines += [f"[{i}] {_clip(turns[i]['text'])}" for i in used]
+    lines.append("")
+    lines.append("Реплики по критериям:")
+    lines += [f"{name}: {', '.join(map(str, ids)) or '-'}" for name, ids in selected.items()]
+    excerpt = "\n".join(lines)
+    return (excerpt if len(excerpt) < len(dialog) else dialog), turns
+
+def attach_turns(analysis: dict, turns: list) -> dict:
+    """Дополнить оценки реплик временем, ролью и текстом.
+    
+    Элементы, которые модель заполнила неверно (ссылка на несуществующую реплику,
+    неизвестный критерий, оценка не числом), отбрасываются, а не роняют анализ.
+    """
+    scored = []
+    for item in analysis.get("segment_scores") or []:
+        try:
+            index = int(item["turn"])
+            turn = turns[index] if index >= 0 else None
+            score = int(float(item.get("score", 0)))
+        except (KeyError, IndexError, TypeError, ValueError, OverflowError, AttributeError):
+            continue
+        if turn is None or item.get("criterion") not in SCORE_CRITERIA or item.get("speaker") not in ("manager", "client"):
+            continue
+        scored.append({
+            "turn": turn["turn"],
+            "criterion": item["criterion"],
+            "score": min(max(score, 0), 5),
+            "comment": str(item.get("comment", "")),
+            "start": turn["start"],
+            "speaker": item["speaker"],
+            "text": turn["text"]
+        })
+    analysis["segment_scores"] = scored
+    return analysis
+
+# =====================
+# АРХИВ ЗАПИСЕЙ И ТРАНСКРИПТОВ
+# =====================
+
+# Транскрипты лежат сжатыми блоками в transcripts.pack: [sha256 текста][сжатый JSON].
+# transcripts.idx - записи фиксированной длины, читаются через memmap без загрузки в память.
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+def _archive_path(*parts) -> str:
+    return os.path.join(DATA_DIR, "archive", *parts)
+
+@st.cache_resource
+def _archive_lock() -> threading.Lock:
+    """Запись в архив из потоков задач и пакетного анализа идет по одной"""
+    return threading.Lock()
+
+def _archive_index_dtype():
+    """Запись индекса: первые 8 байт хэша, смещение и длина блока, кодек"""
+    return np.dtype([("key", "<u8"), ("offset", "<u8"), ("length", "<u4"), ("codec", "u1"), ("pad", "u1", (3,))])
+
+def _compress(payload: bytes) -> tuple:
+    """zstd, если установлен zstandard, иначе zlib"""
+    try:
+        import zstandard
+    except ImportError:
+        import zlib
+        return CODEC_ZLIB, zlib.compress(payload, 9)
+    return CODEC_ZSTD, zstandard.ZstdCompressor(level=19).compress(payload)
+
+def _decompress(codec: int, data: bytes) -> bytes:
+    if codec == CODEC_ZSTD:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    import zlib
+    return zlib.decompress(data)
+
+def _read_index():
+    """Индекс транскриптов через memmap (None, если архив пуст)"""
+    path = _archive_path("transcripts.idx")
+    dtype = _archive_index_dtype()
+    count = os.path.getsize(path) // dtype.itemsize if os.path.exists(path) else 0
+    if not count:
+        return None
+    # Хвост неполной записи (обрыв при дописывании) не читается
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+def _find_transcript_blob(ref: str) -> tuple:
+    """(кодек, сжатые данные) транскрипта или None"""
+    index = _read_index()
+    if index is None:
+        return None
+    digest = bytes.fromhex(ref)
+    hits = np.flatnonzero(index["key"] == np.uint64(int.from_bytes(digest[:8], "little")))
+    if not len(hits):
+        return None
+    with open(_archive_path("transcripts.pack"), "rb") as pack:
+        for i in hits[::-1]:
+            pack.seek(int(index["offset"][i]))
+            blob = pack.read(int(index["length"][i]))
+            if blob[:32] == digest:
+                return int(index["codec"][i]), blob[32:]
+    return None
+
+def archive_transcript(transcript: dict) -> str:
+    """Сохранить транскрипт {"text", "segments", ...} один раз на текст, вернуть ref = content_hash(text).
+    
+    ref совпадает с analyses.transcript_ref в истории.
+    """
+    ref = content_hash(transcript["text"])
+    with _archive_lock():
+        if _find_transcript_blob(ref) is not None:
+            return ref
+        codec, data = _compress(json.dumps(transcript, ensure_ascii=False).encode("utf-8"))
+        digest = bytes.fromhex(ref)
+        os.makedirs(_archive_path(), exist_ok=True)
+        with open(_archive_path("transcripts.pack"), "ab") as pack:
+            offset = pack.seek(0, os.SEEK_END)
+            pack.write(digest + data)
+        entry = np.zeros(1, dtype=_archive_index_dtype())
+        entry[0] = (int.from_bytes(digest[:8], "little"), offset, len(digest) + len(data), codec, (0, 0, 0))
+        # Индекс дописывается после данных: оборванная запись оставит лишь недостижимый блок
+        with open(_archive_path("transcripts.idx"), "ab") as idx:
+            idx.write(entry.tobytes())
+    return ref
+
+def load_transcript(ref: str) -> dict:
+    """Транскрипт из архива по ref (None, если его нет)"""
+    found = _find_transcript_blob(ref)
+    if found is None:
+        return None
+    return json.loads(_decompress(*found))
+
+def find_archived_audio(audio_hash: str) -> str:
+    """Путь к записи в архиве или пустая строка"""
+    if not audio_hash:
+        return ""
+    folder = _archive_path("audio", audio_hash[:2])
+    if os.path.isdir(folder):
+        for name in os.listdir(folder):
+            if name.split(".", 1)[0] == audio_hash:
+                return os.path.join(folder, name)
+    return ""
+
+def archive_audio(fileobj, audio_hash: str) -> str:
+    """Сохранить запись один раз на содержимое в моно Opus 16 кГц.
+    
+    Без ffmpeg (или если он не смог перекодировать) запись не архивируется - пустая
+    строка: несжатые оригиналы заняли бы на порядок больше места.
+    """
+    existing = find_archived_audio(audio_hash)
+    if existing:
+        return existing
+    ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg:
+        return ""
+    
+    folder = _archive_path("audio", audio_hash[:2])
+    os.makedirs(folder, exist_ok=True)
+    fileobj.seek(0)
+    fmt = _detect_audio_format(fileobj.read(12))
+    fileobj.seek(0)
+    with tempfile.NamedTemporaryFile(dir=folder, suffix=f".{fmt}", delete=False) as tmp:
+        shutil.copyfileobj(fileobj, tmp, 1024 * 1024)
+    fileobj.seek(0)
+    
+    encoded = tmp.name + ".ogg"
+    done = subprocess.run(
+        [ffmpeg, "-nostdin", "-loglevel", "error", "-y", "-i", tmp.name,
+         "-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", ARCHIVE_OPUS_BITRATE,
+         "-application", "voip", encoded],
+        capture_output=True
+    )
+    os.remove(tmp.name)
+    if done.returncode != 0:
+        if os.path.exists(encoded):
+            os.remove(encoded)
+        return ""
+    path = os.path.join(folder, f"{audio_hash}.ogg")
+    os.replace(encoded, path)
+    return path
+
+# =====================
+# ФУНКЦИИ АНАЛИЗА
+# =====================
+
+def _transcribe_detailed(audio) -> dict:
+    """Транскрибация с таймкодами без вывода в интерфейс.
+    
+    audio - байты или файловый объект (например, UploadedFile): запись читается
+    окнами, окна транскрибируются параллельно и склеиваются по таймкодам.
+    """
+    fileobj = BytesIO(audio) if isinstance(audio, (bytes, bytearray)) else audio
+    audio_hash = hash_fileobj(fileobj)
+    key = transcript_cache_key(audio_hash)
+    cached = cache_get(key)
+    if cached is not None:
+        return cached
+    
+    chunks = []
+    with ThreadPoolExecutor(max_workers=TRANSCRIBE_WORKERS, thread_name_prefix="rubi-whisper") as pool:
+        pending = {}
+        for offset, data, filename in iter_audio_chunks(fileobj):
+            # Не держим в памяти больше двух окон на поток
+            if len(pending) >= TRANSCRIBE_WORKERS * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                chunks.extend((pending.pop(f), f.result()) for f in done)
+            pending[pool.submit(_transcribe_chunk, data, filename)] = offset
+        chunks.extend((offset, f.result()) for f, offset in pending.items())
+    
+    result = stitch_transcripts(sorted(chunks, key=lambda c: c[0]))
+    cache_put(key, result)
+    archive_transcript(dict(result, audio=audio_hash))
+    if ARCHIVE_AUDIO:
+        archive_audio(fileobj, audio_hash)
+    return result
+
+def _transcribe(audio) -> str:
+    """Транскрибация через Whisper без вывода в интерфейс"""
+    return _transcribe_detailed(audio)["text"]
+
+def transcribe_audio(audio) -> str:
+    """Транскрибация через Whisper"""
+    try:
+        st.info("🎙️ Транскрибируем звонок...")
+        text = _transcribe(audio)
+        st.success("✅ Транскрибация завершена!")
+        return text
+    except Exception as e:
+        st.error(f"❌ Ошибка: {str(e)}")
+        return ""
+
+def _record_stream_usage(record: dict, usage, messages: list, generated: list, extra: str = ""):
+    """Токены потокового ответа: из usage, а если поток закрыт до него - оценка"""
+    if usage is not None:
+        record_usage(record, usage.prompt_tokens, usage.completion_tokens)
+    else:
+        prompt = sum(_message_tokens(m) for m in messages) + (count_tokens(extra) if extra else 0)
+        record_usage(record, prompt, count_tokens("".join(generated)), estimated=True)
+
+def stream_chat(messages: list, model: str, **kwargs):
+    """Потоковый ответ chat.completions: отдает текст по мере генерации"""
+    with span("openai.chat", model=model) as record:
+        stream = call_with_retry(
+            "openai",
+            get_openai_client().chat.completions.create,
+            model=model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+            **kwargs
+        )
+        usage, generated = None, []
+        try:
+            for chunk in stream:
+                usage = chunk.usage or usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    generated.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        finally:
+            # При досрочном выходе (JSON уже получен) соединение закрывается сразу
+            stream.response.close()
+            _record_stream_usage(record, usage, messages, generated)
+
+def stream_tool_arguments(messages: list, model: str, tool: dict, **kwargs):
+    """Потоковый вызов функции: отдает фрагменты JSON-аргументов по мере генерации"""
+    with span("openai.chat", model=model) as record:
+        stream = call_with_retry(
+            "openai",
+            get_openai_client().chat.completions.create,
+            model=model,
+            messages=messages,
+            tools=[tool],
+            tool_choice={"type": "function", "function": {"name": tool["function"]["name"]}},
+            stream=True,
+            stream_options={"include_usage": True},
+            **kwargs
+        )
+        usage, generated = None, []
+        try:
+            for chunk in stream:
+                usage = chunk.usage or usage
+                if chunk.choices and chunk.choices[0].delta.tool_calls:
+                    arguments = chunk.choices[0].delta.tool_calls[0].function.arguments
+                    if arguments:
+                        generated.append(arguments)
+                        yield arguments
+        finally:
+            stream.response.close()
+            _record_stream_usage(record, usage, messages, generated, json.dumps(tool, ensure_ascii=False))
+
+class JsonObjectScanner:
+    """Инкрементально находит первый JSON-объект в потоке текста"""
+    
+    def __init__(self):
+        self.text = ""
+        self.start = -1
+        self.end = -1
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+    
+    def feed(self, chunk: str) -> bool:
+        """Добавить фрагмент; True, когда объект закрылся"""
+        self.text += chunk
+        while self.end < 0 and self._pos < len(self.text):
+            ch = self.text[self._pos]
+            self._pos += 1
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"' and self._depth:
+                self._in_string = True
+            elif ch == "{":
+                if not self._depth:
+                    self.start = self._pos - 1
+                self._depth += 1
+            elif ch == "}" and self._depth:
+                self._depth -= 1
+                if not self._depth:
+                    self.end = self._pos
+        return self.end >= 0
+    
+    def value(self) -> dict:
+        if self.end < 0:
+            raise ValueError("Ответ модели не содержит законченного JSON-объекта")
+        return json.loads(self.text[self.start:self.end])
+
+SCORE_CRITERIA = ["politeness", "understanding", "solution", "closing"]
+CRITERION_LABELS = {"politeness": "Вежливость", "understanding": "Понимание", "solution": "Решение", "closing": "Закрытие"}
+
+SCORING_PROMPT = """Ты оцениваешь качество телефонного звонка менеджера по продажам.
+
+Дай оценку (0-5 каждый):
+1. politeness - вежливость
+2. understanding - выявление потребностей
+3. solution - представление решения
+4. closing - закрытие сделки
+
+Определи:
+- Тональность (Позитивная/Нейтральная/Негативная)
+- Ключевые фразы (3-5)
+- Рекомендации (2-3)
+
+Если реплики пронумерованы, в segment_scores оцени 3-8 самых показательных реплик:
+номер реплики, кто ее произносит (manager/client - определи по смыслу), критерий,
+оценка 0-5 и короткий комментарий.
+
+Верни результат вызовом функции submit_call_score."""
+
+SCORING_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "submit_call_score",
+        "description": "Оценка качества телефонного звонка",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                **{name: {"type": "integer", "minimum": 0, "maximum": 5} for name in SCORE_CRITERIA},
+                "sentiment": {"type": "string", "enum": ["Позитивная", "Нейтральная", "Негативная"]},
+                "key_phrases": {"type": "array", "items": {"type": "string"}},
+                "recommendations": {"type": "array", "items": {"type": "string"}},
+                "segment_scores": {
+                    "type": "array",
+                    "maxItems": 8,
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "turn": {"type": "integer"},
+                            "speaker": {"type": "string", "enum": ["manager", "client"]},
+                            "criterion": {"type": "string", "enum": SCORE_CRITERIA},
+                            "score": {"type": "integer", "minimum": 0, "maximum": 5},
+                            "comment": {"type": "string"}
+                        },
+                        "required": ["turn", "speaker", "criterion", "score"]
+                    }
+                }
+            },
+            "required": SCORE_CRITERIA + ["sentiment", "key_phrases", "recommendations"]
+        }
+    }
+}
+
+def scoring_messages(transcription: str) -> list:
+    return [
+        {"role": "system", "content": SCORING_PROMPT},
+        {"role": "user", "content": transcription}
+    ]
+
+def _score_with_model(transcription: str, model: str, on_progress=None) -> dict:
+    """Один проход оценки: аргументы функции по схеме SCORING_TOOL, temperature=0"""
+    scanner = JsonObjectScanner()
+    for delta in stream_tool_arguments(
+        scoring_messages(transcription),
+        model,
+        SCORING_TOOL,
+        temperature=0,
+        max_tokens=1000
+    ):
+        closed = scanner.feed(delta)
+        if on_progress:
+            on_progress(scanner.text)
+        if closed:
+            break
+    return finish_analysis(scanner.value(), model)
+
+def finish_analysis(analysis: dict, model: str) -> dict:
+    """Привести аргументы submit_call_score к виду анализа: оценки 0-5, итог, модель"""
+    scores = {name: min(max(int(analysis.get(name, 0)), 0), 5) for name in SCORE_CRITERIA}
+    analysis.update(scores)
+    analysis["scores"] = scores
+    analysis["total_score"] = sum(scores.values())
+    analysis["model"] = model
+    return analysis
+
+def is_borderline(total: int) -> bool:
+    """Итог рядом с порогами 14/18, где ошибка быстрой модели меняет вердикт"""
+    return any(abs(total - threshold) <= SCORING_BORDER_MARGIN for threshold in SCORING_THRESHOLDS)
+
+def _analyze(transcription: str, on_progress=None, segments: list = None) -> dict:
+    """Оценка звонка через GPT без вывода в интерфейс.
+    
+    Сначала SCORING_FAST_MODEL; если ответ не разобрался или итог пограничный,
+    оценку повторяет SCORING_STRONG_MODEL. Ответ читается потоком, on_progress(text)
+    получает накопленные аргументы. С сегментами Whisper модель получает очищенные
+    пронумерованные реплики (см. scoring_input) и оценивает отдельные из них.
+    """
+    key = analysis_cache_key(transcription, bool(segments))
+    cached = cache_get(key)
+    if cached is not None:
+        return cached
+    
+    analysis = _score_call(transcription, on_progress, segments)
+    cache_put(key, analysis)
+    return analysis
+
+def _score_call(transcription: str, on_progress=None, segments: list = None) -> dict:
+    """Оценка без кэша: быстрая модель, при сомнениях - сильная"""
+    prompt, turns = scoring_input(transcription, segments)
+    metrics = get_metrics()
+    metrics.inc("scoring_chars_total", len(transcription), type="transcript")
+    metrics.inc("scoring_chars_total", len(prompt), type="prompt")
+    try:
+        analysis = _score_with_model(prompt, SCORING_FAST_MODEL, on_progress)
+    except (ValueError, TypeError):
+        analysis = None
+    
+    if analysis is None or is_borderline(analysis["total_score"]):
+        analysis = _score_with_model(prompt, SCORING_STRONG_MODEL, on_progress)
+    return attach_turns(analysis, turns)
+
+def analyze_call(transcription: str, segments: list = None) -> dict:
+    """Анализ качества звонка"""
+    try:
+        st.info("🤖 Анализируем качество звонка...")
+        preview = st.empty()
+        shown_at = [0.0]
+        
+        def show_progress(text):
+            # Не чаще 5 раз в секунду, чтобы не забивать websocket
+            if time.time() - shown_at[0] > 0.2:
+                shown_at[0] = time.time()
+                preview.code(text[-600:], language="json")
+        
+        analysis = _analyze(transcription, on_progress=show_progress, segments=segments)
+        preview.empty()
+        st.success("✅ Анализ завершен!")
+        return analysis
+    except Exception as e:
+        st.error(f"❌ Ошибка: {str(e)}")
+        return {}
+
+# =====================
+# ПАКЕТНЫЙ АНАЛИЗ
+# =====================
+
+def process_call(item: dict) -> dict:
+    """Транскрибация и оценка одного звонка из пакета"""
+    started = time.time()
+    result = {
+        "name": item["name"],
+        "manager": item.get("manager", ""),
+        "deal_id": item.get("deal_id", ""),
+        "transcription": "",
+        "analysis": {},
+        "error": ""
+    }
+    
+    try:
+        # Аудио загружается лениво, уже внутри рабочего потока
+        audio = item["audio"]
+        audio_data = audio() if callable(audio) else audio
+        details = _transcribe_detailed(audio_data)
+        result["transcription"] = details["text"]
+        result["analysis"] = _analyze(details["text"], segments=details["segments"])
+        record_analysis(result["analysis"], result["transcription"], result["manager"], result["deal_id"])
+        index_transcript(result["transcription"])
+    except Exception as e:
+        result["error"] = str(e)
+    
+    result["elapsed"] = round(time.time() - started, 1)
+    return result
+
+def run_batch_analysis(items: list, max_workers: int = BATCH_MAX_WORKERS):
+    """Пакетный анализ на пуле потоков: результаты отдаются по мере готовности"""
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rubi-batch")
+    try:
+        futures = [pool.submit(process_call, item) for item in items]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # Если генератор закрыт досрочно, не ждем оставшиеся звонки
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def batch_items_from_bitrix(calls: list) -> list:
+    """Подготовить звонки Bitrix24 к пакетному анализу"""
+    items = []
+    for call in calls:
+        if not call.get("FILES"):
+            continue
+        items.append({
+            "name": call.get("SUBJECT") or f"Звонок {call.get('ID')}",
+            "manager": manager_name(call["RESPONSIBLE_ID"]) if call.get("RESPONSIBLE_ID") else "",
+            "deal_id": call.get("OWNER_ID", "") if str(call.get("OWNER_TYPE_ID")) == "2" else "",
+            "audio": lambda call=call: download_call_record(call)
+        })
+    return items
+
+# =====================
+# ПЕРЕОЦЕНКА АРХИВА
+# =====================
+
+RESCORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rescore_items (
+    run_id TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    status TEXT NOT NULL,
+    batch_id TEXT NOT NULL DEFAULT '',
+    error TEXT NOT NULL DEFAULT '',
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (run_id, ref)
+);
+CREATE INDEX IF NOT EXISTS idx_rescore_status ON rescore_items(run_id, status, batch_id);
+"""
+
+# pending - ждет быстрой модели, escalate - сильной, submitted - отправлен в пакете Batch API
+RESCORE_STATUSES = ("pending", "escalate", "submitted", "done", "error")
+BATCH_FINAL_STATUSES = {"completed", "expired", "failed", "cancelled"}
+
+def rescore_run_id() -> str:
+    """Прогон определяется рубрикой и моделями: повторный запуск с той же рубрикой продолжает его"""
+    return content_hash(
+        PROMPT_VERSION, SCORING_PROMPT, json.dumps(SCORING_TOOL, sort_keys=True),
+        SCORING_FAST_MODEL, SCORING_STRONG_MODEL
+    )[:16]
+
+def plan_rescore(run_id: str, retry_errors: bool = False) -> dict:
+    """Поставить в прогон транскрипты из истории, которые есть в архиве"""
+    with _db("history.sqlite", HISTORY_SCHEMA) as conn:
+        refs = [ref for (ref,) in conn.execute("SELECT DISTINCT transcript_ref FROM analyses WHERE transcript_ref != ''")]
+    index = _read_index()
+    archived = set(index["key"].tolist()) if index is not None else set()
+    found = [ref for ref in refs if int.from_bytes(bytes.fromhex(ref)[:8], "little") in archived]
+    
+    now = time.time()
+    with _db("rescore.sqlite", RESCORE_SCHEMA) as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO rescore_items (run_id, ref, status, updated_at) VALUES (?, ?, 'pending', ?)",
+            [(run_id, ref, now) for ref in found]
+        )
+        if retry_errors:
+            conn.execute("UPDATE rescore_items SET status = 'pending', error = '' WHERE run_id = ? AND status = 'error'", (run_id,))
+    return {"history": len(refs), "not_archived": len(refs) - len(found)}
+
+def rescore_progress(run_id: str) -> dict:
+    """Число транскриптов прогона по статусам"""
+    with _db("rescore.sqlite", RESCORE_SCHEMA) as conn:
+        counts = dict(conn.execute(
+            "SELECT status, COUNT(*) FROM rescore_items WHERE run_id = ? GROUP BY status", (run_id,)
+        ).fetchall())
+    return {status: counts.get(status, 0) for status in RESCORE_STATUSES}
+
+def _rescore_todo(run_id: str, status: str, limit: int) -> list:
+    with _db("rescore.sqlite", RESCORE_SCHEMA) as conn:
+        return [ref for (ref,) in conn.execute(
+            "SELECT ref FROM rescore_items WHERE run_id = ? AND status = ? ORDER BY ref LIMIT ?", (run_id, status, limit)
+        )]
+
+def _set_rescore_status(conn: sqlite3.Connection, run_id: str, items: list, status: str, batch_id: str = ""):
+    """items - [(ref, ошибка), ...]"""
+    now = time.time()
+    conn.executemany(
+        "UPDATE rescore_items SET status = ?, batch_id = ?, error = ?, updated_at = ? WHERE run_id = ? AND ref = ?",
+        [(status, batch_id, error, now, run_id, ref) for ref, error in items]
+    )
+
+def save_rescored(run_id: str, scored: list):
+    """Записать результаты [(ref, модель, анализ или None, ошибка), ...] в историю и отметить в прогоне.
+    
+    Пограничный итог или неразобранный ответ быстрой модели уходит на сильную (escalate),
+    как в _analyze.
+    """
+    done, escalate, failed = [], [], []
+    with _db("history.sqlite", HISTORY_SCHEMA) as conn:
+        for ref, model, analysis, error in scored:
+            weak = model != SCORING_STRONG_MODEL
+            if analysis is None and not error and weak:
+                escalate.append((ref, ""))
+            elif analysis is None:
+                failed.append((ref, error or "не удалось разобрать ответ модели"))
+            elif weak and is_borderline(analysis["total_score"]):
+                escalate.append((ref, ""))
+            else:
+                update_analyses(conn, ref, analysis)
+                done.append((ref, ""))
+    with _db("rescore.sqlite", RESCORE_SCHEMA) as conn:
+        _set_rescore_status(conn, run_id, done, "done")
+        _set_rescore_status(conn, run_id, escalate, "escalate")
+        _set_rescore_status(conn, run_id, failed, "error")
+
+def finish_rescore():
+    """После записи оценок: пересчитать агрегаты истории и сбросить кэши дашбордов"""
+    rebuild_history_stats()
+    with _db("bitrix.sqlite", SYNC_SCHEMA) as conn:
+        _touch_data_version(conn)
+
+def rescore_concurrent(run_id: str, workers: int = BATCH_MAX_WORKERS, progress=None):
+    """Переоценка параллельными запросами через общий лимитер OpenAI (полная цена, без ожидания пакета)"""
+    def score(ref, status):
+        model = SCORING_STRONG_MODEL if status == "escalate" else SCORING_FAST_MODEL
+        transcript = load_transcript(ref)
+        if transcript is None:
+            return ref, model, None, "транскрипт не найден в архиве"
+        try:
+            if status == "escalate":
+                prompt, turns = scoring_input(transcript["text"], transcript.get("segments"))
+                return ref, model, attach_turns(_score_with_model(prompt, model), turns), ""
+            analysis = _score_call(transcript["text"], segments=transcript.get("segments"))
+            return ref, analysis["model"], analysis, ""
+        except Exception as e:
+            return ref, model, None, str(e) or type(e).__name__
+    
+    # Контрольная точка - каждая порция: после обрыва прогон продолжается с первой незаписанной
+    chunk = max(workers * 8, 32)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rubi-rescore") as pool:
+        for status in ("escalate", "pending"):
+            while True:
+                refs = _rescore_todo(run_id, status, chunk)
+                if not refs:
+                    break
+                save_rescored(run_id, list(pool.map(lambda ref: score(ref, status), refs)))
+                if progress:
+                    progress(rescore_progress(run_id))
+    finish_rescore()
+
+def _batch_request(ref: str, transcript: dict, model: str) -> dict:
+    """Строка JSONL для Batch API: тот же запрос, что и в _score_call, без потока"""
+    prompt, _ = scoring_input(transcript["text"], transcript.get("segments"))
+    return {
+        "custom_id": ref,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": model,
+            "messages": scoring_messages(prompt),
+            "tools": [SCORING_TOOL],
+            "tool_choice": {"type": "function", "function": {"name": SCORING_TOOL["function"]["name"]}},
+            "temperature": 0,
+            "max_tokens": 1000
+        }
+    }
+
+def submit_rescore_batch(run_id: str, status: str, model: str, limit: int = RESCORE_BATCH_SIZE) -> int:
+    """Отправить следующую порцию в Batch API; вернуть число взятых транскриптов (0 - очередь пуста)"""
+    refs = _rescore_todo(run_id, status, limit)
+    if not refs:
+        return 0
+    
+    # Файл пишется построчно: транскрипты читаются из архива по одному
+    os.makedirs(os.path.join(DATA_DIR, "rescore"), exist_ok=True)
+    path = os.path.join(DATA_DIR, "rescore", f"{run_id}-{uuid.uuid4().hex}.jsonl")
+    written, missing = [], []
+    with open(path, "w", encoding="utf-8") as out:
+        for ref in refs:
+            transcript = load_transcript(ref)
+            if transcript is None:
+                missing.append((ref, "транскрипт не найден в архиве"))
+                continue
+            out.write(json.dumps(_batch_request(ref, transcript, model), ensure_ascii=False) + "\n")
+            written.append((ref, ""))
+    
+    try:
+        batch_id = ""
+        if written:
+            client = get_openai_client()
+            with span("openai.batch_submit", model=model):
+                # Путь, а не открытый файл: при повторе запроса SDK перечитает его с начала
+                uploaded = call_with_retry("openai", client.files.create, file=Path(path), purpose="batch", idempotent=False)
+                batch = call_with_retry(
+                    "openai",
+                    client.batches.create,
+                    input_file_id=uploaded.id,
+                    endpoint="/v1/chat/completions",
+                    completion_window="24h",
+                    metadata={"run_id": run_id, "model": model},
+                    idempotent=False
+                )
+            batch_id = batch.id
+    finally:
+        os.remove(path)
+    
+    with _db("rescore.sqlite", RESCORE_SCHEMA) as conn:
+        _set_rescore_status(conn, run_id, written, "submitted", batch_id)
+        _set_rescore_status(conn, run_id, missing, "error")
+    return len(refs)
+
+def _parse_batch_line(item: dict, model: str) -> tuple:
+    """(анализ или None, ошибка) из строки результата Batch API"""
+    response = item.get("response") or {}
+    body = response.get("body") or {}
+    if item.get("error") or response.get("status_code") != 200:
+        error = item.get("error") or body.get("error") or {}
+        return None, str(error.get("message", "") if isinstance(error, dict) else error) or f"HTTP {response.get('status_code')}"
+    try:
+        arguments = body["choices"][0]["message"]["tool_calls"][0]["function"]["arguments"]
+        analysis = finish_analysis(json.loads(arguments), model)
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None, ""
+    # Оценки реплик ссылаются на номера: реплики восстанавливаются из архивного транскрипта
+    transcript = load_transcript(item["custom_id"]) if analysis.get("segment_scores") else None
+    turns = scoring_input(transcript["text"], transcript.get("segments"))[1] if transcript else []
+    return attach_turns(analysis, turns), ""
+
+def collect_rescore_batch(run_id: str, batch_id: str) -> str:
+    """Забрать результаты пакета, если он завершен; вернуть статус пакета"""
+    client = get_openai_client()
+    batch = call_with_retry("openai", client.batches.retrieve, batch_id)
+    if batch.status not in BATCH_FINAL_STATUSES:
+        return batch.status
+    
+    model = (batch.metadata or {}).get("model", SCORING_FAST_MODEL)
+    scored = []
+    with span("openai.batch", model=model) as record:
+        prompt_tokens = completion_tokens = 0
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = call_with_retry("openai", client.files.content, file_id)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                usage = ((item.get("response") or {}).get("body") or {}).get("usage") or {}
+                prompt_tokens += usage.get("prompt_tokens", 0)
+                completion_tokens += usage.get("completion_tokens", 0)
+                scored.append((item["custom_id"], model, *_parse_batch_line(item, model)))
+        record_usage(record, prompt_tokens, completion_tokens, batch=True)
+    save_rescored(run_id, scored)
+    
+    # Без ответа остались запросы пакета, который истек или отменен: они снова идут в очередь.
+    # Пакет, не прошедший проверку (failed), повторять бессмысленно - кроме отказа по лимиту
+    # токенов в очереди: он пройдет, когда завершатся пакеты, отправленные раньше.
+    errors = getattr(batch.errors, "data", None) or []
+    over_limit = any(getattr(e, "code", "") == "token_limit_exceeded" for e in errors)
+    with _db("rescore.sqlite", RESCORE_SCHEMA) as conn:
+        left = [ref for (ref,) in conn.execute(
+            "SELECT ref FROM rescore_items WHERE run_id = ? AND status = 'submitted' AND batch_id = ?", (run_id, batch_id)
+        )]
+        if batch.status == "failed" and not over_limit:
+            message = "; ".join(str(getattr(e, "message", e)) for e in errors) or "пакет отклонен"
+            _set_rescore_status(conn, run_id, [(ref, message) for ref in left], "error")
+        else:
+            requeue = "escalate" if model == SCORING_STRONG_MODEL and model != SCORING_FAST_MODEL else "pending"
+            _set_rescore_status(conn, run_id, [(ref, "") for ref in left], requeue)
+    return batch.status
+
+def _rescore_batches_in_flight(run_id: str) -> list:
+    with _db("rescore.sqlite", RESCORE_SCHEMA) as conn:
+        return [batch_id for (batch_id,) in conn.execute(
+            "SELECT DISTINCT batch_id FROM rescore_items WHERE run_id = ? AND status = 'submitted'", (run_id,)
+        )]
+
+def rescore_with_batch_api(run_id: str, batch_size: int = RESCORE_BATCH_SIZE, poll_seconds: float = RESCORE_POLL_SECONDS,
+                           max_batches: int = RESCORE_MAX_BATCHES, progress=None):
+    """Переоценка через Batch API (вдвое дешевле, результат в пределах 24 часов).
+    
+    В обработке одновременно не больше max_batches пакетов: OpenAI отклоняет пакеты
+    сверх лимита токенов в очереди. Новый пакет отправляется, когда завершился
+    предыдущий. batch_id хранится в rescore.sqlite, поэтому после обрыва процесса
+    отправленные пакеты забираются, а не отправляются заново.
+    """
+    while True:
+        in_flight = len(_rescore_batches_in_flight(run_id))
+        for status, model in (("pending", SCORING_FAST_MODEL), ("escalate", SCORING_STRONG_MODEL)):
+            while in_flight < max_batches and submit_rescore_batch(run_id, status, model, batch_size):
+                in_flight += 1
+        
+        batch_ids = _rescore_batches_in_flight(run_id)
+        if not batch_ids:
+            break
+        
+        statuses = [collect_rescore_batch(run_id, batch_id) for batch_id in batch_ids]
+        if progress:
+            progress(rescore_progress(run_id))
+        # Пауза, если ни один пакет не принес результатов (в том числе отказ по лимиту очереди)
+        if "completed" not in statuses:
+            time.sleep(poll_seconds)
+    finish_rescore()
+
+# =====================
+# ФОНОВЫЕ ЗАДАЧИ
+# =====================
+
+JOBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    progress TEXT NOT NULL DEFAULT '',
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);
+CREATE TABLE IF NOT EXISTS job_items (
+    job_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    item TEXT NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+"""
+
+JOB_STATUSES = {
+    "queued": "⏳ В очереди",
+    "running": "⚙️ Выполняется",
+    "done": "✅ Готово",
+    "error": "❌ Ошибка",
+}
+
+@st.cache_resource
+def get_job_executor() -> ThreadPoolExecutor:
+    """Исполнитель фоновых задач: один на процесс, переживает rerun скрипта.
+    
+    При старте возвращает в очередь задачи, прерванные остановкой процесса.
+    """
+    executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="rubi-job")
+    with _db("jobs.sqlite", JOBS_SCHEMA) as conn:
+        conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+        pending = [job_id for (job_id,) in conn.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY id")]
+    for job_id in pending:
+        executor.submit(_run_job, job_id)
+    return executor
+
+def _update_job(job_id: int, **fields):
+    fields["updated_at"] = time.time()
+    with _db("jobs.sqlite", JOBS_SCHEMA) as conn:
+        conn.execute(
+            f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?",
+            [*fields.values(), job_id]
+        )
+
+def submit_job(kind: str, payload: dict) -> int:
+    """Поставить задачу в очередь и вернуть ее id"""
+    # Исполнитель создается до вставки: иначе он подхватил бы новую задачу из базы еще раз
+    executor = get_job_executor()
+    now = time.time()
+    with _db("jobs.sqlite", JOBS_SCHEMA) as conn:
+        job_id = conn.execute(
+            "INSERT INTO jobs (kind, status, payload, created_at, updated_at) VALUES (?, 'queued', ?, ?, ?)",
+            (kind, json.dumps(payload, ensure_ascii=False), now, now)
+        ).lastrowid
+    executor.submit(_run_job, job_id)
+    return job_id
+
+def get_job(job_id: int) -> dict:
+    """Статус, прогресс и результат задачи"""
+    with _db("jobs.sqlite", JOBS_SCHEMA) as conn:
+        row = conn.execute(
+            "SELECT id, kind, status, payload, progress, result, error, created_at, updated_at FROM jobs WHERE id = ?",
+            (job_id,)
+        ).fetchone()
+    if row is None:
+        return {}
+    return {
+        "id": row[0],
+        "kind": row[1],
+        "status": row[2],
+        "payload": json.loads(row[3]),
+        "progress": row[4],
+        "result": json.loads(row[5]) if row[5] else None,
+        "error": row[6],
+        "created_at": datetime.fromtimestamp(row[7]),
+        "updated_at": datetime.fromtimestamp(row[8])
+    }
+
+def get_job_items(job_id: int) -> list:
+    """Готовые элементы задачи в порядке завершения"""
+    with _db("jobs.sqlite", JOBS_SCHEMA) as conn:
+        rows = conn.execute("SELECT item FROM job_items WHERE job_id = ? ORDER BY seq", (job_id,)).fetchall()
+    return [json.loads(item) for (item,) in rows]
+
+def list_jobs(limit: int = 10) -> list:
+    """Последние задачи"""
+    with _db("jobs.sqlite", JOBS_SCHEMA) as conn:
+        ids = [job_id for (job_id,) in conn.execute("SELECT id FROM jobs ORDER BY id DESC LIMIT ?", (limit,))]
+    return [get_job(job_id) for job_id in ids]
+
+def _run_job(job_id: int):
+    """Выполнение задачи в потоке исполнителя; статус и результат пишутся в таблицу jobs"""
+    with _db("jobs.sqlite", JOBS_SCHEMA) as conn:
+        # Задачу забирает ровно один поток, даже если она попала в исполнитель дважды
+        claimed = conn.execute(
+            "UPDATE jobs SET status = 'running', progress = '', updated_at = ? WHERE id = ? AND status = 'queued'",
+            (time.time(), job_id)
+        ).rowcount
+        if not claimed:
+            return
+        # Задача, прерванная остановкой процесса, выполняется заново с начала
+        conn.execute("DELETE FROM job_items WHERE job_id = ?", (job_id,))
+    job = get_job(job_id)
+    
+    reported_at = [0.0]
+    seq = [0]
+    
+    def progress(text, item=None):
+        # Готовые элементы пишутся сразу, чтобы их было видно до конца задачи
+        if item is not None:
+            seq[0] += 1
+            with _db("jobs.sqlite", JOBS_SCHEMA) as conn:
+                conn.execute(
+                    "INSERT INTO job_items (job_id, seq, item) VALUES (?, ?, ?)",
+                    (job_id, seq[0], json.dumps(item, ensure_ascii=False))
+                )
+        # Прогресс пишется в базу не чаще раза в полсекунды
+        if time.time() - reported_at[0] > 0.5:
+            reported_at[0] = time.time()
+            _update_job(job_id, progress=text)
+    
+    try:
+        result = JOB_HANDLERS[job["kind"]](job["payload"], progress)
+        _update_job(job_id, status="done", progress="", result=json.dumps(result, ensure_ascii=False))
+    except Exception as e:
+        _update_job(job_id, status="error", error=str(e))
+
+def save_job_audio(fileobj) -> str:
+    """Скопировать загруженный файл на диск блоками, вернуть путь"""
+    jobs_dir = os.path.join(DATA_DIR, "jobs")
+    os.makedirs(jobs_dir, exist_ok=True)
+    path = os.path.join(jobs_dir, f"{uuid.uuid4().hex}.audio")
+    fileobj.seek(0)
+    with open(path, "wb") as out:
+        shutil.copyfileobj(fileobj, out, 1024 * 1024)
+    return path
+
+def _run_analysis_job(payload: dict, progress) -> dict:
+    """Задача analyze_call: транскрибация, оценка и запись в историю"""
+    progress("🎙️ Транскрибируем звонок...")
+    try:
+        with open(payload["audio_path"], "rb") as audio:
+            details = _transcribe_detailed(audio)
+        analysis = _analyze(
+            details["text"],
+            lambda text: progress(f"🤖 Анализируем качество звонка... ({len(text)} симв.)"),
+            details["segments"]
+        )
+        record_analysis(analysis, details["text"], payload["manager"], payload["deal_id"], payload["client"])
+        index_transcript(details["text"])
+    finally:
+        # Копия загрузки удаляется, когда задача завершилась (успехом или ошибкой - такие
+        # не повторяются). После остановки процесса посреди задачи файл остается на диске
+        # для задачи, которую get_job_executor вернет в очередь.
+        if os.path.exists(payload["audio_path"]):
+            os.remove(payload["audio_path"])
+    return {"transcription": details["text"], "segments": details["segments"], "analysis": analysis}
+
+def _read_audio(path: str) -> bytes:
+    with open(path, "rb") as audio:
+        return audio.read()
+
+def _run_batch_job(payload: dict, progress) -> dict:
+    """Задача batch_analysis: файлы с диска и звонки Bitrix24 на пуле потоков"""
+    items = [
+        {"name": f["name"], "manager": f["manager"], "deal_id": "", "audio": lambda path=f["audio_path"]: _read_audio(path)}
+        for f in payload["files"]
+    ] + batch_items_from_bitrix(payload["calls"])
+    done = 0
+    try:
+        for result in run_batch_analysis(items, max_workers=payload["workers"]):
+            done += 1
+            progress(f"{done}/{len(items)}: {result['name']}", item=result)
+    finally:
+        for f in payload["files"]:
+            if os.path.exists(f["audio_path"]):
+                os.remove(f["audio_path"])
+    # Сами результаты лежат в job_items: get_job_items(job_id)
+    return {"count": done}
+
+JOB_HANDLERS = {
+    "analyze_call": _run_analysis_job,
+    "batch_analysis": _run_batch_job,
+}
+
+# =====================
+# КОНТЕКСТ AI АССИСТЕНТА
+# =====================
+
+ASSISTANT_PROMPT = "Ты AI ассистент отдела продаж RUBI CHAT PRO. Отвечай по-русски, кратко и по делу."
+
+@st.cache_resource
+def _token_encoding():
+    """Кодировщик tiktoken или None, если пакет не установлен"""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    return tiktoken.get_encoding("cl100k_base")
+
+def count_tokens(text: str) -> int:
+    """Число токенов: tiktoken, если установлен, иначе оценка ~3 символа на токен"""
+    encoding = _token_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return len(text) // 3 + 1
+
+def _message_tokens(message: dict) -> int:
+    # 4 токена - служебная разметка сообщения
+    return count_tokens(message["content"]) + 4
+
+def _summarize_chat(summary: str, messages: list) -> str:
+    """Дописать в резюме разговора реплики, выпадающие из окна"""
+    dialog = "\n".join(
+        f"{'Пользователь' if m['role'] == 'user' else 'Ассистент'}: {m['content']}" for m in messages
+    )
+    with span("openai.chat", model=SCORING_FAST_MODEL) as record:
+        response = call_with_retry(
+            "openai",
+            get_openai_client().chat.completions.create,
+            model=SCORING_FAST_MODEL,
+            messages=[{
+                "role": "user",
+                "content": f"""Обнови краткое резюме разговора: факты, договоренности, открытые вопросы.
+Не длиннее 150 слов.
+
+Текущее резюме:
+{summary or "(пусто)"}
+
+Новые реплики:
+{dialog}"""
+            }],
+            temperature=0,
+            max_tokens=ASSISTANT_SUMMARY_TOKENS
+        )
+        record_usage(record, response.usage.prompt_tokens, response.usage.completion_tokens)
+    return response.choices[0].message.content.strip()
+
+def build_chat_context(history: list, summary: str, summarized: int, budget: int = ASSISTANT_CONTEXT_TOKENS) -> tuple:
+    """Сообщения для запроса в пределах бюджета токенов.
+    
+    history[summarized:] - реплики, еще не свернутые в резюме. В запрос идут
+    системный промпт, резюме и скользящее окно последних реплик; если окно не
+    помещается, старые реплики сворачиваются в резюме с запасом (окно сжимается
+    до 60% бюджета), чтобы не вызывать суммаризацию на каждом сообщении.
+    
+    Возвращает (messages, summary, summarized).
+    """
+    window_budget = budget - ASSISTANT_SUMMARY_TOKENS - count_tokens(ASSISTANT_PROMPT)
+    
+    def window_start(limit):
+        used = 0
+        start = len(history)
+        while start > summarized and used + _message_tokens(history[start - 1]) <= limit:
+            start -= 1
+            used += _message_tokens(history[start])
+        # Последняя реплика пользователя отправляется всегда
+        return min(start, len(history) - 1)
+    
+    start = window_start(window_budget)
+    if start > summarized:
+        start = window_start(int(window_budget * 0.6))
+        summary = _summarize_chat(summary, history[summarized:start])
+        summarized = start
+    
+    messages = [{"role": "system", "content": ASSISTANT_PROMPT}]
+    if summary:
+        messages.append({"role": "system", "content": f"Краткое содержание предыдущего разговора:\n{summary}"})
+    messages += [{"role": m["role"], "content": m["content"]} for m in history[summarized:]]
+    return messages, summary, summarized
 
 # =====================
-# ФУНКЦИИ BITRIX24
+# ПОИСК ПО ДАННЫМ CRM
 # =====================
 
-def get_calls_from_bitrix() -> list:
-    """Получить звонки из Bitrix24"""
-    if not BITRIX24_WEBHOOK:
-        return []
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rows (
+    row INTEGER PRIMARY KEY,
+    doc_id TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS docs (
+    doc_id TEXT PRIMARY KEY,
+    row INTEGER NOT NULL,
+    hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+TRANSCRIPT_PIECE_CHARS = 2000
+
+def _vectors_path() -> str:
+    return os.path.join(DATA_DIR, "index.f32")
+
+def _index_meta(conn: sqlite3.Connection, key: str, default: str = "") -> str:
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+@st.cache_resource
+def _index_lock() -> threading.Lock:
+    return threading.Lock()
+
+def _embed(texts: list) -> np.ndarray:
+    """Нормированные эмбеддинги пачками по 100 текстов"""
+    vectors = []
+    for i in range(0, len(texts), 100):
+        with span("openai.embeddings", model=EMBEDDING_MODEL) as record:
+            response = call_with_retry(
+                "openai",
+                get_openai_client().embeddings.create,
+                model=EMBEDDING_MODEL,
+                input=texts[i:i + 100],
+                dimensions=EMBEDDING_DIM
+            )
+            record_usage(record, response.usage.prompt_tokens)
+        vectors.extend(item.embedding for item in response.data)
+    matrix = np.asarray(vectors, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+def index_documents(docs: list) -> int:
+    """Инкрементально добавить документы [(doc_id, text), ...] в индекс.
     
-    try:
-        url = f"{BITRIX24_WEBHOOK}crm.activity.list.json"
-        params = {
-            "filter[SUBJECT]": "Звонок",
-            "filter[TYPE_ID]": "1",
-            "limit": 50
-        }
+    Неизмененные документы (тот же хэш текста) пропускаются. Векторы дописываются
+    в конец файла index.f32, старая строка измененного документа просто
+    перестает быть живой. Возвращает число проиндексированных документов.
+    """
+    with _index_lock():
+        with _db("index.sqlite", INDEX_SCHEMA) as conn:
+            known = dict(conn.execute("SELECT doc_id, hash FROM docs"))
+        fresh = [
+            (doc_id, text, digest)
+            for doc_id, text in docs
+            for digest in [content_hash(text)]
+            if known.get(doc_id) != digest
+        ]
+        if not fresh:
+            return 0
         
-        response = requests.get(url, params=params, timeout=10)
-        if response.status_code == 200:
-            return response.json().get("result", [])
-        return []
-    except:
-        return []
+        vectors = _embed([text for _, text, _ in fresh])
+        os.makedirs(DATA_DIR, exist_ok=True)
+        with open(_vectors_path(), "ab") as out:
+            first_row = out.tell() // (4 * EMBEDDING_DIM)
+            out.write(vectors.tobytes())
+        
+        with _db("index.sqlite", INDEX_SCHEMA) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO rows VALUES (?, ?, ?)",
+                [(first_row + i, doc_id, text) for i, (doc_id, text, _) in enumerate(fresh)]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO docs VALUES (?, ?, ?)",
+                [(doc_id, first_row + i, digest) for i, (doc_id, _, digest) in enumerate(fresh)]
+            )
+            generation = int(_index_meta(conn, "generation", "0")) + 1
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (str(generation),))
+        return len(fresh)
 
-def get_deal_info(deal_id: str) -> dict:
-    """Получить информацию о сделке"""
-    if not BITRIX24_WEBHOOK:
-        return {}
-    
-    try:
-        url = f"{BITRIX24_WEBHOOK}crm.deal.get.json"
-        response = requests.get(url, params={"id": deal_id}, timeout=10)
-        if response.status_code == 200:
-            return response.json().get("result", {})
-        return {}
-    except:
-        return {}
+def _index_vectors() -> np.ndarray:
+    """Матрица векторов через memmap: после дописывания не перечитывается в память целиком"""
+    path = _vectors_path()
+    rows = os.path.getsize(path) // (4 * EMBEDDING_DIM) if os.path.exists(path) else 0
+    if not rows:
+        return np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+    return np.memmap(path, dtype=np.float32, mode="r", shape=(rows, EMBEDDING_DIM))
 
-def save_analysis_to_bitrix(deal_id: str, analysis: dict):
-    """Сохранить анализ в Bitrix24"""
-    if not BITRIX24_WEBHOOK:
-        return False
+@st.cache_resource(max_entries=1)
+def _load_live_rows(generation: str) -> np.ndarray:
+    """Номера живых строк индекса, один раз на поколение (векторы не копируются)"""
+    with _db("index.sqlite", INDEX_SCHEMA) as conn:
+        return np.fromiter((row for (row,) in conn.execute("SELECT row FROM docs")), dtype=np.int64)
+
+def search_index(query: str, k: int = RETRIEVAL_TOP_K) -> list:
+    """Top-k документов по косинусной близости: [(score, doc_id, text), ...]"""
+    with _db("index.sqlite", INDEX_SCHEMA) as conn:
+        generation = _index_meta(conn, "generation", "0")
+    vectors = _index_vectors()
+    live = np.zeros(len(vectors), dtype=bool)
+    live_rows = _load_live_rows(generation)
+    live[live_rows[live_rows < len(vectors)]] = True
+    if not live.any():
+        return []
     
-    try:
-        note_text = f"""📊 АНАЛИЗ КАЧЕСТВА ЗВОНКА - RUBI CHAT PRO v4.0
+    scores = vectors @ _embed([query])[0]
+    scores[~live] = -np.inf
+    k = min(k, int(live.sum()))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    
+    with _db("index.sqlite", INDEX_SCHEMA) as conn:
+        docs = {
+            row: (doc_id, text)
+            for row, doc_id, text in conn.execute(
+                f"SELECT row, doc_id, text FROM rows WHERE row IN ({','.join('?' * len(top))})",
+                [int(row) for row in top]
+            )
+        }
+    return [(float(scores[row]), *docs[int(row)]) for row in top]
 
-⭐ Оценка: {analysis.get('total_score', 0)}/20
+def index_transcript(transcription: str):
+    """Проиндексировать транскрипт кусками по TRANSCRIPT_PIECE_CHARS символов"""
+    ref = content_hash(transcription)
+    index_documents([
+        (f"transcript:{ref}:{i // TRANSCRIPT_PIECE_CHARS}", transcription[i:i + TRANSCRIPT_PIECE_CHARS])
+        for i in range(0, len(transcription), TRANSCRIPT_PIECE_CHARS)
+    ])
 
-Критерии:
-🎤 Вежливость: {analysis.get('scores', {}).get('politeness', 0)}/5
-👂 Выявление потребностей: {analysis.get('scores', {}).get('understanding', 0)}/5
-💼 Представление решения: {analysis.get('scores', {}).get('solution', 0)}/5
-✍️ Закрытие сделки: {analysis.get('scores', {}).get('closing', 0)}/5
+def _deal_documents(version: str) -> list:
+    deals = load_deals_frame(version)
+    texts = (
+        "Сделка " + deals["title"] + ". Менеджер: " + deals["manager"].astype(str)
+        + ". Сумма: " + deals["amount_fmt"] + ". Стадия: " + deals["stage"].astype(str)
+        + ". Вероятность: " + deals["probability"].astype(str) + "%. Следующее действие: "
+        + deals["next_action"]
+    )
+    return list(zip("deal:" + deals["id"].astype(str), texts))
 
-😊 Тональность: {analysis.get('sentiment', 'N/A')}
+def _analysis_documents(after_id: int) -> list:
+    with _db("history.sqlite", HISTORY_SCHEMA) as conn:
+        rows = conn.execute(
+            "SELECT id, created_at, manager, deal_id, client, analysis FROM analyses WHERE id > ? ORDER BY id",
+            (after_id,)
+        ).fetchall()
+    docs = []
+    for analysis_id, created_at, manager, deal_id, client_name, raw in rows:
+        analysis = json.loads(raw)
+        docs.append((
+            f"analysis:{analysis_id}",
+            f"Анализ звонка {datetime.fromtimestamp(created_at):%d.%m.%Y}. Менеджер: {manager}. "
+            f"Клиент: {client_name}. Сделка: {deal_id}. Оценка: {analysis.get('total_score', 0)}/20. "
+            f"Тональность: {analysis.get('sentiment', '')}. "
+            f"Ключевые фразы: {'; '.join(analysis.get('key_phrases', []))}. "
+            f"Рекомендации: {'; '.join(analysis.get('recommendations', []))}"
+        ))
+    return docs
 
-💡 Рекомендации:
-{chr(10).join(f"• {rec}" for rec in analysis.get('recommendations', []))}"""
-        
-        url = f"{BITRIX24_WEBHOOK}crm.activity.add.json"
-        data = {
-            "fields": {
-                "OWNER_ID": deal_id,
-                "OWNER_TYPE_ID": "2",
-                "TYPE_ID": "4",
-                "DESCRIPTION": note_text,
-                "SUBJECT": "🤖 АНАЛИЗ ЗВОНКА"
-            }
-        }
-        
-        response = requests.post(url, json=data, timeout=10)
-        return response.status_code == 200
-    except:
-        return False
+def _run_index_refresh_job(payload: dict, progress) -> dict:
+    """Задача index_refresh: дозаписать в индекс новые сделки и анализы"""
+    with _db("index.sqlite", INDEX_SCHEMA) as conn:
+        last_analysis = int(_index_meta(conn, "last_analysis_id", "0"))
+    
+    progress("🔎 Индексируем сделки...")
+    indexed = index_documents(_deal_documents(payload["version"]))
+    
+    progress("🔎 Индексируем анализы звонков...")
+    docs = _analysis_documents(last_analysis)
+    indexed += index_documents(docs)
+    
+    with _db("index.sqlite", INDEX_SCHEMA) as conn:
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('deals_version', ?)", (payload["version"],))
+        if docs:
+            conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('last_analysis_id', ?)",
+                (docs[-1][0].split(":")[1],)
+            )
+    return {"indexed": indexed}
+
+JOB_HANDLERS["index_refresh"] = _run_index_refresh_job
+
+def ensure_index_fresh():
+    """Поставить обновление индекса в фон, если сделки или история изменились"""
+    version = data_version()
+    with _db("index.sqlite", INDEX_SCHEMA) as conn:
+        deals_version = _index_meta(conn, "deals_version")
+        last_analysis = int(_index_meta(conn, "last_analysis_id", "0"))
+    with _db("history.sqlite", HISTORY_SCHEMA) as conn:
+        max_analysis = conn.execute("SELECT COALESCE(MAX(id), 0) FROM analyses").fetchone()[0]
+    if deals_version == version and max_analysis <= last_analysis:
+        return
+    
+    # Не чаще одной попытки в 5 минут после ошибки
+    with _db("jobs.sqlite", JOBS_SCHEMA) as conn:
+        busy = conn.execute(
+            """SELECT 1 FROM jobs WHERE kind = 'index_refresh'
+               AND (status IN ('queued', 'running') OR (status = 'error' AND updated_at > ?))""",
+            (time.time() - 300,)
+        ).fetchone()
+    if not busy:
+        submit_job("index_refresh", {"version": version})
+
+def crm_context(query: str) -> str:
+    """Фрагменты данных CRM, релевантные вопросу, для подстановки в промпт"""
+    hits = search_index(query)
+    if not hits:
+        return ""
+    return "Данные CRM (используй их при ответе, если они относятся к вопросу):\n" + "\n".join(
+        f"- {text[:500]}" for _, _, text in hits
+    )
 
 # =====================
-# ФУНКЦИИ АНАЛИЗА
+# ВХОДЯЩИЕ СОБЫТИЯ BITRIX24
 # =====================
 
-def transcribe_audio(audio_data: bytes) -> str:
-    """Транскрибация через Whisper"""
-    try:
-        audio_file = BytesIO(audio_data)
-        audio_file.name = "call.mp3"
-        
-        st.info("🎙️ Транскрибируем звонок...")
-        
-        transcript = client.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio_file,
-            language="ru"
-        )
-        
-        st.success("✅ Транскрибация завершена!")
-        return transcript.text
-    except Exception as e:
-        st.error(f"❌ Ошибка: {str(e)}")
-        return ""
+WEBHOOK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_calls (
+    activity_id INTEGER PRIMARY KEY,
+    job_id INTEGER NOT NULL,
+    queued_at REAL NOT NULL
+);
+"""
 
-def analyze_call(transcription: str) -> dict:
-    """Анализ качества звонка"""
-    try:
-        st.info("🤖 Анализируем качество звонка...")
-        
-        prompt = f"""Проанализируй телефонный звонок:
+WEBHOOK_EVENTS = {"ONCRMACTIVITYADD", "ONCRMACTIVITYUPDATE", "ONCRMDEALADD", "ONCRMDEALUPDATE"}
+WEBHOOK_MAX_BODY = 64 * 1024
 
-{transcription}
+def parse_bitrix_event(body: bytes) -> dict:
+    """Событие исходящего вебхука: form-urlencoded с ключами вида data[FIELDS][ID]"""
+    fields = dict(parse_qsl(body.decode("utf-8", "replace")))
+    return {
+        "event": fields.get("event", "").upper(),
+        "id": fields.get("data[FIELDS][ID]", ""),
+        "token": fields.get("auth[application_token]", "")
+    }
 
-Дай оценку (0-5 каждый):
-1. Вежливость
-2. Выявление потребностей
-3. Представление решения
-4. Закрытие сделки
+def is_call(activity: dict) -> bool:
+    """Дело подходит под CALL_FILTER"""
+    return all(str(activity.get(field, "")) == value for field, value in CALL_FILTER.items())
 
-Определи:
-- Тональность (Позитивная/Нейтральная/Негативная)
-- Ключевые фразы (3-5)
-- Рекомендации (2-3)
+def _touch_data_version(conn: sqlite3.Connection):
+    """Сменить версию данных дашбордов, не сдвигая high-water mark синхронизации"""
+    conn.execute("INSERT OR REPLACE INTO sync_state (entity, synced_at) VALUES ('webhook', ?)", (time.time(),))
 
-Ответ JSON:
-{{
-    "politeness": 0-5,
-    "understanding": 0-5,
-    "solution": 0-5,
-    "closing": 0-5,
-    "sentiment": "...",
-    "key_phrases": [...],
-    "recommendations": [...]
-}}"""
-        
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
-            max_tokens=1000
-        )
-        
-        response_text = response.choices[0].message.content
-        start_idx = response_text.find('{')
-        end_idx = response_text.rfind('}') + 1
-        
-        analysis = json.loads(response_text[start_idx:end_idx])
-        
-        total = sum([
-            analysis.get("politeness", 0),
-            analysis.get("understanding", 0),
-            analysis.get("solution", 0),
-            analysis.get("closing", 0)
-        ])
-        
-        analysis["total_score"] = total
-        analysis["scores"] = {
-            "politeness": analysis.get("politeness", 0),
-            "understanding": analysis.get("understanding", 0),
-            "solution": analysis.get("solution", 0),
-            "closing": analysis.get("closing", 0)
-        }
+def enqueue_call_analysis(call: dict) -> int:
+    """Поставить анализ звонка в очередь один раз на активность, вернуть id задачи (0 - уже в очереди).
+    
+    Звонок, анализ которого завершился ошибкой, ставится заново при следующем событии.
+    """
+    with _db("bitrix.sqlite", WEBHOOK_SCHEMA) as conn:
+        claimed = conn.execute(
+            "INSERT OR IGNORE INTO webhook_calls VALUES (?, 0, ?)", (int(call["ID"]), time.time())
+        ).rowcount
+        previous = conn.execute("SELECT job_id FROM webhook_calls WHERE activity_id = ?", (int(call["ID"]),)).fetchone()[0]
+    if not claimed and (not previous or get_job(previous).get("status") != "error"):
+        return 0
+    job_id = submit_job("analyze_bitrix_call", {
+        "name": call.get("SUBJECT") or f"Звонок {call['ID']}",
+        "manager": manager_name(call["RESPONSIBLE_ID"]) if call.get("RESPONSIBLE_ID") else "",
+        "activity_id": int(call["ID"])
+    })
+    with _db("bitrix.sqlite", WEBHOOK_SCHEMA) as conn:
+        conn.execute("UPDATE webhook_calls SET job_id = ? WHERE activity_id = ?", (job_id, int(call["ID"])))
+    return job_id
+
+def _run_bitrix_event_job(payload: dict, progress) -> dict:
+    """Задача bitrix_event: дочитать сущность, обновить локальное хранилище, поставить звонок в анализ"""
+    if payload["event"].startswith("ONCRMDEAL"):
+        deal = bitrix_call("crm.deal.get", {"id": payload["id"]})
+        with _db("bitrix.sqlite", SYNC_SCHEMA) as conn:
+            _upsert_deals(conn, [deal])
+            _touch_data_version(conn)
+        return {"deal_id": payload["id"]}
+    
+    activity = bitrix_call("crm.activity.get", {"id": payload["id"]})
+    if not activity or not is_call(activity):
+        return {"skipped": True}
+    with _db("bitrix.sqlite", SYNC_SCHEMA) as conn:
+        _upsert_activities(conn, [activity])
+        _touch_data_version(conn)
+    # Запись часто прикрепляется позже - ее принесет ONCRMACTIVITYUPDATE
+    if not activity.get("FILES"):
+        return {"activity_id": payload["id"], "job_id": 0}
+    return {"activity_id": payload["id"], "job_id": enqueue_call_analysis(activity)}
+
+def _run_bitrix_call_job(payload: dict, progress) -> dict:
+    """Задача analyze_bitrix_call: скачать запись, транскрибировать, оценить и записать в историю"""
+    with _db("bitrix.sqlite", SYNC_SCHEMA) as conn:
+        row = conn.execute("SELECT raw FROM activities WHERE id = ?", (payload["activity_id"],)).fetchone()
+    call = json.loads(row[0]) if row else bitrix_call("crm.activity.get", {"id": payload["activity_id"]})
+    
+    progress("🎙️ Транскрибируем звонок...")
+    items = batch_items_from_bitrix([call])
+    if not items:
+        raise ValueError(f"У звонка {payload['activity_id']} нет записи")
+    result = process_call(items[0])
+    if result["error"]:
+        raise RuntimeError(result["error"])
+    return {"transcription": result["transcription"], "analysis": result["analysis"]}
+
+JOB_HANDLERS["bitrix_event"] = _run_bitrix_event_job
+JOB_HANDLERS["analyze_bitrix_call"] = _run_bitrix_call_job
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    """Принимает событие и сразу отвечает 200: обработка идет фоновой задачей"""
+    
+    def do_POST(self):
+        if self.path.split("?", 1)[0] != WEBHOOK_PATH:
+            return self._reply(404)
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > WEBHOOK_MAX_BODY:
+            return self._reply(413)
         
-        st.success("✅ Анализ завершен!")
-        return analysis
-    except Exception as e:
-        st.error(f"❌ Ошибка: {str(e)}")
-        return {}
+        event = parse_bitrix_event(self.rfile.read(length))
+        if not hmac.compare_digest(event["token"], BITRIX24_APP_TOKEN):
+            return self._reply(403)
+        if event["event"] in WEBHOOK_EVENTS and event["id"].isdigit():
+            submit_job("bitrix_event", {
+                "name": f"{event['event']} #{event['id']}",
+                "event": event["event"],
+                "id": event["id"]
+            })
+        get_metrics().inc("webhook_events_total", event=event["event"] or "unknown")
+        self._reply(200)
+    
+    def _reply(self, status: int):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+    
+    def log_message(self, *args):
+        pass
+
+@st.cache_resource
+def start_webhook_server():
+    """HTTP-приемник событий Bitrix24: один на процесс, в фоновом потоке.
+    
+    Возвращает сервер или None, если RUBI_WEBHOOK_PORT не задан или занят либо нет
+    BITRIX24_APP_TOKEN: без него любой, кто достучится до порта, ставил бы платные анализы.
+    """
+    if not WEBHOOK_PORT or not BITRIX24_APP_TOKEN:
+        return None
+    try:
+        server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), _WebhookHandler)
+    except OSError:
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="rubi-webhook", daemon=True).start()
+    return server
 
 # =====================
 # АУТЕНТИФИКАЦИЯ
@@ -258,6 +3548,7 @@ def require_auth():
 # МОДУЛИ ПРИЛОЖЕНИЯ
 # =====================
 
+@traced
 def module_call_analysis():
     """Модуль 1: Оценка звонков"""
     st.markdown("# 🎙️ Оценка качества звонков")
@@ -267,12 +3558,20 @@ def module_call_analysis():
         st.markdown("### Загрузить аудиозапись")
     with col2:
         if st.button("🔄 Обновить список", use_container_width=True):
-            st.success("✅ Обновлено")
+            if not BITRIX24_WEBHOOK:
+                st.warning("⚠️ Bitrix24 не подключен")
+            else:
+                try:
+                    with st.spinner("⏳ Синхронизация с Bitrix24..."):
+                        synced = sync_bitrix()
+                    st.success(f"✅ Обновлено: звонков {synced['activities']}, сделок {synced['deals']}")
+                except (requests.RequestException, BitrixError, CircuitOpenError) as e:
+                    st.error(f"❌ Ошибка синхронизации: {str(e)}")
     
     st.markdown("---")
     
     # Вкладка 1: Загрузка и анализ
-    tab1, tab2, tab3 = st.tabs(["📥 Загрузка", "📊 История", "📈 Статистика"])
+    tab1, tab_batch, tab2, tab3 = st.tabs(["📥 Загрузка", "📦 Пакетный анализ", "📊 История", "📈 Статистика"])
     
     with tab1:
         col1, col2 = st.columns([2, 1])
@@ -291,74 +3590,332 @@ def module_call_analysis():
                 deal_id = st.text_input("ID сделки Bitrix24:", "123")
             
             if st.button("🚀 Начать анализ", use_container_width=True, type="primary"):
-                audio_data = uploaded_file.read()
-                
-                # Транскрибация
-                st.markdown("### 📝 Этап 1: Транскрибация")
-                transcription = transcribe_audio(audio_data)
-                
-                if transcription:
-                    st.text_area("Транскрибация:", transcription, height=100, disabled=True)
-                    
-                    # Анализ
-                    st.markdown("### 🎯 Этап 2: Анализ качества")
-                    analysis = analyze_call(transcription)
-                    
-                    if analysis:
-                        # Показать результаты
-                        col1, col2, col3, col4 = st.columns(4)
-                        with col1:
-                            st.metric("🎤 Вежливость", f"{analysis.get('scores', {}).get('politeness', 0)}/5")
-                        with col2:
-                            st.metric("👂 Понимание", f"{analysis.get('scores', {}).get('understanding', 0)}/5")
-                        with col3:
-                            st.metric("💼 Решение", f"{analysis.get('scores', {}).get('solution', 0)}/5")
-                        with col4:
-                            st.metric("✍️ Закрытие", f"{analysis.get('scores', {}).get('closing', 0)}/5")
-                        
-                        st.markdown("---")
-                        
-                        total = analysis.get("total_score", 0)
-                        if total >= 18:
-                            st.success(f"🟢 Оценка: {total}/20 (Отличный звонок)")
-                        elif total >= 14:
-                            st.warning(f"🟡 Оценка: {total}/20 (Хороший звонок)")
-                        else:
-                            st.error(f"🔴 Оценка: {total}/20 (Требует улучшения)")
-                        
-                        st.markdown("---")
-                        
-                        # Детали
-                        col1, col2 = st.columns(2)
-                        with col1:
-                            st.markdown("#### 😊 Тональность:")
-                            st.write(analysis.get("sentiment", "N/A"))
-                        with col2:
-                            st.markdown("#### 🔑 Ключевые фразы:")
-                            for phrase in analysis.get("key_phrases", [])[:3]:
-                                st.write(f"• {phrase}")
-                        
-                        st.markdown("#### 💡 Рекомендации:")
-                        for rec in analysis.get("recommendations", []):
-                            st.write(f"• {rec}")
-                        
-                        st.markdown("---")
-                        
-                        if st.button("💾 Сохранить в Bitrix24", use_container_width=True):
-                            success = save_analysis_to_bitrix(deal_id, analysis)
-                            if success:
-                                st.success("✅ Сохранено в Bitrix24!")
-                            else:
-                                st.info("ℹ️ Результаты готовы")
+                # Работа уходит в фоновую задачу и не прерывается при rerun
+                st.session_state.analysis_job = submit_job("analyze_call", {
+                    "audio_path": save_job_audio(uploaded_file),
+                    "name": uploaded_file.name,
+                    "manager": manager,
+                    "deal_id": deal_id,
+                    "client": client_name
+                })
+        
+        if st.session_state.get("analysis_job"):
+            render_job(st.session_state.analysis_job)
+        
+        with st.expander("🗂️ Фоновые задачи"):
+            for job in list_jobs():
+                st.write(
+                    f"#{job['id']} · {job['payload'].get('name', job['kind'])} · "
+                    f"{job['payload'].get('manager', '')} · {JOB_STATUSES[job['status']]}"
+                )
+    
+    with tab_batch:
+        render_batch_analysis()
     
     with tab2:
         st.markdown("### 📊 История анализированных звонков")
-        st.info("История будет сохраняться после каждого анализа")
+        render_history()
     
     with tab3:
         st.markdown("### 📈 Статистика по звонкам")
+        render_statistics()
+
+HISTORY_PAGE_SIZE = 20
+
+@traced
+def render_history():
+    """Вкладка истории: постраничный просмотр сохраненных анализов"""
+    col1, col2 = st.columns([2, 1])
+    with col1:
+        managers = dict.fromkeys([m["name"] for m in MANAGERS] + [s["manager"] for s in load_manager_stats()])
+        manager = st.selectbox("Менеджер:", ["Все"] + list(managers), key="history_manager")
+    with col2:
+        page = st.number_input("Страница:", min_value=1, value=1, step=1, key="history_page")
+    
+    rows = load_history(
+        "" if manager == "Все" else manager,
+        limit=HISTORY_PAGE_SIZE,
+        offset=(page - 1) * HISTORY_PAGE_SIZE
+    )
+    if not rows:
+        st.info("История будет сохраняться после каждого анализа")
+        return
+    
+    st.dataframe(
+        pd.DataFrame([
+            {
+                "🕒 Дата": r["created_at"].strftime("%d.%m.%Y %H:%M"),
+                "👤 Менеджер": r["manager"],
+                "🏢 Клиент": r["client"],
+                "🆔 Сделка": r["deal_id"],
+                "⭐ Оценка": f"{r['total_score']}/20",
+                "😊 Тональность": r["sentiment"]
+            }
+            for r in rows
+        ]),
+        use_container_width=True,
+        hide_index=True
+    )
+    
+    for r in rows:
+        with st.expander(f"{r['created_at'].strftime('%d.%m.%Y %H:%M')} · {r['manager']} · {r['total_score']}/20"):
+            st.markdown("#### 🔑 Ключевые фразы:")
+            for phrase in r["analysis"].get("key_phrases", []):
+                st.write(f"• {phrase}")
+            st.markdown("#### 💡 Рекомендации:")
+            for rec in r["analysis"].get("recommendations", []):
+                st.write(f"• {rec}")
+            
+            # Транскрипт и запись читаются из локального архива только при раскрытии кнопкой
+            if st.toggle("📝 Транскрипт и запись", key=f"history_transcript_{r['id']}"):
+                transcript = load_transcript(r["transcript_ref"]) if r["transcript_ref"] else None
+                if transcript is None:
+                    st.caption("Транскрипт не сохранен в архиве")
+                else:
+                    st.text(format_timestamped(transcript["segments"]) or transcript["text"])
+                    audio_path = find_archived_audio(transcript.get("audio", ""))
+                    if audio_path:
+                        st.audio(audio_path)
+
+@traced
+def render_statistics():
+    """Вкладка статистики: читает только накопленные агрегаты"""
+    stats = load_manager_stats()
+    if not stats:
         st.info("Статистика обновляется в реальном времени")
+        return
+    
+    total_calls = sum(m["calls"] for m in stats)
+    col1, col2 = st.columns(2)
+    with col1:
+        st.metric("📞 Проанализировано звонков", total_calls)
+    with col2:
+        st.metric("⭐ Средняя оценка", f"{sum(m['avg_score'] * m['calls'] for m in stats) / total_calls:.1f}/20")
+    
+    st.dataframe(
+        pd.DataFrame([
+            {
+                "👤 Менеджер": m["manager"],
+                "📞 Звонков": m["calls"],
+                "⭐ Средняя оценка": round(m["avg_score"], 1),
+                "🎤 Вежливость": round(m["avg_politeness"], 1),
+                "👂 Понимание": round(m["avg_understanding"], 1),
+                "💼 Решение": round(m["avg_solution"], 1),
+                "✍️ Закрытие": round(m["avg_closing"], 1),
+                "😊 Позитивных": f"{m['positive_share']:.0%}"
+            }
+            for m in stats
+        ]),
+        use_container_width=True,
+        hide_index=True
+    )
+    
+    daily = load_daily_stats()
+    if daily:
+        fig = px.line(
+            pd.DataFrame(daily),
+            x="day",
+            y="avg_score",
+            color="manager",
+            markers=True,
+            labels={"day": "День", "avg_score": "Средняя оценка", "manager": "Менеджер"},
+            title="Средняя оценка по дням"
+        )
+        st.plotly_chart(fig, use_container_width=True)
+
+_fragment = getattr(st, "fragment", None) or st.experimental_fragment
+
+@traced
+def render_job(job_id: int):
+    """Статус фоновой задачи анализа; пока она активна, фрагмент опрашивает базу сам"""
+    job = get_job(job_id)
+    active = bool(job) and job["status"] in ("queued", "running")
+    _fragment(run_every=JOB_POLL_SECONDS if active else None)(_render_job_body)(job_id, active)
+
+def _render_job_body(job_id: int, was_active: bool):
+    job = get_job(job_id)
+    if not job:
+        return
+    
+    if job["status"] in ("queued", "running"):
+        st.info(f"{JOB_STATUSES[job['status']]} · {job['payload']['name']} {job['progress']}")
+        st.caption("Можно переключаться между модулями - анализ продолжится в фоне")
+        return
+    if was_active:
+        # Задача завершилась - полный rerun выключает опрос
+        st.rerun()
+    if job["status"] == "error":
+        st.error(f"❌ Ошибка: {job['error']}")
+        return
+    
+    result = job["result"]
+    st.markdown("### 📝 Этап 1: Транскрибация")
+    st.text_area("Транскрибация:", result["transcription"], height=100, disabled=True)
+    if result["segments"]:
+        with st.expander("🕒 С таймкодами"):
+            st.text(format_timestamped(result["segments"]))
+    
+    st.markdown("### 🎯 Этап 2: Анализ качества")
+    render_analysis(result["analysis"], job["payload"]["deal_id"], key=f"save_{job_id}")
+
+@traced
+def render_analysis(analysis: dict, deal_id: str, key: str = None):
+    """Карточка результатов анализа с сохранением в Bitrix24"""
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("🎤 Вежливость", f"{analysis.get('scores', {}).get('politeness', 0)}/5")
+    with col2:
+        st.metric("👂 Понимание", f"{analysis.get('scores', {}).get('understanding', 0)}/5")
+    with col3:
+        st.metric("💼 Решение", f"{analysis.get('scores', {}).get('solution', 0)}/5")
+    with col4:
+        st.metric("✍️ Закрытие", f"{analysis.get('scores', {}).get('closing', 0)}/5")
+    
+    st.markdown("---")
+    
+    total = analysis.get("total_score", 0)
+    if total >= 18:
+        st.success(f"🟢 Оценка: {total}/20 (Отличный звонок)")
+    elif total >= 14:
+        st.warning(f"🟡 Оценка: {total}/20 (Хороший звонок)")
+    else:
+        st.error(f"🔴 Оценка: {total}/20 (Требует улучшения)")
+    
+    st.markdown("---")
+    
+    # Детали
+    col1, col2 = st.columns(2)
+    with col1:
+        st.markdown("#### 😊 Тональность:")
+        st.write(analysis.get("sentiment", "N/A"))
+    with col2:
+        st.markdown("#### 🔑 Ключевые фразы:")
+        for phrase in analysis.get("key_phrases", [])[:3]:
+            st.write(f"• {phrase}")
+    
+    st.markdown("#### 💡 Рекомендации:")
+    for rec in analysis.get("recommendations", []):
+        st.write(f"• {rec}")
+    
+    segment_scores = analysis.get("segment_scores") or []
+    if segment_scores:
+        st.markdown("#### 🧩 Оценки реплик:")
+        st.dataframe(
+            pd.DataFrame({
+                "⏱️ Время": [f"{int(s['start']) // 60:02d}:{int(s['start']) % 60:02d}" for s in segment_scores],
+                "🗣️ Кто": ["Менеджер" if s["speaker"] == "manager" else "Клиент" for s in segment_scores],
+                "📋 Критерий": [CRITERION_LABELS[s["criterion"]] for s in segment_scores],
+                "⭐ Оценка": [f"{s['score']}/5" for s in segment_scores],
+                "💬 Комментарий": [s["comment"] for s in segment_scores],
+                "📝 Реплика": [s["text"] for s in segment_scores]
+            }),
+            use_container_width=True,
+            hide_index=True
+        )
+    
+    st.markdown("---")
+    
+    if st.button("💾 Сохранить в Bitrix24", use_container_width=True, key=key):
+        success = save_analysis_to_bitrix(deal_id, analysis)
+        if success:
+            st.success("✅ Сохранено в Bitrix24!")
+        else:
+            st.info("ℹ️ Результаты готовы")
+
+@traced
+def render_batch_analysis():
+    """Вкладка пакетного анализа: много файлов или список звонков Bitrix24"""
+    st.markdown("### 📦 Пакетный анализ звонков")
+    
+    source = st.radio("Источник:", ["📁 Файлы", "📊 Звонки Bitrix24"], horizontal=True, key="batch_source")
+    
+    col1, col2 = st.columns([2, 1])
+    with col2:
+        workers = st.slider("Параллельных потоков:", 1, 16, BATCH_MAX_WORKERS, key="batch_workers")
+    with col1:
+        if source == "📁 Файлы":
+            files = st.file_uploader(
+                "Выберите файлы",
+                type=["mp3", "wav", "ogg", "m4a"],
+                accept_multiple_files=True,
+                key="batch_files"
+            )
+            manager = st.selectbox("Менеджер:", [m["name"] for m in MANAGERS], key="batch_manager")
+            files, calls = files or [], []
+        else:
+            files, calls = [], [c for c in get_calls_from_bitrix() if c.get("FILES")]
+            st.info(f"📞 Звонков с записью: {len(calls)}")
+    
+    total = len(files) + len(calls)
+    if total and st.button(f"🚀 Проанализировать {total} звонков", use_container_width=True, type="primary"):
+        # Пакет уходит в фоновую задачу: rerun и переключение модулей его не прерывают
+        st.session_state.batch_job = submit_job("batch_analysis", {
+            "name": f"Пакет из {total} звонков",
+            "files": [{"name": f.name, "manager": manager, "audio_path": save_job_audio(f)} for f in files],
+            "calls": calls,
+            "workers": workers
+        })
+    
+    if st.session_state.get("batch_job"):
+        render_batch_job(st.session_state.batch_job)
+
+@traced
+def render_batch_job(job_id: int):
+    """Статус пакетной задачи; пока она активна, фрагмент опрашивает базу сам"""
+    job = get_job(job_id)
+    active = bool(job) and job["status"] in ("queued", "running")
+    _fragment(run_every=JOB_POLL_SECONDS if active else None)(_render_batch_job_body)(job_id, active)
+
+def _render_batch_job_body(job_id: int, was_active: bool):
+    job = get_job(job_id)
+    if not job:
+        return
+    
+    results = get_job_items(job_id)
+    if job["status"] in ("queued", "running"):
+        st.info(f"{JOB_STATUSES[job['status']]} · {job['payload']['name']} {job['progress']}")
+        st.caption("Можно переключаться между модулями - пакет обрабатывается в фоне")
+        if results:
+            st.dataframe(batch_results_frame(results), use_container_width=True, hide_index=True)
+        return
+    if was_active:
+        st.rerun()
+    if job["status"] == "error":
+        st.error(f"❌ Ошибка: {job['error']}")
+        if results:
+            st.dataframe(batch_results_frame(results), use_container_width=True, hide_index=True)
+        return
+    
+    failed = sum(1 for r in results if r["error"])
+    if failed:
+        st.warning(f"⚠️ Готово с ошибками: {failed} из {len(results)}")
+    else:
+        st.success(f"✅ Проанализировано звонков: {len(results)}")
+    st.dataframe(batch_results_frame(results), use_container_width=True, hide_index=True)
+    
+    to_save = [(r["deal_id"], r["analysis"]) for r in results if r["deal_id"] and r["analysis"]]
+    if to_save and st.button(f"💾 Сохранить {len(to_save)} анализов в Bitrix24", use_container_width=True, key=f"batch_save_{job_id}"):
+        saved = save_analyses_to_bitrix(to_save)
+        if saved:
+            st.success(f"✅ Сохранено в Bitrix24: {saved}")
+        else:
+            st.info("ℹ️ Результаты готовы")
+
+def batch_results_frame(results: list) -> pd.DataFrame:
+    """Таблица результатов пакетного анализа"""
+    return pd.DataFrame([
+        {
+            "📁 Звонок": r["name"],
+            "👤 Менеджер": r["manager"],
+            "⭐ Оценка": r["analysis"].get("total_score") if r["analysis"] else None,
+            "😊 Тональность": r["analysis"].get("sentiment", "") if r["analysis"] else "",
+            "⏱️ Время, с": r["elapsed"],
+            "❌ Ошибка": r["error"]
+        }
+        for r in results
+    ])
 
+@traced
 def module_sales_results():
     """Модуль 2: Результаты продаж"""
     st.markdown("# 🚀 Результаты отдела продаж")
@@ -368,169 +3925,267 @@ def module_sales_results():
     # KPI показатели
     st.markdown("## 📊 KPI МЕНЕДЖЕРОВ")
     
-    kpi_data = []
-    for m in MANAGERS:
-        kpi_data.append({
-            "👤 Менеджер": m["name"],
-            "📞 Звонков": m["calls"],
-            "🤝 Сделок": m["deals"],
-            "📈 KPI": f"{m['kpi']}%",
-            "🎯 План": f"{m['target']}%"
-        })
+    version = data_version()
+    col1, col2 = st.columns([1, 2])
+    with col1:
+        grain = st.radio("Период:", list(KPI_GRAINS), format_func=KPI_GRAINS.get, horizontal=True, key="kpi_grain")
+    with col2:
+        options = kpi_period_options(version, grain)
+        period = st.selectbox("Выберите период:", options, key=f"kpi_period_{grain}") if options else ""
+    if not period:
+        st.caption("Демо-данные: KPI появятся после синхронизации с Bitrix24")
     
-    df_kpi = pd.DataFrame(kpi_data)
-    st.dataframe(df_kpi, use_container_width=True, hide_index=True)
+    st.dataframe(kpi_table(version, grain, period), use_container_width=True, hide_index=True)
     
     st.markdown("---")
     
     # Графики
+    conversion_fig, calls_fig = sales_figures(version, grain, period)
     col1, col2 = st.columns(2)
     
     with col1:
-        st.markdown("## 📈 Выполнение плана")
-        names = [m["name"] for m in MANAGERS]
-        kpi_values = [m["kpi"] for m in MANAGERS]
-        
-        fig = px.bar(
-            x=names,
-            y=kpi_values,
-            labels={"x": "Менеджер", "y": "KPI %"},
-            title="KPI по менеджерам"
-        )
-        st.plotly_chart(fig, use_container_width=True)
+        st.markdown("## 📈 Конверсия")
+        st.plotly_chart(conversion_fig, use_container_width=True)
     
     with col2:
         st.markdown("## 📞 Количество звонков")
-        calls = [m["calls"] for m in MANAGERS]
-        
-        fig = px.bar(
-            x=names,
-            y=calls,
-            labels={"x": "Менеджер", "y": "Звонки"},
-            title="Звонки по менеджерам"
-        )
-        st.plotly_chart(fig, use_container_width=True)
+        st.plotly_chart(calls_fig, use_container_width=True)
 
+@traced
 def module_deal_audit():
     """Модуль 3: Аудит воронки"""
     st.markdown("# 🔍 Аудит воронки сделок")
     
     st.markdown("---")
     
-    # Таблица сделок
-    st.markdown("## 📋 Сделки")
-    
-    deals_data = []
-    for d in DEALS:
-        deals_data.append({
-            "ID": d["id"],
-            "📌 Сделка": d["title"],
-            "👤 Менеджер": d["manager"],
-            "💰 Сумма": f"{d['amount']:,}₽".replace(",", " "),
-            "📊 Стадия": d["stage"],
-            "📈 Вероятность": f"{d['probability']}%",
-            "🎯 Следующее действие": d["next_action"]
-        })
-    
-    df_deals = pd.DataFrame(deals_data)
-    st.dataframe(df_deals, use_container_width=True, hide_index=True)
-    
-    st.markdown("---")
+    version = data_version()
+    deals = load_deals_frame(version)
+    index = load_deal_index(version)
     
     # Фильтры
     col1, col2, col3 = st.columns(3)
     with col1:
-        filter_manager = st.selectbox("Менеджер:", ["Все"] + [m["name"] for m in MANAGERS])
+        filter_manager = st.selectbox("Менеджер:", ["Все"] + index["managers"])
     with col2:
-        filter_stage = st.selectbox("Стадия:", ["Все", "Переговоры", "Предложение", "Квалификация"])
+        filter_stage = st.selectbox("Стадия:", ["Все"] + index["stages"])
     with col3:
-        filter_probability = st.selectbox("Вероятность:", ["Все", "> 80%", "60-80%", "< 60%"])
+        filter_probability = st.selectbox("Вероятность:", ["Все"] + PROBABILITY_BUCKETS)
+    
+    positions, stage_counts = select_deals(index, filter_manager, filter_stage, filter_probability)
+    
+    # Таблица сделок
+    st.markdown("## 📋 Сделки")
+    
+    if filter_manager == filter_stage == filter_probability == "Все":
+        table = deals_table(version)
+    else:
+        shown = np.sort(positions)[:TABLE_MAX_ROWS]
+        table = build_deals_table(deals.iloc[shown])
+    st.dataframe(table, use_container_width=True, hide_index=True)
+    if len(positions) > TABLE_MAX_ROWS:
+        st.caption(f"Показано {TABLE_MAX_ROWS} из {len(positions)} сделок")
+    
+    st.markdown("---")
     
     # График воронки
     st.markdown("## 📊 Воронка продаж")
     
-    stages = ["Квалификация", "Предложение", "Переговоры", "Закрыто выиграно"]
-    counts = [2, 4, 6, 1]
-    
-    fig = px.funnel(
-        x=counts,
-        y=stages,
-        title="Воронка продаж"
-    )
-    st.plotly_chart(fig, use_container_width=True)
+    funnel = {stage: count for stage, count in stage_counts.items() if count}
+    if funnel:
+        st.plotly_chart(funnel_figure(tuple(funnel), tuple(funnel.values())), use_container_width=True)
+    else:
+        st.info("Нет сделок по выбранным фильтрам")
 
+@traced
 def module_deals_pulse():
     """Модуль 4: Пульс сделок"""
     st.markdown("# ⛵ Пульс сделок")
     
     st.markdown("---")
     
-    for deal in DEALS:
-        with st.container(border=True):
-            col1, col2, col3 = st.columns([2, 1, 1])
-            
-            with col1:
-                st.markdown(f"### 💼 {deal['title']}")
-                st.markdown(f"**Менеджер:** {deal['manager']} | **Сумма:** {deal['amount']:,}₽".replace(",", " "))
-            
-            with col2:
-                st.markdown(f"**Стадия:** {deal['stage']}")
-                st.markdown(f"**Вероятность:** {deal['probability']}%")
-            
-            with col3:
-                if deal['probability'] > 70:
-                    st.success("✅ Здоровая сделка")
-                elif deal['probability'] > 40:
-                    st.warning("⚠️ Требует внимания")
-                else:
-                    st.error("🔴 Критичная")
-            
-            st.markdown(f"📌 **Следующее действие:** {deal['next_action']}")
+    # Пульс обновляется сам, перерисовывая только свой фрагмент страницы
+    _fragment(run_every=PULSE_REFRESH_SECONDS)(render_pulse)()
+
+@traced
+def render_pulse():
+    """Сводка здоровья, изменения с прошлой версии данных и постраничная таблица сделок"""
+    version = data_version()
+    deals = load_deals_frame(version)
+    pulse = load_pulse_index(version)
+    # (версия, которую пользователь видел до текущей, текущая) - изменения показываются с первой
+    seen = st.session_state.get("pulse_seen", (None, None))
+    if seen[1] != version:
+        seen = (seen[1], version)
+        st.session_state.pulse_seen = seen
+    changes = get_deal_change_tracker().changes_between(seen[0], version, deals)
+    counts = np.diff(pulse["bounds"])
+    
+    cols = st.columns(len(PULSE_HEALTH) + 1)
+    for col, label, count in zip(cols, PULSE_HEALTH, counts):
+        col.metric(label, int(count))
+    cols[-1].metric("🔔 Изменились", len(changes["positions"]))
+    
+    if changes["table"] is not None and len(changes["table"]):
+        since = float(changes["since"])
+        since = f"с {datetime.fromtimestamp(since):%d.%m %H:%M:%S}" if since else "с первой загрузки"
+        with st.expander(f"🔔 Изменения {since} ({len(changes['positions'])})"):
+            st.dataframe(changes["table"], use_container_width=True, hide_index=True)
+    
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        health = st.radio("Показать:", ["Все"] + PULSE_HEALTH, horizontal=True, key="pulse_health")
+    with col2:
+        only_changed = st.toggle("Только изменившиеся", key="pulse_changed")
+    
+    if health == "Все":
+        positions = pulse["order"]
+    else:
+        h = PULSE_HEALTH.index(health)
+        positions = pulse["order"][pulse["bounds"][h]:pulse["bounds"][h + 1]]
+    changed = np.zeros(len(deals), dtype=bool)
+    changed[changes["positions"]] = True
+    if only_changed:
+        positions = positions[changed[positions]]
+    
+    pages = max((len(positions) + PULSE_PAGE_SIZE - 1) // PULSE_PAGE_SIZE, 1)
+    if st.session_state.get("pulse_page", 1) > pages:
+        st.session_state.pulse_page = pages
+    page = st.number_input(f"Страница (из {pages}):", min_value=1, max_value=pages, step=1, key="pulse_page")
+    
+    shown = positions[(page - 1) * PULSE_PAGE_SIZE:page * PULSE_PAGE_SIZE]
+    table = build_deals_table(deals.iloc[shown])
+    table.insert(0, "🩺 Здоровье", pd.Categorical.from_codes(pulse["health"][shown], PULSE_HEALTH))
+    table.insert(1, "🔔", np.where(changed[shown], "🔔", ""))
+    st.dataframe(table, use_container_width=True, hide_index=True)
+    synced = f" · данные от {datetime.fromtimestamp(float(version)):%d.%m %H:%M:%S}" if float(version) else ""
+    st.caption(f"Обновляется каждые {PULSE_REFRESH_SECONDS} с{synced}")
 
+@traced
 def module_ai_assistant():
     """Модуль 5: AI Ассистент"""
     st.markdown("# 🤖 AI Ассистент")
     
     if "chat_history" not in st.session_state:
         st.session_state.chat_history = []
+        st.session_state.chat_summary = ""
+        st.session_state.chat_summarized = 0
+        st.session_state.chat_visible = CHAT_PAGE_SIZE
     
-    # Историческое сообщение
-    for message in st.session_state.chat_history:
-        if message["role"] == "user":
-            with st.chat_message("user"):
-                st.markdown(message["content"])
-        else:
-            with st.chat_message("assistant"):
-                st.markdown(message["content"])
+    history = st.session_state.chat_history
+    ensure_index_fresh()
+    
+    # Историческое сообщение: только последняя страница, ранние - по запросу
+    hidden = max(len(history) - st.session_state.chat_visible, 0)
+    if hidden and st.button(f"⬆️ Показать ранее ({hidden})", use_container_width=True):
+        st.session_state.chat_visible += CHAT_PAGE_SIZE
+        st.rerun()
+    
+    for message in history[hidden:]:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
     
     # Ввод
     user_input = st.chat_input("Введите ваш вопрос...")
     
     if user_input:
-        st.session_state.chat_history.append({"role": "user", "content": user_input})
+        history.append({"role": "user", "content": user_input})
+        with st.chat_message("user"):
+            st.markdown(user_input)
         
         with st.chat_message("assistant"):
-            with st.spinner("⏳ Обработка..."):
-                try:
-                    response = client.chat.completions.create(
-                        model="gpt-4",
-                        messages=[{"role": "user", "content": user_input}],
-                        temperature=0.7,
-                        max_tokens=1000
-                    )
-                    
-                    response_text = response.choices[0].message.content
-                    st.markdown(response_text)
-                    
-                    st.session_state.chat_history.append({"role": "assistant", "content": response_text})
-                except Exception as e:
-                    st.error(f"❌ Ошибка: {str(e)}")
+            try:
+                context = crm_context(user_input)
+                messages, st.session_state.chat_summary, st.session_state.chat_summarized = build_chat_context(
+                    history,
+                    st.session_state.chat_summary,
+                    st.session_state.chat_summarized,
+                    budget=ASSISTANT_CONTEXT_TOKENS - count_tokens(context)
+                )
+                if context:
+                    # Найденные данные идут прямо перед последним вопросом
+                    messages.insert(-1, {"role": "system", "content": context})
+                response_text = st.write_stream(stream_chat(
+                    messages,
+                    ASSISTANT_MODEL,
+                    temperature=0.7,
+                    max_tokens=1000
+                ))
+                
+                history.append({"role": "assistant", "content": response_text})
+            except Exception as e:
+                st.error(f"❌ Ошибка: {str(e)}")
+
+def render_performance_panel():
+    """Боковая панель: спаны текущего rerun и счетчики процесса"""
+    spans = list(_RERUN_SPANS)
+    metrics = get_metrics()
+    
+    with st.sidebar.expander("⏱️ Производительность"):
+        elapsed_ms = (time.perf_counter() - _RERUN_STARTED) * 1000
+        st.caption(
+            f"{'🟢' if elapsed_ms <= RERUN_BUDGET_MS else '🔴'} Rerun: {elapsed_ms:.0f} из {RERUN_BUDGET_MS:.0f} мс, "
+            f"внешних вызовов и отрисовок: {len(spans)}"
+        )
+        if spans:
+            # Без pandas: панель видна на каждой странице, в том числе без дашбордов
+            summary = {}
+            for r in spans:
+                name = " ".join([r["span"], *map(str, r["labels"].values())])
+                row = summary.setdefault(name, {"Операция": name, "Вызовов": 0, "Всего, мс": 0.0, "Макс, мс": 0.0, "Ошибки": 0})
+                row["Вызовов"] += 1
+                row["Всего, мс"] = round(row["Всего, мс"] + r["seconds"] * 1000, 1)
+                row["Макс, мс"] = max(row["Макс, мс"], round(r["seconds"] * 1000, 1))
+                row["Ошибки"] += r["error"]
+            st.dataframe(
+                sorted(summary.values(), key=lambda row: -row["Всего, мс"]),
+                use_container_width=True,
+                hide_index=True
+            )
+            rerun_cost = sum(r.get("cost", 0) for r in spans)
+            if rerun_cost:
+                st.caption(f"Стоимость rerun: ${rerun_cost:.4f}, токенов: {sum(r.get('tokens', 0) for r in spans)}")
+        
+        st.markdown("**С запуска процесса**")
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("Токены", f"{metrics.total('openai_tokens_total'):,.0f}".replace(",", " "))
+            st.metric("Повторы", f"{metrics.total('retries_total'):.0f}")
+        with col2:
+            st.metric("Стоимость", f"${metrics.total('openai_cost_usd_total'):.2f}")
+            with metrics.lock:
+                errors = sum(stat["errors"] for stat in metrics.spans.values())
+            st.metric("Ошибки", errors)
+        
+        st.download_button("📥 Prometheus", metrics.prometheus(), file_name="rubi_metrics.prom", mime="text/plain", use_container_width=True)
+        st.download_button("📥 Спаны JSONL", metrics.jsonl(), file_name="rubi_spans.jsonl", mime="application/jsonl", use_container_width=True)
+
+def record_rerun():
+    """Полное время прогона скрипта по страницам - гистограмма для контроля бюджета старта"""
+    page = f"module_{st.session_state.get('module')}" if st.session_state.get("auth") else "login"
+    get_metrics().observe({
+        "span": "rerun",
+        "labels": {"page": page},
+        "error": False,
+        "seconds": time.perf_counter() - _RERUN_STARTED
+    })
 
 # =====================
 # ГЛАВНОЕ ПРИЛОЖЕНИЕ
 # =====================
 
+def bare_mode():
+    """Подготовка к работе без `streamlit run` (скрипты и бенчмарк).
+    
+    Без ScriptRunContext Streamlit предупреждает об этом на каждом вызове st.*.
+    """
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+
 def main():
+    # Задачи, прерванные остановкой процесса, продолжаются сразу, а не при первой новой задаче
+    get_job_executor()
+    webhook = start_webhook_server()
     if not require_auth():
         st.stop()
     
@@ -554,6 +4209,16 @@ def main():
         with col2:
             st.success("✅ Подключен") if BITRIX24_WEBHOOK else st.warning("⚠️ Опционально")
         
+        if WEBHOOK_PORT:
+            col1, col2 = st.columns([1, 2])
+            with col1:
+                st.markdown("📡 События:")
+            with col2:
+                if not BITRIX24_APP_TOKEN:
+                    st.error("❌ Нет BITRIX24_APP_TOKEN")
+                else:
+                    st.success(f"✅ Порт {WEBHOOK_PORT}") if webhook else st.error(f"❌ Порт {WEBHOOK_PORT} занят")
+        
         st.markdown("---")
         
         # Меню модулей
@@ -589,6 +4254,11 @@ def main():
         module_deals_pulse()
     elif module == 5:
         module_ai_assistant()
+    
+    render_performance_panel()
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        record_rerun()